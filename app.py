@@ -1,25 +1,95 @@
 #!/usr/bin/env python3
 import os
+import sys
 import uuid
 import time
-import threading
+import random
 import json
+import fcntl
+import hmac
+import threading
 import shutil
+import zipfile
+import mimetypes
+import multiprocessing
+from collections import OrderedDict
 from datetime import datetime
-from flask import Flask, request, render_template, send_from_directory, redirect, url_for, jsonify, flash, session
-from werkzeug.utils import secure_filename
+from urllib.parse import quote
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask, Response, request, render_template, send_from_directory, redirect, url_for, jsonify, flash, session, g, abort
+from werkzeug.utils import secure_filename, safe_join
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 import pdf_to_image
+from job_queue import JobQueue, QueueFull
+from conversion_store import ConversionStore
+import zip_stream
+from conversion_cache import ConversionCache, save_and_hash, cache_key
+from usage_tracker import UsageTracker, tree_usage, linked_usage
+from retention import RetentionService
+from renderers import get_renderer
+from metrics import Metrics
+from chunked_upload import UploadSessions, UploadError, file_type
+from batch import BatchManifest, ArchiveTooLarge, iter_zip_pdfs
+from output_manifest import build_manifest, load_manifest
+from profiling import PROFILE_DIR, profile_conversion, load_summary
 
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = 'uploads'
 app.config['OUTPUT_FOLDER'] = 'output'
 app.config['STATUS_FOLDER'] = 'status'
-app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32MB max file size
+app.config['MAX_CONTENT_LENGTH'] = 32 * 1024 * 1024  # 32MB max request body: single-request uploads and upload chunks
+app.config['MAX_UPLOAD_SIZE'] = int(os.environ.get('MAX_UPLOAD_SIZE_MB', 4096)) * 1024 * 1024  # Largest chunked upload
+app.config['UPLOAD_CHUNK_SIZE'] = int(os.environ.get('UPLOAD_CHUNK_SIZE_MB', 8)) * 1024 * 1024  # Chunk size suggested to clients
+app.config['BATCH_MAX_PDFS'] = int(os.environ.get('BATCH_MAX_PDFS', 500))  # PDFs in one batch, counting those in ZIP archives
+app.config['BATCH_MAX_EXTRACTED_SIZE'] = int(os.environ.get('BATCH_MAX_EXTRACTED_MB', 4096)) * 1024 * 1024  # Bytes extracted from the ZIP archives of one batch
+app.config['UPLOAD_SESSION_TTL'] = int(os.environ.get('UPLOAD_SESSION_TTL', 86400))  # Seconds an unfinished chunked upload is kept
 app.config['SECRET_KEY'] = 'your-secret-key-change-in-production'  # For session/login security
 app.config['USERS_FILE'] = 'users.json'  # File to store user data
 app.config['SUPERADMIN_ID'] = 'admin'  # The ID of the superadmin user who can delete conversions
+app.config['PDF_CHUNK_SIZE'] = int(os.environ.get('PDF_CHUNK_SIZE', pdf_to_image.DEFAULT_CHUNK_SIZE))  # Pages rendered at once per job
+app.config['PDF_WORKERS'] = int(os.environ.get('PDF_WORKERS', pdf_to_image.default_workers()))  # Worker processes per job
+app.config['PDF_RENDERER'] = os.environ.get('PDF_RENDERER', 'auto')  # Rendering backend (see renderers.py); auto follows PDF_RENDERER_BY_TYPE, else picks the first available
+app.config['PROGRESS_INTERVAL'] = float(os.environ.get('PROGRESS_INTERVAL', 1.0))  # Seconds between progress updates of a job
+app.config['STATUS_STREAM_POLL'] = float(os.environ.get('STATUS_STREAM_POLL', 0.25))  # Seconds between status file checks per stream after a change
+app.config['STATUS_STREAM_POLL_MAX'] = float(os.environ.get('STATUS_STREAM_POLL_MAX', 2.0))  # Longest interval the checks back off to while nothing changes
+app.config['STATUS_STREAM_HEARTBEAT'] = 15  # Seconds between keep-alive comments on idle streams
+app.config['STATUS_STREAM_TIMEOUT'] = int(os.environ.get('STATUS_STREAM_TIMEOUT', 600))  # Seconds before a stream is closed (the browser reconnects)
+app.config['STATUS_STREAM_RECONNECT'] = 3  # Seconds the browser waits before reconnecting a closed stream, plus up to as much again at random
+# Conversions running at once across all gunicorn workers; by default enough for their PDF_WORKERS to use every core
+app.config['JOB_SLOTS'] = int(os.environ.get('JOB_SLOTS', max(1, 2 * pdf_to_image.default_workers() // app.config['PDF_WORKERS'])))
+app.config['JOB_WORKERS'] = int(os.environ.get('JOB_WORKERS', app.config['JOB_SLOTS']))  # Conversion threads per gunicorn worker
+app.config['JOB_SWEEP_INTERVAL'] = float(os.environ.get('JOB_SWEEP_INTERVAL', 10))  # Seconds between checks for jobs of dead workers
+app.config['MAX_PENDING_JOBS'] = int(os.environ.get('MAX_PENDING_JOBS', 50))  # Queued conversions on the server
+app.config['MAX_PENDING_JOBS_PER_USER'] = int(os.environ.get('MAX_PENDING_JOBS_PER_USER', 10))  # Queued conversions per user
+
+app.config['DATABASE'] = os.path.join(app.config['STATUS_FOLDER'], 'conversions.db')  # Indexed conversion metadata
+app.config['HISTORY_PAGE_SIZE'] = 24  # Conversions per history page
+app.config['PREVIEW_WIDTHS'] = pdf_to_image.PREVIEW_WIDTHS  # WebP previews written per page for the gallery and history
+app.config['CONVERSION_CACHE'] = os.environ.get('CONVERSION_CACHE', '1') == '1'  # Reuse outputs of identical uploads
+app.config['CONVERSION_CACHE_MAX_BYTES'] = int(os.environ.get('CONVERSION_CACHE_MAX_BYTES', 2 * 1024 ** 3))  # LRU eviction threshold
+app.config['USAGE_RECONCILE_INTERVAL'] = int(os.environ.get('USAGE_RECONCILE_INTERVAL', 3600))  # Seconds between disk usage rescans
+app.config['RETENTION_INTERVAL'] = int(os.environ.get('RETENTION_INTERVAL', 300))  # Seconds between retention runs
+app.config['RETENTION_BATCH_SIZE'] = int(os.environ.get('RETENTION_BATCH_SIZE', 20))  # Conversions deleted per batch
+app.config['RETENTION_MAX_AGE_DAYS'] = float(os.environ.get('RETENTION_MAX_AGE_DAYS', 0))  # Delete older conversions (0 keeps them)
+app.config['RETENTION_USER_QUOTA_MB'] = int(os.environ.get('RETENTION_USER_QUOTA_MB', 0))  # Disk space per user (0 for no limit)
+app.config['RETENTION_DISK_BUDGET_MB'] = int(os.environ.get('RETENTION_DISK_BUDGET_MB', 0))  # Disk space for all conversions (0 for no limit)
+app.config['DELETE_SOURCE_PDFS'] = os.environ.get('DELETE_SOURCE_PDFS', '0') == '1'  # Delete uploads once converted
+app.config['LAZY_PREFETCH_PAGES'] = int(os.environ.get('LAZY_PREFETCH_PAGES', 2))  # Pages rendered ahead of the reader in lazy mode
+app.config['LAZY_RENDER_WORKERS'] = int(os.environ.get('LAZY_RENDER_WORKERS', 1))  # Processes rendering lazy pages per gunicorn worker
+app.config['LAZY_RENDER_TIMEOUT'] = float(os.environ.get('LAZY_RENDER_TIMEOUT', 30))  # Seconds a request waits for a lazy page before a 503
+app.config['CACHE_ZIP_ARCHIVES'] = os.environ.get('CACHE_ZIP_ARCHIVES', '0') == '1'  # Keep each job's ZIP from its first download on, for Range requests (a second copy of the images on disk)
+app.config['METRICS_FLUSH_INTERVAL'] = float(os.environ.get('METRICS_FLUSH_INTERVAL', 5))  # Seconds between metric writes per gunicorn worker
+app.config['SENDFILE_HEADER'] = os.environ.get('SENDFILE_HEADER', '')  # X-Accel-Redirect (nginx) or X-Sendfile (Apache, lighttpd) to let the front proxy send output files; empty sends them from Python
+app.config['SENDFILE_PREFIX'] = os.environ.get('SENDFILE_PREFIX', '/protected-output/')  # Internal nginx location aliased to OUTPUT_FOLDER, for X-Accel-Redirect
+app.config['USE_X_SENDFILE'] = app.config['SENDFILE_HEADER'] == 'X-Sendfile'
+app.config['IMMUTABLE_MAX_AGE'] = 365 * 86400  # Seconds browsers may keep the files of completed conversions
+app.config['OUTPUT_INFO_CACHE_SIZE'] = 1024  # Completed conversions whose owner and ETags are kept in memory per process
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN', '')  # Bearer token required by /metrics (empty for none)
+
+# Extensions of page images written by pdf_to_image.process_pdf
+IMAGE_EXTENSIONS = tuple(pdf_to_image.OUTPUT_FORMATS.values())
 
 # Initialize Flask-Login
 login_manager = LoginManager()
@@ -27,12 +97,42 @@ login_manager.init_app(app)
 login_manager.login_view = 'login'
 login_manager.login_message = "请先登录再访问此页面"
 
-# Create required directories if they don't exist
-for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'], app.config['STATUS_FOLDER']]:
-    os.makedirs(folder, exist_ok=True)
+# Indexed conversion metadata, opened on first use; existing status files
+# are imported by initialize_storage
+conversion_store = ConversionStore(app.config['DATABASE'])
+
+# Outputs of finished conversions keyed by PDF hash and options; inside the
+# output folder so pages can be hard-linked
+conversion_cache = ConversionCache(os.path.join(app.config['OUTPUT_FOLDER'], '.cache'), conversion_store,
+                                   app.config['CONVERSION_CACHE_MAX_BYTES'],
+                                   on_evict=lambda key: recount_cache_conversions(key))
+
+# Disk usage counters, rescanned in the background; the first scan is run by initialize_storage
+usage_tracker = UsageTracker(conversion_store, app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'],
+                             app.config['STATUS_FOLDER'], app.config['USAGE_RECONCILE_INTERVAL'])
 
-# Dictionary to track processing tasks
-processing_tasks = {}
+# Resumable chunked uploads, written to disk as they arrive; see chunked_upload.py
+upload_sessions = UploadSessions(os.path.join(app.config['UPLOAD_FOLDER'], '.partial'),
+                                 app.config['MAX_UPLOAD_SIZE'], app.config['UPLOAD_SESSION_TTL'])
+# Page counts probed as chunked uploads finish, by upload ID (this process's probes only)
+upload_probes = {}
+upload_probes_lock = threading.Lock()
+upload_prober = ThreadPoolExecutor(max_workers=2, thread_name_prefix="upload-probe")
+
+# Prometheus metrics, merged across gunicorn workers at scrape time; see metrics.py
+metrics = Metrics(os.path.join(app.config['STATUS_FOLDER'], '.metrics'), app.config['METRICS_FLUSH_INTERVAL'])
+metrics.histogram('pdf2img_http_request_duration_seconds', 'Time to handle a request, by route',
+                  ('method', 'route', 'status'))
+metrics.histogram('pdf2img_queue_wait_seconds', 'Time conversions spent queued before they started')
+metrics.histogram('pdf2img_page_stage_seconds', 'Time spent per page in each pipeline stage', ('stage',))
+metrics.histogram('pdf2img_job_duration_seconds', 'Time to run a conversion, by outcome', ('outcome',))
+metrics.histogram('pdf2img_job_pages_per_second', 'Throughput of completed conversions', (),
+                  buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 25, 50, 100))
+metrics.counter('pdf2img_jobs_total', 'Finished conversions by outcome and error type', ('outcome', 'error'))
+metrics.counter('pdf2img_pages_total', 'Pages converted')
+metrics.counter('pdf2img_bytes_written_total', 'Bytes of page images written')
+metrics.gauge('pdf2img_active_jobs', 'Conversions running')
+metrics.gauge('pdf2img_queued_jobs', 'Conversions waiting in the queue')
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -51,9 +151,23 @@ class User(UserMixin):
     def get_id(self):
         return self.id
 
-# Load users from JSON file
-def load_users():
-    if not os.path.exists(app.config['USERS_FILE']):
+class UserStore:
+    """
+    users.json with an in-process cache and a username index.
+    
+    The file is parsed again only when its inode, mtime or size changes, so
+    writes made by other gunicorn workers are still picked up at the cost of
+    one stat() per lookup. Writes go to a temporary file that is renamed over
+    users.json, so readers never see a partial file.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._version = None
+        self._users = {}
+        self._ids_by_username = {}
+    
+    def _create_default(self):
         # Create default admin if no users file exists
         users = {
             'admin': {
@@ -63,24 +177,78 @@ def load_users():
                 'is_admin': True
             }
         }
-        with open(app.config['USERS_FILE'], 'w') as f:
-            json.dump(users, f)
+        self._write(users)
         print("Created default admin user (username: admin, password: admin)")
     
-    with open(app.config['USERS_FILE'], 'r') as f:
-        return json.load(f)
+    def _write(self, users):
+        tmp_path = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(users, f)
+        os.replace(tmp_path, self.path)
+    
+    def _refresh(self):
+        """Reload the cache if users.json changed. Must be called with the lock held."""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            self._create_default()
+            stat = os.stat(self.path)
+        
+        version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        if version == self._version:
+            return
+        
+        with open(self.path, 'r') as f:
+            users = json.load(f)
+        self._users = users
+        self._ids_by_username = {data['username']: user_id for user_id, data in users.items()}
+        self._version = version
+    
+    def all(self):
+        """Copy of all user records, keyed by user ID, safe for the caller to modify"""
+        with self._lock:
+            self._refresh()
+            return {user_id: dict(data) for user_id, data in self._users.items()}
+    
+    def get(self, user_id):
+        """Copy of one user record, or None"""
+        with self._lock:
+            self._refresh()
+            data = self._users.get(user_id)
+            return dict(data) if data is not None else None
+    
+    def find_by_username(self, username):
+        """(user_id, copy of the record) for a username, or (None, None)"""
+        with self._lock:
+            self._refresh()
+            user_id = self._ids_by_username.get(username)
+            if user_id is None:
+                return None, None
+            return user_id, dict(self._users[user_id])
+    
+    def save(self, users):
+        """Replace all user records"""
+        with self._lock:
+            self._write(users)
+            # Force a reload so the index matches what was written
+            self._version = None
+            self._refresh()
+
+user_store = UserStore(app.config['USERS_FILE'])
+
+# Load users from JSON file
+def load_users():
+    return user_store.all()
 
 # Save users to JSON file
 def save_users(users):
-    with open(app.config['USERS_FILE'], 'w') as f:
-        json.dump(users, f)
+    user_store.save(users)
 
 # User loader for Flask-Login
 @login_manager.user_loader
 def load_user(user_id):
-    users = load_users()
-    if user_id in users:
-        user_data = users[user_id]
+    user_data = user_store.get(user_id)
+    if user_data is not None:
         return User(
             id=user_id,
             username=user_data['username'],
@@ -89,46 +257,641 @@ def load_user(user_id):
         )
     return None
 
-def process_pdf_in_background(file_id, filepath, output_dir, dpi, split_pages, rotation, crop_margin):
-    """Process PDF in a background thread and update status"""
+def claim_job(file_id):
+    """
+    Claim a pending job so that only one process runs it.
+    
+    Takes a non-blocking exclusive lock on the job's status file and checks
+    that the job is still pending. The lock covers the window until the
+    runner writes the "processing" status; after that, other processes see
+    the job is no longer pending.
+    
+    Returns:
+        (lock_handle, status) if the job was claimed, otherwise (None, None)
+    """
     status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
+    try:
+        handle = open(status_file, 'r')
+    except OSError:
+        return None, None
     
     try:
-        # Get current status to preserve custom fields
-        current_status = {}
-        if os.path.exists(status_file):
-            with open(status_file, 'r') as f:
-                current_status = json.load(f)
+        fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        status = json.load(handle)
+    except (OSError, ValueError):
+        handle.close()
+        return None, None
+    
+    # Cancelled, already finished, or picked up by another worker process
+    if status.get('status') != 'pending':
+        handle.close()
+        return None, None
+    
+    return handle, status
+
+def is_cancel_requested(file_id):
+    """Whether a cancellation was requested for a job, from any worker process"""
+    if job_queue.is_cancelled(file_id):
+        return True
+    status = get_status(file_id)
+    return status.get('status') == 'cancelled' or status.get('cancel_requested', False)
+
+def parse_conversion_options(form):
+    """
+    Read process_pdf options from the upload form.
+    
+    Raises:
+        ValueError: if an option is missing its expected type or range
+    """
+    options = {
+        'dpi': int(form.get('dpi', 300)),
+        'split_pages': 'split' in form,
+        'rotation': None,
+        'crop_margin': int(form.get('crop_margin', 0)),
+        'output_format': form.get('output_format', pdf_to_image.DEFAULT_OUTPUT_FORMAT),
+        'png_compression': int(form.get('png_compression', pdf_to_image.DEFAULT_PNG_COMPRESSION)),
+        'quality': int(form.get('quality', pdf_to_image.DEFAULT_QUALITY)),
+        'color_mode': form.get('color_mode', pdf_to_image.DEFAULT_COLOR_MODE),
+        'pages': form.get('pages', '').strip() or None,
+    }
+    
+    # Convert rotation to int if provided
+    rotation = form.get('rotation')
+    if rotation and rotation != 'auto':
+        options['rotation'] = int(rotation)
+    
+    if options['output_format'] not in pdf_to_image.OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {options['output_format']}")
+    if options['color_mode'] not in pdf_to_image.COLOR_MODES:
+        raise ValueError(f"Unsupported color mode: {options['color_mode']}")
+    if not 0 <= options['png_compression'] <= 9:
+        raise ValueError("PNG compression must be between 0 and 9")
+    if not 1 <= options['quality'] <= 100:
+        raise ValueError("Quality must be between 1 and 100")
+    if options['pages'] is not None:
+        pdf_to_image.parse_page_ranges(options['pages'])
+    
+    return options
+
+def conversion_options(status):
+    """process_pdf options recorded in a status file, with defaults for older records"""
+    return {
+        'dpi': status.get('dpi', 300),
+        'split_pages': status.get('split_pages', False),
+        'rotation': status.get('rotation'),
+        'crop_margin': status.get('crop_margin', 0),
+        'output_format': status.get('output_format', pdf_to_image.DEFAULT_OUTPUT_FORMAT),
+        'png_compression': status.get('png_compression', pdf_to_image.DEFAULT_PNG_COMPRESSION),
+        'quality': status.get('quality', pdf_to_image.DEFAULT_QUALITY),
+        'color_mode': status.get('color_mode', pdf_to_image.DEFAULT_COLOR_MODE),
+        'pages': status.get('pages'),
+    }
+
+def summarize_progress(progress):
+    """Turn a process_pdf progress report into the status file's progress field"""
+    total = progress['pages_total']
+    written = progress['pages_written']
+    elapsed = progress['elapsed']
+    eta = elapsed / written * (total - written) if written else None
+    return {
+        'percent': round(100.0 * written / total, 1) if total else 100.0,
+        'pages_total': total,
+        'pages_rendered': progress['pages_rendered'],
+        'pages_written': written,
+        'files_written': progress['files_written'],
+        'bytes_written': progress['bytes_written'],
+        'elapsed': round(elapsed, 2),
+        'eta_seconds': round(eta, 1) if eta is not None else None,
+        'timings': {stage: round(seconds, 3) for stage, seconds in progress['timings'].items()},
+    }
+
+def make_progress_publisher(file_id, extra):
+    """
+    Build a process_pdf progress_callback that publishes progress through
+    update_status at most once every PROGRESS_INTERVAL seconds.
+    
+    Publishing also checks for cancellation, so a cancel request written by
+    another worker process is honoured instead of being overwritten.
+    """
+    last_published = [0.0]
+    
+    def publish(progress):
+        now = time.time()
+        finished = progress['pages_written'] >= progress['pages_total']
+        if not finished and now - last_published[0] < app.config['PROGRESS_INTERVAL']:
+            return
+        last_published[0] = now
         
+        if is_cancel_requested(file_id):
+            raise pdf_to_image.ConversionCancelled(f"Conversion {file_id} was cancelled")
+        
+        summary = summarize_progress(progress)
+        conversion_store.set_usage(file_id, 'output', summary['bytes_written'], summary['files_written'])
+        update_status(file_id, "processing",
+                      f"Processed page {summary['pages_written']}/{summary['pages_total']}",
+                      progress=summary, **extra)
+    
+    return publish
+
+def zip_archive_path(file_id):
+    """Path of the cached ZIP archive of a conversion's images"""
+    return os.path.join(app.config['OUTPUT_FOLDER'], f"{file_id}_images.zip")
+
+# One archive built at a time per process: build_zip's temporary file is named after the process
+zip_build_lock = threading.Lock()
+
+def record_output_usage(file_id):
+    """
+    Recount the disk usage of a conversion's output directory and archive.
+
+    Pages hard-linked with the conversion cache are billed to the cache,
+    once, instead of to every conversion linking them, and recorded as the
+    conversion's linked usage for quotas; see scan_usage.
+    """
+    cached = set()
+    record = conversion_store.get(file_id)
+    key = record['params'].get('cache_key') if record else None
+    if key:
+        cached = conversion_cache.linked_inodes(key)
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+    size, files = tree_usage(output_dir, shared='split', skip_inodes=cached)
+    # Still the owner's, for quotas
+    conversion_store.set_usage(file_id, 'linked', *linked_usage(output_dir, cached))
+    zip_path = zip_archive_path(file_id)
+    if os.path.exists(zip_path):
+        size += os.path.getsize(zip_path)
+        files += 1
+    conversion_store.set_usage(file_id, 'output', size, files)
+
+def recount_cache_conversions(key):
+    """Recount the conversions that shared their pages with an evicted cache entry"""
+    for file_id in conversion_store.cache_conversions(key):
+        record_output_usage(file_id)
+
+def finish_outputs(file_id, output_dir):
+    """Post-process the outputs of a completed conversion"""
+    # Content ETags, so downloads can be revalidated without reading the files
+    try:
+        build_manifest(output_dir, subdirs=(pdf_to_image.PREVIEW_DIR,))
+    except OSError as e:
+        print(f"Error building manifest for {file_id}: {str(e)}")
+
+def lazy_pages(status):
+    """Page numbers available in a lazy conversion"""
+    return pdf_to_image.select_pages(status.get('pages'), status.get('pages_total', 0))
+
+def lazy_page_name(file_id, status, page_num):
+    """Filename process_pdf gives page `page_num` of a conversion"""
+    extension = pdf_to_image.OUTPUT_FORMATS[status.get('output_format', pdf_to_image.DEFAULT_OUTPUT_FORMAT)]
+    return f"{file_id}_page{page_num:04d}{extension}"
+
+class LazyPageBusy(Exception):
+    """A lazy page was not rendered before the request's deadline"""
+
+_lazy_render_pool = None
+_lazy_render_pool_lock = threading.Lock()
+
+def lazy_render_pool(renew=False):
+    """Processes rendering lazy pages, started on first use in each worker process"""
+    global _lazy_render_pool
+    with _lazy_render_pool_lock:
+        if _lazy_render_pool is None or renew:
+            # Rendering in the worker process would block every request of a gevent worker
+            _lazy_render_pool = ProcessPoolExecutor(max_workers=app.config['LAZY_RENDER_WORKERS'],
+                                                    mp_context=multiprocessing.get_context("spawn"))
+        return _lazy_render_pool
+
+def _release_lazy_lock(lock, lock_path):
+    # Removed before unlocking: the page exists by then, which is what waiters check first
+    try:
+        os.remove(lock_path)
+    except OSError:
+        pass
+    fcntl.flock(lock, fcntl.LOCK_UN)
+    lock.close()
+
+def start_lazy_render(file_id, status, page_num):
+    """
+    Start rendering a page of a lazy conversion in the render pool, unless
+    it already exists or is being rendered.
+    
+    A lock file per page, held until the render finishes, makes concurrent
+    requests for the same page, from any worker process, wait for one
+    render instead of each rendering it.
+    
+    Returns:
+        Future of the render, or None if there is nothing to start
+    """
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+    path = os.path.join(output_dir, lazy_page_name(file_id, status, page_num))
+    if os.path.exists(path):
+        return None
+    
+    lock_path = os.path.join(output_dir, f".page{page_num}.lock")
+    lock = open(lock_path, 'a')
+    try:
+        # Non-blocking so gevent/greenlet workers are never stuck in flock
+        fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        lock.close()
+        return None
+    try:
+        if os.path.exists(path):
+            _release_lazy_lock(lock, lock_path)
+            return None
+        options = conversion_options(status)
+        options.pop('pages')
+        encode_options = {key: options.pop(key) for key in
+                          ('output_format', 'png_compression', 'quality', 'color_mode')}
+        args = (pdf_to_image.render_page, os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf"),
+                page_num, output_dir, file_id)
+        kwargs = dict(encode_options=encode_options, renderer=app.config['PDF_RENDERER'], **options)
+        try:
+            future = lazy_render_pool().submit(*args, **kwargs)
+        except BrokenProcessPool:
+            # A render process died; start a new pool
+            future = lazy_render_pool(renew=True).submit(*args, **kwargs)
+    except Exception:
+        _release_lazy_lock(lock, lock_path)
+        raise
+    
+    def finish(future):
+        try:
+            if future.exception() is None:
+                record_output_usage(file_id)
+            else:
+                print(f"Error rendering page {page_num} of {file_id}: {str(future.exception())}")
+        finally:
+            _release_lazy_lock(lock, lock_path)
+    
+    future.add_done_callback(finish)
+    return future
+
+def ensure_lazy_page(file_id, status, page_num):
+    """
+    Render a page of a lazy conversion unless it already exists, and wait
+    for it, polling so gevent workers keep serving other requests.
+    
+    Raises:
+        LazyPageBusy: The page was not ready within LAZY_RENDER_TIMEOUT
+    
+    Returns:
+        Filename of the page image in the conversion's output directory
+    """
+    name = lazy_page_name(file_id, status, page_num)
+    path = os.path.join(app.config['OUTPUT_FOLDER'], file_id, name)
+    deadline = time.monotonic() + app.config['LAZY_RENDER_TIMEOUT']
+    future = None
+    while not os.path.exists(path):
+        if future is None:
+            # Rendered here, or by another request holding the page's lock
+            future = start_lazy_render(file_id, status, page_num)
+        elif future.done():
+            future.result()
+            break
+        if time.monotonic() > deadline:
+            raise LazyPageBusy(f"Page {page_num} of {file_id} is still being rendered")
+        time.sleep(0.05)
+    return name
+
+def lazy_archive_files(file_id, status):
+    """
+    Filenames of the pages of a lazy conversion, rendering those that have
+    not been viewed yet as its archive is streamed.
+    
+    The response has started by then, so a page that cannot be rendered is
+    logged and left out rather than cutting the archive short.
+    """
+    for page_num in lazy_pages(status):
+        try:
+            yield ensure_lazy_page(file_id, status, page_num)
+        except Exception as e:
+            print(f"Leaving page {page_num} out of the archive of {file_id}: {str(e)}")
+
+def prefetch_lazy_pages(file_id, status, page_num):
+    """Start rendering the neighbours of a page, without waiting for them"""
+    pages = lazy_pages(status)
+    index = pages.index(page_num)
+    neighbours = pages[index + 1:index + 1 + app.config['LAZY_PREFETCH_PAGES']] + pages[max(0, index - 1):index]
+    for n in neighbours:
+        try:
+            start_lazy_render(file_id, status, n)
+        except Exception as e:
+            print(f"Error prefetching page {n} of {file_id}: {str(e)}")
+
+def record_page_metrics(progress, last_progress):
+    """Count the page reported by a process_pdf progress callback in the metrics"""
+    # Progress is cumulative and reported once per page: the difference is this page
+    previous = last_progress.get('timings', {})
+    for stage, seconds in progress['timings'].items():
+        metrics.observe('pdf2img_page_stage_seconds', seconds - previous.get(stage, 0.0), stage=stage)
+    metrics.inc('pdf2img_pages_total', progress['pages_written'] - last_progress.get('pages_written', 0))
+    metrics.inc('pdf2img_bytes_written_total',
+                progress['bytes_written'] - last_progress.get('bytes_written', 0))
+
+def process_pdf_in_background(file_id, filepath, output_dir, options):
+    """Process a queued PDF on a job queue worker and update status"""
+    claim, current_status = claim_job(file_id)
+    if claim is None:
+        return
+    
+    # Fields that describe the job rather than its current state
+    extra = {k: v for k, v in current_status.items()
+             if k not in ['id', 'status', 'message', 'timestamp', 'queue_position', 'progress']}
+    publish_progress = make_progress_publisher(file_id, extra)
+    last_progress = {}
+    
+    def on_progress(progress):
+        record_page_metrics(progress, last_progress)
+        last_progress.update(progress)
+        publish_progress(progress)
+    
+    if extra.get('queued_at'):
+        metrics.observe('pdf2img_queue_wait_seconds', max(0.0, time.time() - extra['queued_at']))
+    metrics.inc('pdf2img_active_jobs')
+    started = time.perf_counter()
+    outcome, error = 'completed', ''
+    try:
         # Update status to processing while preserving other fields
-        update_status(file_id, "processing", "PDF processing started", 
-                     **{k: v for k, v in current_status.items() 
-                        if k not in ['id', 'status', 'message', 'timestamp']})
+        update_status(file_id, "processing", "PDF processing started", **extra)
         
         # Process the PDF
-        pdf_to_image.process_pdf(
-            filepath, 
-            output_dir, 
-            dpi=dpi, 
-            split_pages=split_pages, 
-            rotation=rotation, 
-            crop_margin=crop_margin
+        kwargs = dict(
+            chunk_size=app.config['PDF_CHUNK_SIZE'],
+            workers=app.config['PDF_WORKERS'],
+            cancel_check=lambda: is_cancel_requested(file_id),
+            progress_callback=on_progress,
+            preview_widths=app.config['PREVIEW_WIDTHS'],
+            renderer=app.config['PDF_RENDERER'],
+            **options
         )
+        if extra.get('profile'):
+            # cProfile only sees this thread: render every page here
+            kwargs['workers'] = 1
+            saved = profile_conversion(os.path.join(output_dir, PROFILE_DIR), pdf_to_image.process_pdf,
+                                       filepath, output_dir, **kwargs)
+        else:
+            saved = pdf_to_image.process_pdf(filepath, output_dir, **kwargs)
         
         # Update status to completed
-        update_status(file_id, "completed", "PDF processed successfully", 
-                     **{k: v for k, v in current_status.items() 
-                        if k not in ['id', 'status', 'message', 'timestamp']})
+        progress = summarize_progress(last_progress) if last_progress else None
+        update_status(file_id, "completed", "PDF processed successfully", progress=progress,
+                      image_count=len(saved),
+                      thumbnail=os.path.basename(saved[0]) if saved else None,
+                      preview_widths=list(app.config['PREVIEW_WIDTHS']), **extra)
+        
+        finish_outputs(file_id, output_dir)
+        if app.config['CONVERSION_CACHE'] and extra.get('cache_key'):
+            conversion_cache.add(extra['cache_key'], extra['pdf_sha256'], output_dir, file_id)
+    except pdf_to_image.ConversionCancelled:
+        outcome = 'cancelled'
+        update_status(file_id, "cancelled", "PDF processing was cancelled", **extra)
+        print(f"Cancelled {file_id}")
     except Exception as e:
+        outcome, error = 'error', type(e).__name__
         # Update status to error
-        update_status(file_id, "error", f"Error processing PDF: {str(e)}",
-                     **{k: v for k, v in current_status.items() 
-                        if k not in ['id', 'status', 'message', 'timestamp']})
+        update_status(file_id, "error", f"Error processing PDF: {str(e)}", **extra)
         print(f"Error processing {file_id}: {str(e)}")
     finally:
-        # Remove task from tracking
-        if file_id in processing_tasks:
-            del processing_tasks[file_id]
+        elapsed = time.perf_counter() - started
+        metrics.dec('pdf2img_active_jobs')
+        metrics.inc('pdf2img_jobs_total', outcome=outcome, error=error)
+        metrics.observe('pdf2img_job_duration_seconds', elapsed, outcome=outcome)
+        if outcome == 'completed' and last_progress.get('pages_written') and elapsed > 0:
+            metrics.observe('pdf2img_job_pages_per_second', last_progress['pages_written'] / elapsed)
+        record_output_usage(file_id)
+        release_claim(claim)
+
+def process_batch_in_background(batch_id, file_ids, options):
+    """
+    Run a batch of queued conversions as one job, with the pages of all of
+    them on one worker pool (see pdf_to_image.process_batch).
+    
+    Each conversion keeps its own status, claimed when the batch reaches
+    it, so conversions the batch never got to are still pending and are
+    queued again after a restart.
+    """
+    claims, extras, publishers, last_progress = {}, {}, {}, {}
+    started = {}
+    
+    def on_document_start(file_id):
+        claim, status = claim_job(file_id)
+        if claim is None:
+            return False
+        claims[file_id] = claim
+        extras[file_id] = {k: v for k, v in status.items()
+                           if k not in ['id', 'status', 'message', 'timestamp', 'queue_position', 'progress']}
+        publishers[file_id] = make_progress_publisher(file_id, extras[file_id])
+        last_progress[file_id] = {}
+        started[file_id] = time.perf_counter()
+        if extras[file_id].get('queued_at'):
+            metrics.observe('pdf2img_queue_wait_seconds', max(0.0, time.time() - extras[file_id]['queued_at']))
+        update_status(file_id, "processing", "PDF processing started", **extras[file_id])
+        return True
+    
+    def on_progress(file_id, progress):
+        record_page_metrics(progress, last_progress[file_id])
+        last_progress[file_id].update(progress)
+        publishers[file_id](progress)
+    
+    def on_document_done(file_id, result):
+        extra = extras.pop(file_id)
+        outcome, error = result['status'], ''
+        try:
+            if outcome == 'completed':
+                progress = last_progress[file_id]
+                saved = result['images']
+                update_status(file_id, "completed", "PDF processed successfully",
+                              progress=summarize_progress(progress) if progress else None,
+                              image_count=len(saved),
+                              thumbnail=os.path.basename(saved[0]) if saved else None,
+                              preview_widths=list(app.config['PREVIEW_WIDTHS']), **extra)
+                output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+                finish_outputs(file_id, output_dir)
+                if app.config['CONVERSION_CACHE'] and extra.get('cache_key'):
+                    conversion_cache.add(extra['cache_key'], extra['pdf_sha256'], output_dir, file_id)
+            elif outcome == 'cancelled':
+                update_status(file_id, "cancelled", "PDF processing was cancelled", **extra)
+            else:
+                error = (result['error'] or '').split(':')[0]
+                update_status(file_id, "error", f"Error processing PDF: {result['error']}", **extra)
+        finally:
+            elapsed = time.perf_counter() - started.pop(file_id)
+            metrics.inc('pdf2img_jobs_total', outcome=outcome, error=error)
+            metrics.observe('pdf2img_job_duration_seconds', elapsed, outcome=outcome)
+            record_output_usage(file_id)
+            release_claim(claims.pop(file_id))
+    
+    metrics.inc('pdf2img_active_jobs')
+    try:
+        pdf_to_image.process_batch(
+            [(file_id, os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf"),
+              os.path.join(app.config['OUTPUT_FOLDER'], file_id)) for file_id in file_ids],
+            chunk_size=app.config['PDF_CHUNK_SIZE'],
+            workers=app.config['PDF_WORKERS'],
+            preview_widths=app.config['PREVIEW_WIDTHS'],
+            renderer=app.config['PDF_RENDERER'],
+            # Conversions are resumed through their statuses, not the manifest
+            manifest=BatchManifest(batch_manifest_path(batch_id), options, resume=False),
+            cancel_check=is_cancel_requested,
+            progress_callback=on_progress,
+            on_document_start=on_document_start,
+            on_document_done=on_document_done,
+            **options
+        )
+    except Exception as e:
+        print(f"Error processing batch {batch_id}: {str(e)}")
+        # Conversions the batch had started but not finished
+        for file_id in list(claims):
+            update_status(file_id, "error", f"Error processing PDF: {str(e)}", **extras.pop(file_id, {}))
+            record_output_usage(file_id)
+            release_claim(claims.pop(file_id))
+    finally:
+        metrics.dec('pdf2img_active_jobs')
+
+def release_claim(claim):
+    fcntl.flock(claim, fcntl.LOCK_UN)
+    claim.close()
+
+def batch_manifest_path(batch_id):
+    return os.path.join(app.config['STATUS_FOLDER'], '.batches', f"{batch_id}.json")
+
+def run_job(job_id, *args):
+    """Job queue runner: a single conversion, or a batch of them"""
+    if job_id.startswith(BATCH_PREFIX):
+        process_batch_in_background(job_id, *args)
+    else:
+        process_pdf_in_background(job_id, *args)
+
+def publish_queue_positions(order):
+    """Write queue positions into the status files of queued jobs"""
+    for position, job_id in enumerate(order, start=1):
+        if job_id.startswith(BATCH_PREFIX):
+            # The conversions of a batch wait at the batch's position
+            file_ids = [record['id'] for record in conversion_store.batch_conversions(job_id)]
+        else:
+            file_ids = [job_id]
+        for file_id in file_ids:
+            status = get_status(file_id)
+            if status.get('status') != 'pending' or status.get('queue_position') == position:
+                continue
+            fields = {k: v for k, v in status.items() if k not in ['id', 'status', 'message', 'timestamp']}
+            fields['queue_position'] = position
+            update_status(file_id, "pending", f"Waiting in queue (position {position})", **fields)
+
+def requeue_job(job_id, *args):
+    """Set the conversions of a job whose worker died back to pending, before the job is queued again"""
+    file_ids = args[0] if job_id.startswith(BATCH_PREFIX) else [job_id]
+    for file_id in file_ids:
+        status = get_status(file_id)
+        if status.get('status') != 'processing':
+            continue
+        fields = {k: v for k, v in status.items()
+                  if k not in ['id', 'status', 'message', 'timestamp', 'progress', 'cancel_requested']}
+        if status.get('cancel_requested'):
+            update_status(file_id, "cancelled", "PDF processing was cancelled", **fields)
+        else:
+            update_status(file_id, "pending", "Worker stopped, waiting to be processed again", **fields)
+
+# Worker pool fed by the queue shared by all gunicorn workers; see job_queue.py
+# Job IDs of batches start with this; other jobs are named after their conversion
+BATCH_PREFIX = 'batch-'
+
+job_queue = JobQueue(
+    run_job,
+    app.config['DATABASE'],
+    os.path.join(app.config['STATUS_FOLDER'], '.workers'),
+    num_workers=app.config['JOB_WORKERS'],
+    max_pending=app.config['MAX_PENDING_JOBS'],
+    max_pending_per_user=app.config['MAX_PENDING_JOBS_PER_USER'],
+    slots=app.config['JOB_SLOTS'],
+    sweep_interval=app.config['JOB_SWEEP_INTERVAL'],
+    on_change=publish_queue_positions,
+    on_requeue=requeue_job
+)
+
+def purge_conversion(file_id):
+    """Delete every file and record of a conversion"""
+    # Delete output directory
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+    if os.path.exists(output_dir):
+        shutil.rmtree(output_dir)
+    
+    # Delete any zip files associated with this conversion
+    zip_path = zip_archive_path(file_id)
+    if os.path.exists(zip_path):
+        os.remove(zip_path)
+    
+    # Delete uploaded PDF file
+    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf")
+    if os.path.exists(pdf_path):
+        os.remove(pdf_path)
+    
+    # Delete status file
+    status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
+    if os.path.exists(status_file):
+        os.remove(status_file)
+    conversion_store.delete(file_id)
+    conversion_store.delete_usage(file_id)
+    with completed_outputs_lock:
+        completed_outputs.pop(file_id, None)
+
+def delete_source_pdf(file_id):
+    """Delete the uploaded PDF of a converted file"""
+    pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf")
+    if os.path.exists(pdf_path):
+        os.remove(pdf_path)
+    conversion_store.set_usage(file_id, 'upload', 0, 0)
+
+# Deletes conversions by policy and on cleanup requests, in the background; see retention.py
+retention_service = RetentionService(
+    conversion_store,
+    purge_conversion,
+    delete_source_pdf,
+    lock_path=os.path.join(app.config['STATUS_FOLDER'], '.retention.lock'),
+    interval=app.config['RETENTION_INTERVAL'],
+    batch_size=app.config['RETENTION_BATCH_SIZE'],
+    max_age=app.config['RETENTION_MAX_AGE_DAYS'] * 86400,
+    user_quota=app.config['RETENTION_USER_QUOTA_MB'] * 1024 * 1024,
+    disk_budget=app.config['RETENTION_DISK_BUDGET_MB'] * 1024 * 1024,
+    delete_sources=app.config['DELETE_SOURCE_PDFS'],
+    on_purge_all=lambda: conversion_cache.evict(0)
+)
+
+def start_services():
+    """
+    Set up the storage if needed and start this process's background
+    threads. Called by gunicorn's post_worker_init hook (see
+    gunicorn.conf.py), and on the first request otherwise, i.e. always
+    after gunicorn forks.
+    """
+    global _services_pid
+    if _services_pid == os.getpid():
+        return
+    if os.environ.get('PDF2IMG_STORAGE_READY') != '1':
+        initialize_storage()
+    retention_service.start()
+    usage_tracker.start()
+    job_queue.start()
+    metrics.start()
+    _services_pid = os.getpid()
+
+_services_pid = None
+
+@app.before_request
+def start_background_services():
+    start_services()
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = g.get('request_started')
+    if started is not None:
+        # The URL rule rather than the path, so IDs do not become labels
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        metrics.observe('pdf2img_http_request_duration_seconds', time.perf_counter() - started,
+                        method=request.method, route=route, status=response.status_code)
+    return response
 
 def update_status(file_id, status, message, **kwargs):
     """Update the status of a processing task"""
@@ -140,9 +903,18 @@ def update_status(file_id, status, message, **kwargs):
         **kwargs
     }
     
+    # Write to a temporary file and rename it over the status file, so readers
+    # (pollers, status streams) never see a half-written file
     status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
-    with open(status_file, 'w') as f:
+    tmp_file = os.path.join(app.config['STATUS_FOLDER'], f".{file_id}.{os.getpid()}.{threading.get_ident()}.tmp")
+    with open(tmp_file, 'w') as f:
         json.dump(status_data, f)
+        size = f.tell()
+    os.replace(tmp_file, status_file)
+    
+    # Keep the indexed metadata store and the disk usage in step with the status file
+    conversion_store.upsert(status_data)
+    conversion_store.set_usage(file_id, 'status', size, 1)
     
     return status_data
 
@@ -156,6 +928,78 @@ def get_status(file_id):
     with open(status_file, 'r') as f:
         return json.load(f)
 
+def recover_pending_jobs():
+    """
+    Queue pending conversions that are missing from the job queue, such as
+    those queued by versions of the app that kept the queue in memory.
+    
+    Jobs already in the queue are left as they are.
+    """
+    pending = []
+    for status_file in os.listdir(app.config['STATUS_FOLDER']):
+        if not status_file.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(app.config['STATUS_FOLDER'], status_file), 'r') as f:
+                status = json.load(f)
+        except (OSError, ValueError):
+            continue
+        if status.get('status') == 'pending':
+            pending.append(status)
+    
+    # Oldest first, so recovered jobs keep their original order
+    pending.sort(key=lambda s: s.get('timestamp', 0))
+    batches = OrderedDict()
+    for status in pending:
+        file_id = status['id']
+        if status.get('batch_id'):
+            # The rest of an interrupted batch runs as a batch again
+            batches.setdefault(status['batch_id'], []).append(status)
+            continue
+        job_queue.submit(
+            file_id, status.get('user_id'),
+            os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf"),
+            os.path.join(app.config['OUTPUT_FOLDER'], file_id),
+            conversion_options(status),
+            force=True
+        )
+    for batch_id, statuses in batches.items():
+        job_queue.submit(batch_id, statuses[0].get('user_id'), [status['id'] for status in statuses],
+                         conversion_options(statuses[0]), force=True)
+    if pending:
+        print(f"Checked {len(pending)} pending conversions against the job queue")
+    return len(pending)
+
+def initialize_storage():
+    """
+    Create the folders and the metadata database, import the status files
+    and scan disk usage on first start, and queue pending conversions
+    missing from the job queue.
+    
+    Run by `python app.py init` before gunicorn starts its workers (see
+    gunicorn.conf.py), or otherwise by each process before it serves (a
+    no-op after the first run but for the recovery scan). The startup lock
+    makes processes run it one at a time; importing the app has no side
+    effects.
+    """
+    for folder in [app.config['UPLOAD_FOLDER'], app.config['OUTPUT_FOLDER'], app.config['STATUS_FOLDER']]:
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(app.config['STATUS_FOLDER'], '.startup.lock'), 'a') as lock:
+        while True:
+            try:
+                # Non-blocking so gevent/greenlet workers are never stuck in flock
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except OSError:
+                time.sleep(0.2)
+        if conversion_store.get_meta('status_files_imported') is None:
+            imported = conversion_store.import_status_files(app.config['STATUS_FOLDER'],
+                                                            app.config['OUTPUT_FOLDER'], IMAGE_EXTENSIONS)
+            print(f"Imported {imported} status files into {app.config['DATABASE']}")
+        if usage_tracker.last_reconciled() is None:
+            usage_tracker.reconcile()
+        recover_pending_jobs()
+
 @app.route('/')
 def index():
     # Redirect to login if not logged in
@@ -172,19 +1016,17 @@ def login():
         username = request.form.get('username')
         password = request.form.get('password')
         
-        users = load_users()
         user_found = None
         
         # Find user by username
-        for user_id, user_data in users.items():
-            if user_data['username'] == username:
-                user_found = User(
-                    id=user_id,
-                    username=user_data['username'],
-                    password_hash=user_data['password_hash'],
-                    is_admin=user_data.get('is_admin', False)
-                )
-                break
+        user_id, user_data = user_store.find_by_username(username)
+        if user_data is not None:
+            user_found = User(
+                id=user_id,
+                username=user_data['username'],
+                password_hash=user_data['password_hash'],
+                is_admin=user_data.get('is_admin', False)
+            )
         
         if user_found and User.check_password(user_found.password_hash, password):
             login_user(user_found)
@@ -216,10 +1058,9 @@ def register():
         users = load_users()
         
         # Check if username exists
-        for user_data in users.values():
-            if user_data['username'] == username:
-                flash('用户名已存在', 'danger')
-                return render_template('register.html')
+        if user_store.find_by_username(username)[0] is not None:
+            flash('用户名已存在', 'danger')
+            return render_template('register.html')
         
         # Check if passwords match
         if password != password_confirm:
@@ -341,54 +1182,406 @@ def upload_file():
         return jsonify({'error': 'No selected file'}), 400
     
     if file and file.filename.lower().endswith('.pdf'):
+        # Get parameters from form
+        try:
+            options = parse_conversion_options(request.form)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        lazy = 'lazy' in request.form
+        if lazy and options['split_pages']:
+            return jsonify({'error': 'Lazy mode cannot split pages'}), 400
+        
         # Generate unique filename
         unique_id = str(uuid.uuid4())
         original_filename = secure_filename(file.filename)
         filename = unique_id + '.pdf'
         filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(filepath)
-        
-        # Get parameters from form
-        dpi = int(request.form.get('dpi', 300))
-        split_pages = 'split' in request.form
-        rotation = request.form.get('rotation')
-        crop_margin = int(request.form.get('crop_margin', 0))
-        
-        # Convert rotation to int if provided
-        if rotation and rotation != 'auto':
-            rotation = int(rotation)
-        else:
-            rotation = None
-            
-        # Create output directory
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], unique_id)
-        os.makedirs(output_dir, exist_ok=True)
-        
-        # Initialize status
-        update_status(unique_id, "pending", "PDF upload completed, waiting for processing", 
-                     original_filename=original_filename, dpi=dpi, split_pages=split_pages,
-                     rotation=rotation, crop_margin=crop_margin,
-                     user_id=current_user.id, username=current_user.username)
-        
-        # Start background processing
-        process_thread = threading.Thread(
-            target=process_pdf_in_background,
-            args=(unique_id, filepath, output_dir, dpi, split_pages, rotation, crop_margin)
-        )
-        process_thread.daemon = True
-        process_thread.start()
-        
-        # Keep track of the task
-        processing_tasks[unique_id] = process_thread
-        
+        pdf_sha256 = save_and_hash(file.stream, filepath)
+        return start_conversion(unique_id, filepath, original_filename, pdf_sha256, options, lazy)
+    
+    return jsonify({'error': 'Invalid file type'}), 400
+
+def conversion_cache_key(pdf_sha256, options, pdf_path):
+    """Conversion cache key of the PDF at `pdf_path` converted with `options` by this server"""
+    return cache_key(pdf_sha256, dict(options, preview_widths=list(app.config['PREVIEW_WIDTHS']),
+                                      renderer=get_renderer(app.config['PDF_RENDERER'], pdf_path).name))
+
+def complete_from_cache(unique_id, key, output_dir, **fields):
+    """
+    Complete a conversion with the pages of an identical earlier one, if
+    the conversion cache has them.
+    
+    Args:
+        **fields: Status fields of the conversion
+    
+    Returns:
+        True if the conversion was completed from the cache
+    """
+    if not app.config['CONVERSION_CACHE']:
+        return False
+    pages = conversion_cache.lookup(key, output_dir, unique_id)
+    if pages is None:
+        return False
+    update_status(unique_id, "completed", "PDF processed successfully (from cache)",
+                  cache_key=key, cache_hit=True,
+                  image_count=len(pages), thumbnail=pages[0] if pages else None,
+                  preview_widths=list(app.config['PREVIEW_WIDTHS']), **fields)
+    finish_outputs(unique_id, output_dir)
+    record_output_usage(unique_id)
+    metrics.inc('pdf2img_jobs_total', outcome='cached', error='')
+    return True
+
+def start_conversion(unique_id, filepath, original_filename, pdf_sha256, options, lazy, pages_total=None):
+    """
+    Start converting a saved upload: lazily, from the conversion cache, or on the job queue.
+    
+    Args:
+        pages_total: Page count if already known (e.g. probed while a chunked upload finished)
+    
+    Returns:
+        The JSON response of the upload request
+    """
+    # Admins can profile a conversion; lazy conversions have no job to profile
+    profile = current_user.is_admin and request.form.get('profile') == '1' and not lazy
+    conversion_store.set_usage(unique_id, 'upload', os.path.getsize(filepath), 1)
+    key = conversion_cache_key(pdf_sha256, options, filepath)
+    
+    # Create output directory
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], unique_id)
+    os.makedirs(output_dir, exist_ok=True)
+    
+    # Lazy mode: only count the pages now and render each one when it is first requested
+    if lazy:
+        try:
+            if pages_total is None:
+                pages_total = pdf_to_image.get_page_count(filepath, app.config['PDF_RENDERER'])
+        except Exception as e:
+            os.remove(filepath)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            conversion_store.delete_usage(unique_id)
+            return jsonify({'error': f'Could not read PDF: {str(e)}'}), 400
+        pages = pdf_to_image.select_pages(options['pages'], pages_total)
+        if not pages:
+            os.remove(filepath)
+            shutil.rmtree(output_dir, ignore_errors=True)
+            conversion_store.delete_usage(unique_id)
+            return jsonify({'error': f'No pages selected: the document has {pages_total} pages'}), 400
+        update_status(unique_id, "completed", "PDF ready, pages are rendered on demand",
+                      original_filename=original_filename, **options,
+                      user_id=current_user.id, username=current_user.username,
+                      pdf_sha256=pdf_sha256, lazy=True, pages_total=pages_total,
+                      image_count=len(pages), thumbnail=str(pages[0]), preview_widths=[])
         return jsonify({
             'success': True,
             'id': unique_id,
-            'message': 'PDF upload successful, processing started',
-            'status': 'pending'
+            'message': 'PDF ready, pages are rendered on demand',
+            'status': 'completed',
         })
     
-    return jsonify({'error': 'Invalid file type'}), 400
+    if pages_total is not None and not pdf_to_image.select_pages(options['pages'], pages_total):
+        os.remove(filepath)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        conversion_store.delete_usage(unique_id)
+        return jsonify({'error': f'No pages selected: the document has {pages_total} pages'}), 400
+    
+    # The same PDF was already converted with the same options: reuse its pages
+    if not profile and complete_from_cache(unique_id, key, output_dir, original_filename=original_filename,
+                                           **options, user_id=current_user.id, username=current_user.username,
+                                           pdf_sha256=pdf_sha256):
+        return jsonify({
+            'success': True,
+            'id': unique_id,
+            'message': 'PDF conversion found in cache',
+            'status': 'completed',
+        })
+    
+    # Initialize status
+    update_status(unique_id, "pending", "PDF upload completed, waiting for processing", 
+                 original_filename=original_filename, **options,
+                 user_id=current_user.id, username=current_user.username,
+                 pdf_sha256=pdf_sha256, cache_key=key, queued_at=time.time(),
+                 **({'profile': True} if profile else {}),
+                 **({'pages_total': pages_total} if pages_total is not None else {}))
+    
+    # Queue for background processing
+    try:
+        position = job_queue.submit(unique_id, current_user.id, filepath, output_dir, options)
+    except QueueFull as e:
+        # Rejected by admission control: leave no trace of the upload
+        os.remove(filepath)
+        shutil.rmtree(output_dir, ignore_errors=True)
+        os.remove(os.path.join(app.config['STATUS_FOLDER'], f"{unique_id}.json"))
+        conversion_store.delete(unique_id)
+        conversion_store.delete_usage(unique_id)
+        return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'success': True,
+        'id': unique_id,
+        'message': 'PDF upload successful, processing queued',
+        'status': 'pending',
+        'queue_position': position
+    })
+
+
+
+def probe_upload(record, path):
+    """
+    Count the pages of a chunked PDF upload as soon as they can be read:
+    after its first chunk if the PDF is linearized, whose first bytes then
+    hold the page count, otherwise once its last chunk, with the trailer
+    and page tree, is written.
+    """
+    upload_id = record['id']
+    if 'pages_total' in record:
+        return
+    if record['offset'] < record['size']:
+        if record['offset'] < min(record['size'], pdf_to_image.LINEARIZED_HEADER_SIZE):
+            return
+        with open(path, 'rb') as f:
+            head = f.read(pdf_to_image.LINEARIZED_HEADER_SIZE)
+        pages_total = pdf_to_image.linearized_page_count(head, record['size'])
+        if pages_total is not None:
+            upload_sessions.update(upload_id, pages_total=pages_total)
+        return
+    
+    def probe():
+        pages_total = pdf_to_image.get_page_count(path, app.config['PDF_RENDERER'])
+        # For the completion request, should another gunicorn worker receive it
+        upload_sessions.update(upload_id, pages_total=pages_total)
+        return pages_total
+    
+    with upload_probes_lock:
+        # Drop probes of uploads completed by another gunicorn worker
+        for other_id, future in list(upload_probes.items()):
+            if future.done() and not upload_sessions.exists(other_id):
+                del upload_probes[other_id]
+        upload_probes[upload_id] = upload_prober.submit(probe)
+
+def upload_error_response(e):
+    body = {'error': str(e)}
+    if e.offset is not None:
+        body['offset'] = e.offset
+    return jsonify(body), e.status
+
+@app.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a chunked upload: form fields filename (a PDF, or a ZIP of PDFs for /batch) and size (bytes)"""
+    filename = secure_filename(request.form.get('filename', ''))
+    try:
+        record = upload_sessions.create(current_user.id, filename, int(request.form.get('size', 0)))
+    except ValueError:
+        return jsonify({'error': 'Invalid upload size'}), 400
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'id': record['id'], 'offset': 0, 'size': record['size'],
+                    'chunk_size': app.config['UPLOAD_CHUNK_SIZE']}), 201
+
+@app.route('/uploads/<upload_id>', methods=['GET', 'PATCH', 'DELETE'])
+@login_required
+def upload_chunk(upload_id):
+    """
+    GET: the offset to resume from. PATCH: append the request body, which
+    must start at the offset given in the Upload-Offset header. DELETE: abort.
+    """
+    try:
+        if request.method == 'DELETE':
+            upload_sessions.get(upload_id, current_user.id)
+            upload_sessions.delete(upload_id)
+            with upload_probes_lock:
+                upload_probes.pop(upload_id, None)
+            return jsonify({'success': True})
+        if request.method == 'PATCH':
+            try:
+                offset = int(request.headers.get('Upload-Offset', ''))
+            except ValueError:
+                return jsonify({'error': 'Upload-Offset header required'}), 400
+            record = upload_sessions.get(upload_id, current_user.id)
+            record = upload_sessions.append(upload_id, current_user.id, offset, request.stream,
+                                            on_chunk=probe_upload if file_type(record['filename']) == '.pdf'
+                                            else None)
+        else:
+            record = upload_sessions.get(upload_id, current_user.id)
+    except UploadError as e:
+        return upload_error_response(e)
+    return jsonify({'id': upload_id, 'offset': record['offset'], 'size': record['size'],
+                    'complete': record['offset'] == record['size']})
+
+@app.route('/uploads/<upload_id>/complete', methods=['POST'])
+@login_required
+def complete_upload(upload_id):
+    """Convert a fully received chunked upload; takes the same form fields as /upload"""
+    try:
+        options = parse_conversion_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    lazy = 'lazy' in request.form
+    if lazy and options['split_pages']:
+        return jsonify({'error': 'Lazy mode cannot split pages'}), 400
+    
+    # Wait for this process's page count probe, which reads the partial file
+    with upload_probes_lock:
+        probe = upload_probes.pop(upload_id, None)
+    pages_total = None
+    if probe is not None:
+        try:
+            pages_total = probe.result()
+        except Exception as e:
+            print(f"Error counting pages of upload {upload_id}: {str(e)}")
+    
+    filepath = os.path.join(app.config['UPLOAD_FOLDER'], upload_id + '.pdf')
+    try:
+        if file_type(upload_sessions.get(upload_id, current_user.id)['filename']) != '.pdf':
+            return jsonify({'error': 'ZIP archives are converted with /batch'}), 400
+        record = upload_sessions.finish(upload_id, current_user.id, filepath)
+    except UploadError as e:
+        return upload_error_response(e)
+    if pages_total is None:
+        pages_total = record.get('pages_total')
+    return start_conversion(upload_id, filepath, record['filename'], record['sha256'], options, lazy,
+                            pages_total=pages_total)
+
+def discard_batch_documents(documents):
+    """Delete the uploads and records of a batch that was not queued"""
+    for file_id, filepath, _, _ in documents:
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        shutil.rmtree(os.path.join(app.config['OUTPUT_FOLDER'], file_id), ignore_errors=True)
+        status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
+        if os.path.exists(status_file):
+            os.remove(status_file)
+        conversion_store.delete(file_id)
+        conversion_store.delete_usage(file_id)
+
+@app.route('/batch', methods=['POST'])
+@login_required
+def create_batch():
+    """
+    Convert many PDFs as one job: form field upload_id, repeated, naming
+    completed chunked uploads of PDFs or ZIP archives of PDFs, and the
+    options of /upload. Each PDF becomes a conversion of its own.
+    """
+    try:
+        options = parse_conversion_options(request.form)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if 'lazy' in request.form:
+        return jsonify({'error': 'Batches cannot use lazy mode'}), 400
+    upload_ids = request.form.getlist('upload_id')
+    if not upload_ids:
+        return jsonify({'error': 'No uploads in the batch'}), 400
+    try:
+        records = [upload_sessions.get(upload_id, current_user.id) for upload_id in upload_ids]
+    except UploadError as e:
+        return upload_error_response(e)
+    for record in records:
+        if record['offset'] != record['size']:
+            return jsonify({'error': f"Upload incomplete: {record['filename']}", 'id': record['id']}), 409
+    
+    # One conversion per PDF: (file ID, path, original filename, SHA-256)
+    documents = []
+    # Limits shared by all archives of the batch: a small archive can expand to fill the disk
+    max_pdfs = app.config['BATCH_MAX_PDFS']
+    max_bytes = app.config['BATCH_MAX_EXTRACTED_SIZE']
+    try:
+        for record in records:
+            if file_type(record['filename']) == '.pdf':
+                filepath = os.path.join(app.config['UPLOAD_FOLDER'], record['id'] + '.pdf')
+                documents.append((record['id'], filepath, record['filename'],
+                                  upload_sessions.finish(record['id'], current_user.id, filepath)['sha256']))
+                continue
+            zip_path = os.path.join(app.config['UPLOAD_FOLDER'], record['id'] + '.zip')
+            upload_sessions.finish(record['id'], current_user.id, zip_path)
+            try:
+                extracted = 0
+                for name, member in iter_zip_pdfs(zip_path, max_members=max_pdfs - len(documents),
+                                                  max_bytes=max_bytes):
+                    file_id = str(uuid.uuid4())
+                    filepath = os.path.join(app.config['UPLOAD_FOLDER'], file_id + '.pdf')
+                    # Added before it is written, so a failed copy is discarded too
+                    documents.append([file_id, filepath, secure_filename(os.path.basename(name)), None])
+                    documents[-1][3] = save_and_hash(member, filepath)
+                    extracted += os.path.getsize(filepath)
+                max_bytes -= extracted
+            finally:
+                os.remove(zip_path)
+    except ArchiveTooLarge as e:
+        discard_batch_documents(documents)
+        return jsonify({'error': str(e)}), 413
+    except (UploadError, zipfile.BadZipFile, OSError) as e:
+        discard_batch_documents(documents)
+        if isinstance(e, UploadError):
+            return upload_error_response(e)
+        return jsonify({'error': f'Could not read archive: {str(e)}'}), 400
+    if not documents:
+        return jsonify({'error': 'No PDF files in the batch'}), 400
+    
+    batch_id = BATCH_PREFIX + str(uuid.uuid4())
+    queued = []
+    for file_id, filepath, original_filename, pdf_sha256 in documents:
+        conversion_store.set_usage(file_id, 'upload', os.path.getsize(filepath), 1)
+        key = conversion_cache_key(pdf_sha256, options, filepath)
+        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+        os.makedirs(output_dir, exist_ok=True)
+        fields = dict(original_filename=original_filename, **options,
+                      user_id=current_user.id, username=current_user.username,
+                      pdf_sha256=pdf_sha256, batch_id=batch_id)
+        if complete_from_cache(file_id, key, output_dir, **fields):
+            continue
+        update_status(file_id, "pending", "PDF upload completed, waiting for processing",
+                      cache_key=key, queued_at=time.time(), **fields)
+        queued.append(file_id)
+    
+    # The whole batch is one job
+    position = None
+    if queued:
+        try:
+            position = job_queue.submit(batch_id, current_user.id, queued, options)
+        except QueueFull as e:
+            discard_batch_documents(documents)
+            return jsonify({'error': str(e)}), 503
+    
+    return jsonify({
+        'success': True,
+        'batch_id': batch_id,
+        'ids': [document[0] for document in documents],
+        'message': f'{len(documents)} PDFs uploaded, {len(queued)} queued for processing',
+        'status': 'pending' if queued else 'completed',
+        'queue_position': position
+    })
+
+@app.route('/batch/<batch_id>')
+@login_required
+def batch_status(batch_id):
+    """Status of each conversion of a batch, with the results recorded so far"""
+    conversions = conversion_store.batch_conversions(batch_id)
+    if not conversions:
+        return jsonify({'error': 'Batch not found'}), 404
+    if conversions[0]['user_id'] != current_user.id and not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    try:
+        with open(batch_manifest_path(batch_id)) as f:
+            results = json.load(f)['documents']
+    except (OSError, ValueError, KeyError):
+        results = {}
+    documents = []
+    for record in conversions:
+        result = results.get(record['id'], {})
+        documents.append({
+            'id': record['id'],
+            'filename': record['original_filename'],
+            'status': record['status'],
+            'message': record['message'],
+            'pages': record['page_count'],
+            'elapsed': result.get('elapsed'),
+            'timings': result.get('timings'),
+        })
+    counts = {}
+    for document in documents:
+        counts[document['status']] = counts.get(document['status'], 0) + 1
+    return jsonify({'batch_id': batch_id, 'counts': counts, 'documents': documents})
 
 @app.route('/status/<file_id>')
 @login_required
@@ -400,8 +1593,116 @@ def check_status(file_id):
     if 'user_id' in status and status['user_id'] != current_user.id and not current_user.is_admin:
         return jsonify({"error": "Access denied", "status": "error", "message": "您没有权限查看此文件"}), 403
     
+    # Prefer the live position from the shared queue
+    if status.get('status') == 'pending':
+        position = job_queue.position(file_id)
+        if position is not None:
+            status['queue_position'] = position
+    
     return jsonify(status)
 
+# Statuses after which a job never changes again
+FINAL_STATUSES = ('completed', 'error', 'cancelled')
+
+@app.route('/status/<file_id>/stream')
+@login_required
+def stream_status(file_id):
+    """
+    Server-Sent Events stream of a job's status.
+    
+    Access is checked once when the stream opens. After that the stream only
+    stats the status file and re-reads it when it changes, so waiting users
+    cost neither JSON parsing nor user lookups. The checks start every
+    STATUS_STREAM_POLL seconds and back off to STATUS_STREAM_POLL_MAX while
+    the file does not change. Each change is sent as a "status" event; idle
+    streams get a heartbeat comment, and the stream ends once the job
+    reaches a final status, or after STATUS_STREAM_TIMEOUT seconds with a
+    retry hint so the browser reconnects.
+    """
+    status = get_status(file_id)
+    
+    # Check if user has access to this file
+    if 'user_id' in status and status['user_id'] != current_user.id and not current_user.is_admin:
+        return jsonify({"error": "Access denied", "status": "error", "message": "您没有权限查看此文件"}), 403
+    
+    status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
+    min_poll = app.config['STATUS_STREAM_POLL']
+    max_poll = max(min_poll, app.config['STATUS_STREAM_POLL_MAX'])
+    heartbeat = app.config['STATUS_STREAM_HEARTBEAT']
+    timeout = app.config['STATUS_STREAM_TIMEOUT']
+    reconnect = app.config['STATUS_STREAM_RECONNECT']
+    
+    def generate():
+        # Ask the browser to wait before reconnecting after an error
+        yield f"retry: {reconnect * 1000}\n\n"
+        started = last_sent = time.time()
+        last_version = None
+        poll_interval = min_poll
+        
+        # time.sleep yields to other greenlets under gunicorn's gevent worker
+        while time.time() - started < timeout:
+            try:
+                stat = os.stat(status_file)
+                # update_status renames a new file into place, so the inode changes on every write
+                version = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+            except OSError:
+                version = None
+            
+            if version != last_version:
+                last_version = version
+                poll_interval = min_poll
+                data = get_status(file_id)
+                if data.get('status') == 'pending':
+                    position = job_queue.position(file_id)
+                    if position is not None:
+                        data['queue_position'] = position
+                yield f"event: status\ndata: {json.dumps(data)}\n\n"
+                last_sent = time.time()
+                if data.get('status') in FINAL_STATUSES:
+                    return
+            else:
+                # Nothing changed: check less often, up to max_poll
+                poll_interval = min(max_poll, poll_interval * 2)
+                if time.time() - last_sent >= heartbeat:
+                    yield ": heartbeat\n\n"
+                    last_sent = time.time()
+            
+            time.sleep(poll_interval)
+        
+        # Lifetime reached: spread the reconnections of streams opened together
+        yield f"retry: {int((reconnect + random.random() * reconnect) * 1000)}\n\n"
+    
+    return Response(generate(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        # Stop nginx from buffering the stream
+        'X-Accel-Buffering': 'no'
+    })
+
+@app.route('/cancel/<file_id>', methods=['POST'])
+@login_required
+def cancel_conversion(file_id):
+    """Cancel a queued or running conversion"""
+    status = get_status(file_id)
+    
+    # Check if user has access to this file
+    if 'user_id' in status and status['user_id'] != current_user.id and not current_user.is_admin:
+        return jsonify({'success': False, 'error': 'Access denied'}), 403
+    
+    if status['status'] not in ('pending', 'processing'):
+        return jsonify({'success': False, 'error': 'Conversion is not queued or running'}), 400
+    
+    fields = {k: v for k, v in status.items()
+              if k not in ['id', 'status', 'message', 'timestamp', 'queue_position', 'cancel_requested']}
+    outcome = job_queue.cancel(file_id)
+    if outcome == 'queued' or (outcome is None and status['status'] == 'pending'):
+        # Not started yet: a worker in another process will skip it when claiming
+        update_status(file_id, "cancelled", "PDF processing was cancelled", **fields)
+    else:
+        # Running here or in another worker process: it stops at the next page window
+        update_status(file_id, status['status'], "Cancelling...", cancel_requested=True, **fields)
+    
+    return jsonify({'success': True, 'id': file_id, 'status': 'cancelled'})
+
 @app.route('/view/<file_id>')
 @login_required
 def view_results(file_id):
@@ -418,15 +1719,20 @@ def view_results(file_id):
     if status['status'] == 'pending' or status['status'] == 'processing':
         return render_template('processing.html', file_id=file_id, status=status)
     
-    if status['status'] == 'error':
+    if status['status'] in ('error', 'cancelled'):
         error_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         return render_template('error.html', file_id=file_id, status=status, error_time=error_time)
     
     if not os.path.exists(output_dir):
         return "Results not found", 404
     
-    # Get list of images
-    images = sorted([f for f in os.listdir(output_dir) if f.endswith(('.png', '.jpg'))])
+    conversion_store.touch(file_id, time.time())
+    
+    # Get list of images; lazy conversions list page numbers, rendered when the browser loads them
+    if status.get('lazy'):
+        images = [str(n) for n in lazy_pages(status)]
+    else:
+        images = sorted([f for f in os.listdir(output_dir) if f.endswith(IMAGE_EXTENSIONS)])
     
     if not images:
         return "No images found", 404
@@ -434,19 +1740,147 @@ def view_results(file_id):
     # Get original filename for display
     original_filename = status.get('original_filename', '未知文件名')
         
-    return render_template('view.html', file_id=file_id, images=images, original_filename=original_filename)
+    # Conversions from before previews existed have none and show the full images
+    preview_widths = status.get('preview_widths') or []
+        
+    return render_template('view.html', file_id=file_id, images=images, original_filename=original_filename,
+                           preview_widths=preview_widths)
+
+# Owner and ETags of completed conversions, by file ID; their files never change
+completed_outputs = OrderedDict()
+completed_outputs_lock = threading.Lock()
+
+def completed_output_info(file_id):
+    """
+    (user_id, etags) of a completed conversion with a manifest, cached in
+    memory so its downloads skip the status file. None for any other.
+    """
+    with completed_outputs_lock:
+        info = completed_outputs.get(file_id)
+        if info is not None:
+            completed_outputs.move_to_end(file_id)
+            return info
+    
+    status = get_status(file_id)
+    if status.get('status') != 'completed' or status.get('lazy'):
+        return None
+    etags = load_manifest(os.path.join(app.config['OUTPUT_FOLDER'], file_id))
+    if etags is None:
+        return None
+    info = (status.get('user_id'), etags)
+    with completed_outputs_lock:
+        completed_outputs[file_id] = info
+        while len(completed_outputs) > app.config['OUTPUT_INFO_CACHE_SIZE']:
+            completed_outputs.popitem(last=False)
+    return info
+
+def send_output_file(directory, filename, etag=None, immutable=False, max_age=0, **kwargs):
+    """
+    send_from_directory for conversion outputs.
+    
+    A request whose If-None-Match matches `etag` is answered with 304
+    without touching the file. With SENDFILE_HEADER set, the front proxy
+    is told to send the file instead.
+    
+    Args:
+        etag: Strong ETag of the file's content (None for one derived from its mtime and size)
+        immutable: The file never changes: cache it for IMMUTABLE_MAX_AGE
+        max_age: Seconds browsers may cache a file that is not immutable
+        **kwargs: Passed on to send_from_directory (mimetype, as_attachment, download_name)
+    """
+    if immutable:
+        max_age = app.config['IMMUTABLE_MAX_AGE']
+    if etag is not None and etag in request.if_none_match:
+        response = Response(status=304)
+        response.set_etag(etag)
+    elif app.config['SENDFILE_HEADER'] == 'X-Accel-Redirect':
+        path = safe_join(directory, filename)
+        if path is None or not os.path.isfile(path):
+            abort(404)
+        response = Response(mimetype=kwargs.get('mimetype') or mimetypes.guess_type(filename)[0]
+                            or 'application/octet-stream')
+        relative = os.path.relpath(path, app.config['OUTPUT_FOLDER']).replace(os.sep, '/')
+        response.headers['X-Accel-Redirect'] = app.config['SENDFILE_PREFIX'].rstrip('/') + '/' + quote(relative)
+        if kwargs.get('as_attachment'):
+            response.headers.set('Content-Disposition', 'attachment',
+                                 filename=kwargs.get('download_name') or filename)
+        if etag is not None:
+            response.set_etag(etag)
+    else:
+        response = send_from_directory(directory, filename, etag=etag if etag is not None else True,
+                                       conditional=True, max_age=max_age, **kwargs)
+    
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = max_age
+    response.cache_control.immutable = immutable or None
+    return response
 
 @app.route('/download/<file_id>/<filename>')
 @login_required
 def download_file(file_id, filename):
+    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
+    
+    info = completed_output_info(file_id)
+    if info is not None:
+        user_id, etags = info
+        if user_id is not None and user_id != current_user.id and not current_user.is_admin:
+            flash('您没有权限下载此文件', 'danger')
+            return redirect(url_for('index'))
+        return send_output_file(output_dir, filename, etag=etags.get(filename), immutable=True)
+    
     # Check if user has access to this file
     status = get_status(file_id)
     if 'user_id' in status and status['user_id'] != current_user.id and not current_user.is_admin:
         flash('您没有权限下载此文件', 'danger')
         return redirect(url_for('index'))
     
-    output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
-    return send_from_directory(output_dir, filename)
+    # Lazy conversions: /download/<file_id>/<page> renders the page on first request
+    if status.get('lazy') and filename.isdigit():
+        page_num = int(filename)
+        if page_num not in lazy_pages(status):
+            return "Page not found", 404
+        try:
+            filename = ensure_lazy_page(file_id, status, page_num)
+        except LazyPageBusy as e:
+            response = jsonify({'error': str(e)})
+            response.status_code = 503
+            response.headers['Retry-After'] = '5'
+            return response
+        prefetch_lazy_pages(file_id, status, page_num)
+    
+    return send_output_file(output_dir, filename, immutable=status.get('status') == 'completed')
+
+@app.route('/preview/<file_id>/<filename>')
+@login_required
+def preview_file(file_id, filename):
+    preview_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id, pdf_to_image.PREVIEW_DIR)
+    
+    info = completed_output_info(file_id)
+    if info is not None:
+        user_id, etags = info
+        if user_id is not None and user_id != current_user.id and not current_user.is_admin:
+            return jsonify({'error': 'Access denied'}), 403
+        return send_output_file(preview_dir, filename, etag=etags.get(f"{pdf_to_image.PREVIEW_DIR}/{filename}"),
+                                immutable=True)
+    
+    # Check if user has access to this file
+    status = get_status(file_id)
+    if 'user_id' in status and status['user_id'] != current_user.id and not current_user.is_admin:
+        return jsonify({'error': 'Access denied'}), 403
+    
+    # Previews never change once written, so browsers may keep them
+    return send_output_file(preview_dir, filename, max_age=86400)
+
+@app.template_global()
+def preview_url(file_id, image, width):
+    """URL of the `width` pixel preview of a page image"""
+    return url_for('preview_file', file_id=file_id, filename=pdf_to_image.preview_name(image, width))
+
+@app.template_global()
+def preview_srcset(file_id, image, widths):
+    """srcset attribute value listing the previews of a page image"""
+    return ", ".join(f"{preview_url(file_id, image, width)} {width}w" for width in widths)
 
 @app.route('/download-all/<file_id>')
 @login_required
@@ -465,147 +1899,110 @@ def download_all(file_id):
     if not os.path.exists(output_dir):
         return "Results not found", 404
     
-    # Create a zip file with all images
+    conversion_store.touch(file_id, time.time())
     zip_filename = f"{file_id}_images.zip"
-    zip_path = os.path.join(app.config['OUTPUT_FOLDER'], zip_filename)
     
-    shutil.make_archive(
-        os.path.join(app.config['OUTPUT_FOLDER'], file_id + "_images"), 
-        'zip', 
-        output_dir
-    )
+    # With CACHE_ZIP_ARCHIVES, the archive is built on the first download and
+    # served as a file from then on; send_from_directory handles ETag, If-None-Match and Range
+    zip_path = zip_archive_path(file_id)
+    if app.config['CACHE_ZIP_ARCHIVES'] and not status.get('lazy') and not os.path.exists(zip_path):
+        with zip_build_lock:
+            if not os.path.exists(zip_path):
+                try:
+                    zip_stream.build_zip(output_dir, zip_path)
+                    record_output_usage(file_id)
+                except OSError as e:
+                    print(f"Error building archive for {file_id}: {str(e)}")
+    if os.path.exists(zip_path):
+        return send_output_file(app.config['OUTPUT_FOLDER'], os.path.basename(zip_path),
+                                mimetype='application/zip', as_attachment=True, download_name=zip_filename)
     
-    return send_from_directory(app.config['OUTPUT_FOLDER'], zip_filename)
+    # No cached archive: stream one, storing the already-compressed images without deflate
+    if status.get('lazy'):
+        files = lazy_archive_files(file_id, status)
+    else:
+        files = zip_stream.archive_files(output_dir)
+    response = Response(zip_stream.iter_zip(output_dir, files), mimetype='application/zip')
+    response.headers['Content-Disposition'] = f'attachment; filename="{zip_filename}"'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 @app.route('/cleanup', methods=['POST'])
 @login_required
 def cleanup():
-    """Clean up uploads, output, and status folders"""
-    # Only admins can clean everything
-    is_admin = current_user.is_admin
-    user_id = current_user.id
-    
+    """
+    Queue the deletion of the user's finished conversions (everyone's for
+    admins). The retention service deletes them in the background.
+    """
     try:
-        # Get list of items to keep (e.g., currently processing files)
-        active_tasks = list(processing_tasks.keys())
-        
-        # Clean up output folder
-        output_count = 0
-        for item in os.listdir(app.config['OUTPUT_FOLDER']):
-            item_path = os.path.join(app.config['OUTPUT_FOLDER'], item)
-            
-            # Skip if it's an active task
-            skip = False
-            for task_id in active_tasks:
-                if task_id in item:
-                    skip = True
-                    break
-            
-            if skip:
-                continue
-            
-            # For non-admins, only clean their own files
-            if not is_admin:
-                # Check if this is a conversion directory with a status file
-                if os.path.isdir(item_path):
-                    status_file = os.path.join(app.config['STATUS_FOLDER'], f"{item}.json")
-                    if os.path.exists(status_file):
-                        with open(status_file, 'r') as f:
-                            status = json.load(f)
-                            if status.get('user_id') != user_id:
-                                continue
-            
-            # Remove the item
-            if os.path.isdir(item_path):
-                shutil.rmtree(item_path)
-            else:
-                os.remove(item_path)
-            output_count += 1
-        
-        # Clean up uploads folder
-        upload_count = 0
-        for item in os.listdir(app.config['UPLOAD_FOLDER']):
-            item_path = os.path.join(app.config['UPLOAD_FOLDER'], item)
-            
-            # Skip if it's an active task
-            skip = False
-            for task_id in active_tasks:
-                if task_id in item:
-                    skip = True
-                    break
-            
-            if skip:
-                continue
-            
-            # For non-admins, only clean their own files
-            if not is_admin:
-                item_id = item.split('.')[0]  # Get ID without extension
-                status_file = os.path.join(app.config['STATUS_FOLDER'], f"{item_id}.json")
-                if os.path.exists(status_file):
-                    with open(status_file, 'r') as f:
-                        status = json.load(f)
-                        if status.get('user_id') != user_id:
-                            continue
-            
-            # Remove the item
-            os.remove(item_path)
-            upload_count += 1
-        
-        # Clean up status folder
-        status_count = 0
-        for item in os.listdir(app.config['STATUS_FOLDER']):
-            if not item.endswith('.json'):
-                continue
-                
-            item_path = os.path.join(app.config['STATUS_FOLDER'], item)
-            
-            # Skip if it's an active task
-            skip = False
-            for task_id in active_tasks:
-                if task_id in item:
-                    skip = True
-                    break
-            
-            if skip:
-                continue
-            
-            # For non-admins, only clean their own files
-            if not is_admin:
-                with open(item_path, 'r') as f:
-                    status = json.load(f)
-                    if status.get('user_id') != user_id:
-                        continue
-            
-            # Remove the item
-            os.remove(item_path)
-            status_count += 1
-        
-        message = f"清理完成: 已删除 {output_count} 个输出文件夹, {upload_count} 个上传文件, 和 {status_count} 个状态文件"
+        retention_service.request_purge(None if current_user.is_admin else current_user.id)
+        message = "清理已开始: 已完成的转换文件将在后台删除"
         return jsonify({'success': True, 'message': message})
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
 
+@app.route('/admin/retention', methods=['GET', 'POST'])
+@login_required
+def retention_stats():
+    """Retention policies and counters; POST starts a run now"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin access required'}), 403
+    
+    if request.method == 'POST':
+        retention_service.wake()
+    
+    return jsonify(retention_service.stats())
+
+@app.route('/admin/profiles')
+@login_required
+def profiled_conversions():
+    """Profiled conversions, and the profile of one of them with ?id="""
+    if not current_user.is_admin:
+        flash('您没有管理员权限', 'danger')
+        return redirect(url_for('index'))
+    
+    conversions = [dict(record, date=datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d %H:%M:%S'))
+                   for record in conversion_store.profiled_conversions()]
+    file_id = request.args.get('id')
+    summary = None
+    if file_id:
+        file_id = secure_filename(file_id)
+        summary = load_summary(os.path.join(app.config['OUTPUT_FOLDER'], file_id, PROFILE_DIR))
+        if summary is None:
+            flash('没有找到该转换的性能分析结果', 'warning')
+    return render_template('profiles.html', conversions=conversions, file_id=file_id, summary=summary)
+
+@app.route('/admin/profiles/<file_id>/<filename>')
+@login_required
+def download_profile(file_id, filename):
+    """Profile artifacts (profile.pstats, profile.txt, *.snapshot, summary.json)"""
+    if not current_user.is_admin:
+        return jsonify({'error': 'Admin access required'}), 403
+    profile_dir = os.path.join(app.config['OUTPUT_FOLDER'], secure_filename(file_id), PROFILE_DIR)
+    return send_from_directory(profile_dir, filename, as_attachment=True)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Metrics of all gunicorn workers in the Prometheus text format"""
+    token = app.config['METRICS_TOKEN']
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f"Bearer {token}"):
+        return Response('Unauthorized\n', status=401, mimetype='text/plain')
+    # The queue is shared: its length is read once rather than summed over the workers
+    return Response(metrics.render({'pdf2img_queued_jobs': job_queue.stats()['pending']}),
+                    mimetype='text/plain; version=0.0.4')
+
 @app.route('/disk-usage')
 @login_required
 def disk_usage():
-    """Get disk usage information for the app folders"""
+    """
+    Get disk usage information for the app folders.
+    
+    Totals come from the usage counters, which are updated as files are
+    written and removed, conversion cache entries included (see
+    ConversionCache.add), and rescanned every USAGE_RECONCILE_INTERVAL
+    seconds to correct drift.
+    """
     try:
-        def get_size(path):
-            total_size = 0
-            item_count = 0
-            for dirpath, dirnames, filenames in os.walk(path):
-                for f in filenames:
-                    fp = os.path.join(dirpath, f)
-                    if os.path.exists(fp):
-                        total_size += os.path.getsize(fp)
-                        item_count += 1
-            return total_size, item_count
-        
-        # Get sizes
-        upload_size, upload_count = get_size(app.config['UPLOAD_FOLDER'])
-        output_size, output_count = get_size(app.config['OUTPUT_FOLDER'])
-        status_size, status_count = get_size(app.config['STATUS_FOLDER'])
-        
         # Format sizes
         def format_size(size_bytes):
             if size_bytes < 1024:
@@ -617,29 +2014,22 @@ def disk_usage():
             else:
                 return f"{size_bytes/(1024*1024*1024):.2f} GB"
         
+        def summarize(totals):
+            summary = {}
+            for key, category in (('uploads', 'upload'), ('output', 'output'), ('status', 'status')):
+                size, count = totals[category]
+                summary[key] = {'size': format_size(size), 'count': count, 'raw_size': size}
+            size = sum(item['raw_size'] for item in summary.values())
+            count = sum(item['count'] for item in summary.values())
+            summary['total'] = {'size': format_size(size), 'count': count, 'raw_size': size}
+            return summary
+        
         # Return usage info
         return jsonify({
             'success': True,
-            'uploads': {
-                'size': format_size(upload_size),
-                'count': upload_count,
-                'raw_size': upload_size
-            },
-            'output': {
-                'size': format_size(output_size),
-                'count': output_count,
-                'raw_size': output_size
-            },
-            'status': {
-                'size': format_size(status_size),
-                'count': status_count,
-                'raw_size': status_size
-            },
-            'total': {
-                'size': format_size(upload_size + output_size + status_size),
-                'count': upload_count + output_count + status_count,
-                'raw_size': upload_size + output_size + status_size
-            }
+            **summarize(usage_tracker.totals()),
+            'user': summarize(usage_tracker.totals(current_user.id)),
+            'reconciled_at': usage_tracker.last_reconciled()
         })
     except Exception as e:
         return jsonify({'success': False, 'error': str(e)})
@@ -647,90 +2037,43 @@ def disk_usage():
 @app.route('/history')
 @login_required
 def conversion_history():
-    """Show history of all PDF conversions"""
+    """Show history of completed PDF conversions, one page at a time"""
     try:
-        conversions = []
+        page = max(1, request.args.get('page', 1, type=int))
+        per_page = app.config['HISTORY_PAGE_SIZE']
         
-        # Get list of status files
-        for status_file in os.listdir(app.config['STATUS_FOLDER']):
-            if not status_file.endswith('.json'):
-                continue
-                
-            file_path = os.path.join(app.config['STATUS_FOLDER'], status_file)
-            try:
-                with open(file_path, 'r') as f:
-                    status_data = json.load(f)
-                
-                # Debug output
-                print(f"Status data for {status_file}: {status_data}")
-                
-                file_id = status_data.get('id', status_file.replace('.json', ''))
-                
-                # For non-admins, only show their own files
-                if not current_user.is_admin:
-                    if status_data.get('user_id') != current_user.id:
-                        continue
-                
-                # Check if output directory exists and count images
-                output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
-                image_count = 0
-                thumbnail = None
-                
-                if os.path.exists(output_dir):
-                    images = [f for f in os.listdir(output_dir) if f.endswith(('.png', '.jpg'))]
-                    image_count = len(images)
-                    if images:
-                        # Get first image as thumbnail
-                        thumbnail = images[0]
-                
-                # Get PDF filename if it exists
-                pdf_filename = None
-                pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf")
-                if os.path.exists(pdf_path):
-                    pdf_filename = f"{file_id}.pdf"
-                
-                # Format timestamp
-                timestamp = status_data.get('timestamp', 0)
-                converted_date = datetime.fromtimestamp(timestamp).strftime('%Y-%m-%d %H:%M:%S')
-                
-                # Get original filename
-                original_filename = status_data.get('original_filename', '未知文件名')
-                print(f"Original filename: {original_filename}")
-                
-                # Get processing parameters
-                dpi = status_data.get('dpi', 300)
-                split_pages = status_data.get('split_pages', False)
-                rotation = status_data.get('rotation', '自动')
-                crop_margin = status_data.get('crop_margin', 0)
-                
-                # Get user info
-                username = status_data.get('username', '未知用户')
-                
-                # Only include completed conversions that have images
-                if status_data.get('status') == 'completed' and image_count > 0:
-                    conversions.append({
-                        'id': file_id,
-                        'date': converted_date,
-                        'timestamp': timestamp,
-                        'status': status_data.get('status', 'unknown'),
-                        'message': status_data.get('message', ''),
-                        'image_count': image_count,
-                        'thumbnail': thumbnail,
-                        'pdf_filename': pdf_filename,
-                        'original_filename': original_filename,
-                        'dpi': dpi,
-                        'split_pages': split_pages,
-                        'rotation': rotation,
-                        'crop_margin': crop_margin,
-                        'username': username
-                    })
-            except Exception as e:
-                print(f"Error reading status file {status_file}: {str(e)}")
+        # For non-admins, only show their own files
+        user_id = None if current_user.is_admin else current_user.id
         
-        # Sort by timestamp, newest first
-        conversions.sort(key=lambda x: x.get('timestamp', 0), reverse=True)
+        # Only include completed conversions that have images
+        total = conversion_store.count_conversions(user_id=user_id, status='completed', with_pages=True)
+        records = conversion_store.list_conversions(user_id=user_id, status='completed', with_pages=True,
+                                                    limit=per_page, offset=(page - 1) * per_page)
+        
+        conversions = []
+        for record in records:
+            params = record['params']
+            conversions.append({
+                'id': record['id'],
+                'date': datetime.fromtimestamp(record['timestamp']).strftime('%Y-%m-%d %H:%M:%S'),
+                'timestamp': record['timestamp'],
+                'status': record['status'],
+                'message': record['message'] or '',
+                'image_count': record['page_count'],
+                'thumbnail': record['thumbnail'],
+                'preview_widths': sorted(params.get('preview_widths') or []),
+                'original_filename': record['original_filename'] or '未知文件名',
+                'dpi': params.get('dpi', 300),
+                'split_pages': params.get('split_pages', False),
+                'rotation': params.get('rotation', '自动'),
+                'crop_margin': params.get('crop_margin', 0),
+                'output_format': params.get('output_format', pdf_to_image.DEFAULT_OUTPUT_FORMAT),
+                'username': record['username'] or '未知用户'
+            })
         
-        return render_template('history.html', conversions=conversions)
+        total_pages = max(1, -(-total // per_page))
+        return render_template('history.html', conversions=conversions, page=page,
+                               total_pages=total_pages, total=total)
     except Exception as e:
         return f"Error retrieving conversion history: {str(e)}", 500
 
@@ -743,28 +2086,8 @@ def delete_conversion(file_id):
         flash('您没有权限删除此文件', 'danger')
         return redirect(url_for('index'))
     
-    status = get_status(file_id)
-    
     try:
-        # Delete output directory
-        output_dir = os.path.join(app.config['OUTPUT_FOLDER'], file_id)
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        
-        # Delete uploaded PDF file
-        pdf_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}.pdf")
-        if os.path.exists(pdf_path):
-            os.remove(pdf_path)
-        
-        # Delete status file
-        status_file = os.path.join(app.config['STATUS_FOLDER'], f"{file_id}.json")
-        if os.path.exists(status_file):
-            os.remove(status_file)
-        
-        # Delete any zip files associated with this conversion
-        zip_path = os.path.join(app.config['OUTPUT_FOLDER'], f"{file_id}_images.zip")
-        if os.path.exists(zip_path):
-            os.remove(zip_path)
+        purge_conversion(file_id)
         
         flash('转换记录已成功删除', 'success')
         return redirect(url_for('conversion_history'))
@@ -773,4 +2096,8 @@ def delete_conversion(file_id):
         return redirect(url_for('conversion_history'))
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8090, debug=False) 
\ No newline at end of file
+    if sys.argv[1:] == ['init']:
+        # One-time storage setup, run before the server starts
+        initialize_storage()
+    else:
+        app.run(host='0.0.0.0', port=8090, debug=False) 
\ No newline at end of file
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Inputs and manifest of batch conversions.
+
+A batch converts many PDFs in one run of process_batch (see
+pdf_to_image.py), which spreads the pages of all of them over a single
+worker pool. The inputs can be PDF files, directories (searched
+recursively), glob patterns and ZIP archives of PDFs.
+
+The manifest is a JSON file with the result of each document: its
+status, pages, images, bytes written, time taken per stage, and error if
+any. It is rewritten as each document finishes, so an interrupted batch
+run again with the same options skips the documents that were completed
+and whose source file has not changed since.
+"""
+import os
+import glob
+import json
+import time
+import shutil
+import zipfile
+
+MANIFEST_NAME = 'batch-manifest.json'
+
+# Directory inside the batch output where the PDFs of ZIP archives are extracted
+EXTRACT_DIR = '.batch-inputs'
+
+
+def _is_pdf(name):
+    return name.lower().endswith('.pdf')
+
+
+def _stem(path):
+    return os.path.splitext(path)[0].replace(os.sep, '/')
+
+
+class ArchiveTooLarge(ValueError):
+    """Raised when a ZIP archive has more PDFs, or more bytes of them, than allowed"""
+
+
+class _LimitedReader:
+    """
+    File object that raises ArchiveTooLarge once the bytes read through it
+    and the other readers sharing `budget` (a one-item list of bytes left)
+    go past it.
+    """
+
+    def __init__(self, f, budget):
+        self._f = f
+        self._budget = budget
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._budget[0] -= len(data)
+        if self._budget[0] < 0:
+            raise ArchiveTooLarge("The PDFs in the archive are larger than allowed")
+        return data
+
+
+def iter_zip_pdfs(zip_path, max_members=None, max_bytes=None):
+    """
+    The PDFs in a ZIP archive.
+
+    Args:
+        max_members: Optional largest number of PDFs accepted
+        max_bytes: Optional largest total size of the PDFs once extracted,
+            checked against the sizes the archive declares before anything
+            is extracted, then against the bytes actually read
+
+    Raises:
+        ArchiveTooLarge: The archive goes past max_members or max_bytes
+
+    Yields:
+        (name, file object) for each PDF member, name being its path in
+        the archive; members with absolute or parent-relative paths are skipped
+    """
+    with zipfile.ZipFile(zip_path) as zf:
+        members = []
+        for info in zf.infolist():
+            name = info.filename
+            if info.is_dir() or not _is_pdf(name):
+                continue
+            parts = name.replace('\\', '/').split('/')
+            if name.startswith(('/', '\\')) or '..' in parts or os.path.basename(name).startswith('.'):
+                continue
+            members.append(('/'.join(parts), info))
+        if max_members is not None and len(members) > max_members:
+            raise ArchiveTooLarge(f"The archive has {len(members)} PDFs; the limit is {max_members}")
+        if max_bytes is not None and sum(info.file_size for _, info in members) > max_bytes:
+            raise ArchiveTooLarge(f"The PDFs in the archive are larger than {max_bytes} bytes")
+        budget = [max_bytes]
+        for name, info in members:
+            with zf.open(info) as f:
+                yield name, f if max_bytes is None else _LimitedReader(f, budget)
+
+
+def _extract_zip(zip_path, extract_dir):
+    """Extract the PDFs of an archive, skipping those already extracted. Returns (name, path) pairs."""
+    extracted = []
+    for name, f in iter_zip_pdfs(zip_path):
+        path = os.path.join(extract_dir, *name.split('/'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, 'wb') as out:
+                shutil.copyfileobj(f, out)
+            os.replace(tmp_path, path)
+        extracted.append((name, path))
+    return extracted
+
+
+def collect_inputs(paths, extract_dir):
+    """
+    Expand batch inputs into the PDFs to convert.
+
+    Args:
+        paths: PDF files, directories, glob patterns and ZIP archives
+        extract_dir: Directory where the PDFs of ZIP archives are extracted
+
+    Returns:
+        List of (key, pdf_path), key being a unique name for the document
+        ("report" for report.pdf, "scans/2021/a" for a PDF found in a
+        directory or archive), used for its output directory
+
+    Raises:
+        FileNotFoundError: if a path does not exist or a pattern matches nothing
+    """
+    found = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, dirs, files in os.walk(path):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(files):
+                    if _is_pdf(name) and not name.startswith('.'):
+                        pdf_path = os.path.join(root, name)
+                        found.append((_stem(os.path.relpath(pdf_path, path)), pdf_path))
+        elif os.path.isfile(path) and path.lower().endswith('.zip'):
+            archive = os.path.splitext(os.path.basename(path))[0]
+            for name, pdf_path in _extract_zip(path, os.path.join(extract_dir, archive)):
+                found.append((f"{archive}/{os.path.splitext(name)[0]}", pdf_path))
+        elif os.path.isfile(path):
+            found.append((_stem(os.path.basename(path)), path))
+        elif glob.has_magic(path):
+            matches = sorted(p for p in glob.glob(path, recursive=True) if _is_pdf(p) and os.path.isfile(p))
+            if not matches:
+                raise FileNotFoundError(f"No PDF matches {path}")
+            found.extend((_stem(os.path.basename(p)), p) for p in matches)
+        else:
+            raise FileNotFoundError(f"No such file or directory: {path}")
+
+    # The same name found twice (e.g. a/x.pdf and b/x.pdf matched by a glob)
+    inputs, seen = [], set()
+    for key, pdf_path in found:
+        unique, n = key, 2
+        while unique in seen:
+            unique = f"{key}-{n}"
+            n += 1
+        seen.add(unique)
+        inputs.append((unique, pdf_path))
+    return inputs
+
+
+class BatchManifest:
+    """
+    Per-document results of a batch, saved to `path` as they come in.
+
+    An existing manifest is loaded so its completed documents can be
+    skipped; it is started afresh if it was written with other options.
+
+    Args:
+        path: JSON file of the manifest
+        options: The conversion options of the batch
+        resume: Skip the documents completed by an earlier run; otherwise
+            they are converted again, and their entries replaced
+    """
+
+    def __init__(self, path, options, resume=True):
+        self.path = path
+        self.resume = resume
+        self.options = json.loads(json.dumps(options))
+        self.data = {'created': time.time(), 'options': self.options, 'documents': {}}
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        if data.get('options') == self.options:
+            self.data = data
+        else:
+            print(f"Options differ from those of {path}: converting every document again")
+
+    @staticmethod
+    def _source_state(pdf_path):
+        stat = os.stat(pdf_path)
+        return {'source': pdf_path, 'size': stat.st_size, 'mtime': stat.st_mtime}
+
+    def is_done(self, key, pdf_path):
+        """Whether a document was completed by an earlier run and its source is unchanged"""
+        entry = self.data['documents'].get(key)
+        if not self.resume or not entry or entry.get('status') != 'completed':
+            return False
+        try:
+            state = self._source_state(pdf_path)
+        except OSError:
+            return False
+        return all(entry.get(k) == v for k, v in state.items())
+
+    def get(self, key):
+        return self.data['documents'].get(key)
+
+    def record(self, key, pdf_path, result):
+        """Store a document's result and save the manifest"""
+        entry = dict(result, finished=time.time())
+        try:
+            entry.update(self._source_state(pdf_path))
+        except OSError:
+            entry['source'] = pdf_path
+        self.data['documents'][key] = entry
+        self.save()
+
+    def save(self):
+        self.data['updated'] = time.time()
+        documents = self.data['documents'].values()
+        self.data['totals'] = {
+            'documents': len(self.data['documents']),
+            'completed': sum(1 for entry in documents if entry.get('status') == 'completed'),
+            'failed': sum(1 for entry in documents if entry.get('status') == 'error'),
+            'pages': sum(entry.get('pages', 0) for entry in documents),
+            'bytes_written': sum(entry.get('bytes_written', 0) for entry in documents),
+        }
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.data, f, indent=2)
+        os.replace(tmp_path, self.path)
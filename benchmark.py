@@ -0,0 +1,650 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the image pipeline in pdf_to_image.py.
+
+Pages are generated synthetically, so the benchmarks run offline and
+without poppler, except for `render`, which renders real documents with
+each available backend. Usage:
+
+    python benchmark.py deskew [--pages 20] [--dpi 300]
+    python benchmark.py rotate [--dpi 300] [--repeat 5]
+    python benchmark.py alloc [--pages 6] [--dpi 300] [--split]
+    python benchmark.py render [TYPE=]FILE.pdf ... [--pages 5] [--dpi 300] [--gray]
+    python benchmark.py suite [--dpi 150,300] [--cases default,split] [--repeat 3] [--output results.json]
+    python benchmark.py compare BASELINE.json CANDIDATE.json [--max-slowdown 0.1]
+
+`suite` writes a synthetic corpus of scanned and vector PDFs, converts
+each document with process_pdf in a fresh process per case, and saves
+per-stage timings, pages per second, peak RSS and output bytes as JSON.
+`compare` diffs two such files and exits non-zero on regressions.
+"""
+import io
+import os
+import sys
+import json
+import time
+import zlib
+import shutil
+import hashlib
+import argparse
+import platform
+import resource
+import tempfile
+import contextlib
+import subprocess
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import cv2
+from PIL import Image
+import pdf_to_image
+import renderers
+
+# Page sizes in inches
+A4_SIZE = (8.27, 11.69)
+LETTER_SIZE = (8.5, 11.0)
+# Two A4 pages side by side, as scanned from an open book
+A3_LANDSCAPE_SIZE = (16.54, 11.69)
+
+
+def make_page(dpi=300, angle=0.0, seed=0, color=True, size=A4_SIZE):
+    """
+    Render a synthetic text page of `size` inches at `dpi`, skewed by `angle` degrees.
+
+    Returns:
+        RGB (or grayscale) numpy array, as process_pdf gets from pdf2image
+    """
+    rng = np.random.default_rng(seed)
+    w, h = int(size[0] * dpi), int(size[1] * dpi)
+    page = np.full((h, w), 255, dtype=np.uint8)
+
+    margin = int(dpi * 0.8)
+    line_height = max(8, int(dpi * 0.18))
+    font_scale = dpi / 150.0
+    thickness = max(1, dpi // 100)
+    for y in range(margin, h - margin, line_height):
+        # Ragged right edge like real paragraphs
+        words = rng.integers(6, 12)
+        text = " ".join("lorem"[:rng.integers(2, 6)] + "ipsum"[:rng.integers(1, 5)] for _ in range(words))
+        cv2.putText(page, text, (margin, y), cv2.FONT_HERSHEY_SIMPLEX, font_scale, 0, thickness)
+
+    if angle:
+        M = cv2.getRotationMatrix2D((w // 2, h // 2), angle, 1.0)
+        page = cv2.warpAffine(page, M, (w, h), flags=cv2.INTER_LINEAR, borderValue=255)
+
+    return cv2.cvtColor(page, cv2.COLOR_GRAY2RGB) if color else page
+
+
+def legacy_skew_angle(image):
+    """Skew estimate of the original deskew_image: minAreaRect over every foreground pixel."""
+    if len(image.shape) == 3:
+        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    else:
+        gray = image.copy()
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    coords = np.column_stack(np.where(thresh > 0))
+    if len(coords) == 0:
+        return 0.0
+    angle = cv2.minAreaRect(coords)[-1]
+    if angle < -45:
+        angle = -(90 + angle)
+    else:
+        angle = -angle
+    return angle
+
+
+def _time_ms(func, *args, repeat=1):
+    """Best-of-`repeat` wall time of func(*args) in milliseconds, and its result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_deskew(args):
+    """Compare the legacy and the fast skew estimators on skewed synthetic pages."""
+    rng = np.random.default_rng(args.seed)
+    # Include straight pages to exercise the skip-warp path
+    angles = [0.0 if i % 4 == 0 else float(rng.uniform(-args.max_angle, args.max_angle))
+              for i in range(args.pages)]
+
+    methods = {
+        'legacy': legacy_skew_angle,
+        'fast': pdf_to_image.estimate_skew_angle,
+    }
+    results = {name: {'errors': [], 'ms': []} for name in methods}
+    deskew_ms = []
+    skipped = 0
+
+    print(f"Deskew benchmark: {args.pages} pages at {args.dpi} DPI")
+    for i, angle in enumerate(angles):
+        page = make_page(args.dpi, angle, seed=i)
+        for name, method in methods.items():
+            ms, estimate = _time_ms(method, page)
+            # The correction that straightens a page skewed by `angle` is -angle
+            results[name]['errors'].append(abs(estimate + angle))
+            results[name]['ms'].append(ms)
+        ms, deskewed = _time_ms(pdf_to_image.deskew_image, page)
+        deskew_ms.append(ms)
+        if deskewed is page:
+            skipped += 1
+
+    print(f"{'method':<8} {'mean err':>9} {'max err':>9} {'ms/page':>9}")
+    for name, result in results.items():
+        errors = np.array(result['errors'])
+        print(f"{name:<8} {errors.mean():>8.3f}° {errors.max():>8.3f}° {np.mean(result['ms']):>9.1f}")
+    print(f"deskew_image total: {np.mean(deskew_ms):.1f} ms/page, "
+          f"warp skipped on {skipped}/{len(angles)} pages")
+
+
+def legacy_forced_rotation(image, angle):
+    """Forced rotation of the original deskew_image: an INTER_CUBIC warpAffine."""
+    (h, w) = image.shape[:2]
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    size = (h, w) if angle in (90, 270) else (w, h)
+    return cv2.warpAffine(image, M, size, flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+
+
+def bench_rotate(args):
+    """Compare warpAffine and lossless transposes for forced 90/180/270 rotations."""
+    page = make_page(args.dpi, 0.0)
+    print(f"Rotation benchmark: {page.shape[1]}x{page.shape[0]} RGB page ({args.dpi} DPI A4)")
+    print(f"{'angle':>5} {'warpAffine ms':>14} {'transpose ms':>13} {'speedup':>8} {'bit-exact':>10}")
+    for angle in (90, 180, 270):
+        legacy_ms, _ = _time_ms(legacy_forced_rotation, page, angle, repeat=args.repeat)
+        fast_ms, rotated = _time_ms(pdf_to_image.deskew_image, page, angle, repeat=args.repeat)
+        exact = np.array_equal(rotated, np.rot90(page, angle // 90))
+        print(f"{angle:>5} {legacy_ms:>14.1f} {fast_ms:>13.1f} {legacy_ms / fast_ms:>7.1f}x {str(exact):>10}")
+
+
+def _write_ppm(path, page):
+    """Write an RGB page as a binary PPM, the format pdftoppm renders to."""
+    with open(path, 'wb') as f:
+        f.write(f"P6\n{page.shape[1]} {page.shape[0]}\n255\n".encode('ascii'))
+        f.write(np.ascontiguousarray(page).tobytes())
+
+
+def _load_pil(path):
+    """Decode a rendered page into a PIL image, as pdf2image returns it."""
+    img = Image.open(path)
+    img.load()
+    return img
+
+
+def bench_alloc(args):
+    """Compare array allocations per page of the PIL pipeline and the memory-mapped one."""
+    work_dir = tempfile.mkdtemp(prefix="pdf2img-bench-")
+    try:
+        # Skewed pages, so deskew has to write a full-size rotated copy
+        paths = []
+        for i in range(args.pages):
+            path = os.path.join(work_dir, f"page-{i + 1}.ppm")
+            _write_ppm(path, make_page(args.dpi, 1.5 if i % 2 else -2.0, seed=i))
+            paths.append(path)
+        out_dir = os.path.join(work_dir, "out")
+        os.makedirs(out_dir)
+        encode_options = {'output_format': 'png', 'png_compression': 1}
+
+        pipelines = {
+            'pil': (_load_pil, lambda: None),
+            'mmap': (renderers.read_pnm, pdf_to_image.FrameBuffers),
+        }
+        page = make_page(args.dpi, 0.0)
+        print(f"Allocation benchmark: {args.pages} pages of {page.shape[1]}x{page.shape[0]} RGB "
+              f"({page.nbytes / 2**20:.1f} MB each), split={args.split}")
+        print("Peak memory of numpy/OpenCV arrays allocated while processing each page")
+        print(f"{'pipeline':<9} {'first MB':>9} {'steady MB':>10} {'ms/page':>9}")
+        for name, (load, make_buffers) in pipelines.items():
+            buffers = make_buffers()
+            peaks = []
+            elapsed = []
+            tracemalloc.start()
+            for i, path in enumerate(paths):
+                tracemalloc.reset_peak()
+                base = tracemalloc.get_traced_memory()[0]
+                start = time.perf_counter()
+                img = load(path)
+                pdf_to_image.process_page(img, i + 1, out_dir, name, split_pages=args.split,
+                                          encode_options=encode_options, buffers=buffers)
+                del img
+                elapsed.append((time.perf_counter() - start) * 1000)
+                peaks.append((tracemalloc.get_traced_memory()[1] - base) / 2**20)
+            tracemalloc.stop()
+            steady = np.mean(peaks[1:]) if len(peaks) > 1 else peaks[0]
+            print(f"{name:<9} {peaks[0]:>9.1f} {steady:>10.1f} {np.mean(elapsed):>9.1f}")
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def _render_ms(renderer, pdf_path, pages, dpi, gray):
+    """Wall time in milliseconds per page to render the first `pages` pages and read their pixels."""
+    start = time.perf_counter()
+    count = 0
+    for _, page in renderer.iter_pages(pdf_path, 1, pages, dpi=dpi, gray=gray):
+        # Touch every pixel, so lazily loaded pages (memory maps) are charged too
+        cv2.mean(page)
+        count += 1
+    return (time.perf_counter() - start) * 1000 / max(1, count)
+
+
+def bench_render(args):
+    """Time each available rendering backend per document, and pick the fastest per document type.
+
+    Documents without a type label are classified like the converter does
+    (renderers.document_type), and the fastest backends of the 'scan' and
+    'vector' types are printed as a PDF_RENDERER_BY_TYPE setting.
+    """
+    names = args.renderers.split(',') if args.renderers else renderers.available_renderers()
+    documents = []
+    for spec in args.documents:
+        doc_type, _, path = spec.rpartition('=')
+        documents.append((doc_type or renderers.document_type(path), path))
+
+    print(f"Render benchmark: first {args.pages} pages at {args.dpi} DPI"
+          f"{' (gray)' if args.gray else ''}, best of {args.repeat}")
+    print(f"{'document':<30} " + " ".join(f"{name:>11}" for name in names))
+    by_type = {}
+    for doc_type, path in documents:
+        row = []
+        for name in names:
+            renderer = renderers.get_renderer(name)
+            ms = min(_render_ms(renderer, path, args.pages, args.dpi, args.gray) for _ in range(args.repeat))
+            by_type.setdefault(doc_type, {}).setdefault(name, []).append(ms)
+            row.append(ms)
+        label = f"{doc_type}: {os.path.basename(path)}"
+        print(f"{label[:30]:<30} " + " ".join(f"{ms:>8.1f} ms" for ms in row))
+
+    print()
+    by_document_type = {}
+    for doc_type, results in by_type.items():
+        means = {name: np.mean(times) for name, times in results.items()}
+        fastest = min(means, key=means.get)
+        print(f"fastest for {doc_type}: {fastest} ({means[fastest]:.1f} ms/page)")
+        if doc_type in renderers.DOCUMENT_TYPES:
+            by_document_type[doc_type] = fastest
+    if by_document_type:
+        setting = ",".join(f"{doc_type}={name}" for doc_type, name in by_document_type.items())
+        print(f"Set PDF_RENDERER_BY_TYPE={setting} for 'auto' to use these backends")
+
+
+# Synthetic corpus for the `suite` benchmark: (name, kind, pages, size in inches, max skew, color)
+# 'scan' documents embed page images like a scanner does, 'vector' documents draw text and paths
+CORPUS = [
+    ('scan-gray-a4', 'scan', 8, A4_SIZE, 2.0, False),
+    ('scan-color-a4', 'scan', 4, A4_SIZE, 0.0, True),
+    ('scan-spread-a3', 'scan', 4, A3_LANDSCAPE_SIZE, 1.0, False),
+    ('vector-text-a4', 'vector', 12, A4_SIZE, 0.0, False),
+    ('vector-chart-letter', 'vector', 6, LETTER_SIZE, 0.0, True),
+    ('vector-skewed-a4', 'vector', 6, A4_SIZE, 1.5, False),
+]
+
+# Resolution of the page images embedded in scanned documents
+SCAN_DPI = 200
+
+# process_pdf options of each `suite` case, run at every DPI
+SUITE_CASES = {
+    'default': {},
+    'split': {'split_pages': True},
+    'rotate90': {'rotation': 90},
+    'crop': {'crop_margin': 20},
+    'jpeg-gray': {'output_format': 'jpeg', 'color_mode': 'gray'},
+}
+
+
+def _pdf_object(number, body):
+    return f"{number} 0 obj\n".encode('ascii') + body + b"\nendobj\n"
+
+
+def _pdf_stream(data, extra=b""):
+    data = zlib.compress(data)
+    return (b"<< /Length %d /Filter /FlateDecode " % len(data)) + extra + b">>\nstream\n" + data + b"\nendstream"
+
+
+def write_pdf(path, pages):
+    """
+    Write a minimal PDF.
+
+    Args:
+        pages: List of (width_pt, height_pt, content, image) per page: content
+            is the page's content stream, drawing with the Helvetica font /F1
+            and the image /Im1, and image is an RGB or grayscale numpy array
+            embedded as JPEG, or None
+    """
+    objects = {1: b"<< /Type /Catalog /Pages 2 0 R >>",
+               3: b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"}
+    kids = []
+    number = 4
+    for width, height, content, image in pages:
+        page_num, content_num, image_num = number, number + 1, number + 2
+        number += 3 if image is not None else 2
+        resources = b"/Font << /F1 3 0 R >>"
+        if image is not None:
+            resources += b" /XObject << /Im1 %d 0 R >>" % image_num
+            encoded = cv2.imencode('.jpg', image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_RGB2BGR),
+                                   [cv2.IMWRITE_JPEG_QUALITY, 85])[1].tobytes()
+            colorspace = b"/DeviceGray" if image.ndim == 2 else b"/DeviceRGB"
+            objects[image_num] = (b"<< /Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+                                  b"/BitsPerComponent 8 /Filter /DCTDecode /Length %d >>\nstream\n"
+                                  % (image.shape[1], image.shape[0], colorspace, len(encoded))
+                                  + encoded + b"\nendstream")
+        objects[page_num] = (b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %.2f %.2f] /Resources << %s >> "
+                             b"/Contents %d 0 R >>" % (width, height, resources, content_num))
+        objects[content_num] = _pdf_stream(content)
+        kids.append(b"%d 0 R" % page_num)
+    objects[2] = b"<< /Type /Pages /Kids [%s] /Count %d >>" % (b" ".join(kids), len(kids))
+
+    with open(path, 'wb') as f:
+        f.write(b"%PDF-1.4\n")
+        offsets = {}
+        for num in sorted(objects):
+            offsets[num] = f.tell()
+            f.write(_pdf_object(num, objects[num]))
+        xref = f.tell()
+        f.write(b"xref\n0 %d\n0000000000 65535 f \n" % (number))
+        for num in range(1, number):
+            f.write(b"%010d 00000 n \n" % offsets[num])
+        f.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (number, xref))
+
+
+def _vector_content(width, height, rng, angle, color, chart):
+    """Content stream of a text page, optionally with a chart of many short path segments."""
+    ops = []
+    if angle:
+        # Skew the whole page around its center
+        a = np.radians(angle)
+        cx, cy = width / 2, height / 2
+        c, s = np.cos(a), np.sin(a)
+        ops.append(f"q {c:.5f} {s:.5f} {-s:.5f} {c:.5f} {cx - c * cx + s * cy:.2f} {cy - s * cx - c * cy:.2f} cm")
+    ops.append("BT /F1 10 Tf 12 TL 0 g")
+    ops.append(f"72 {height - 72:.0f} Td")
+    lines = int((height - 144) / 12) // (2 if chart else 1)
+    for _ in range(lines):
+        words = " ".join("lorem ipsum dolor sit amet"[:rng.integers(3, 12)] for _ in range(rng.integers(6, 12)))
+        ops.append(f"({words}) '")
+    ops.append("ET")
+    if chart:
+        # A line chart with a few thousand segments per series
+        top = height / 2 - 36
+        for series in range(4):
+            if color:
+                r, g, b = rng.random(3)
+                ops.append(f"{r:.2f} {g:.2f} {b:.2f} RG 0.6 w")
+            else:
+                ops.append(f"{series * 0.2:.1f} G 0.6 w")
+            ys = np.cumsum(rng.normal(0, 2, 2000)) + top / 2
+            xs = np.linspace(72, width - 72, len(ys))
+            ops.append(f"{xs[0]:.2f} {ys[0]:.2f} m " + " ".join(f"{x:.2f} {y:.2f} l" for x, y in zip(xs, ys)) + " S")
+        if color:
+            ops.append("0.9 0.2 0.2 rg 72 72 60 40 re f 0.2 0.4 0.9 rg 140 72 60 40 re f")
+    if angle:
+        ops.append("Q")
+    return "\n".join(ops).encode('latin-1')
+
+
+def write_corpus_document(path, kind, pages, size, max_skew, color, seed=0):
+    """Write one synthetic document of CORPUS."""
+    rng = np.random.default_rng(seed)
+    width, height = size[0] * 72, size[1] * 72
+    pdf_pages = []
+    for i in range(pages):
+        angle = float(rng.uniform(-max_skew, max_skew)) if max_skew else 0.0
+        if kind == 'scan':
+            image = make_page(SCAN_DPI, angle, seed=seed + i, color=color, size=size)
+            if color:
+                # A photo-like block, so the page is not colorless
+                h, w = image.shape[:2]
+                image[h // 3:h // 2, w // 4:w // 2] = rng.integers(0, 255, (h // 2 - h // 3, w // 2 - w // 4, 3))
+            content = b"q %.2f 0 0 %.2f 0 0 cm /Im1 Do Q" % (width, height)
+            pdf_pages.append((width, height, content, image))
+        else:
+            content = _vector_content(width, height, rng, angle, color, chart='chart' in os.path.basename(path))
+            pdf_pages.append((width, height, content, None))
+    write_pdf(path, pdf_pages)
+
+
+def build_corpus(corpus_dir):
+    """
+    Write the CORPUS documents to `corpus_dir`, reusing those already there.
+
+    Returns:
+        List of (name, path, spec) per document
+    """
+    os.makedirs(corpus_dir, exist_ok=True)
+    documents = []
+    for seed, (name, kind, pages, size, max_skew, color) in enumerate(CORPUS):
+        spec = {'kind': kind, 'pages': pages, 'size': list(size), 'max_skew': max_skew, 'color': color,
+                'seed': seed, 'scan_dpi': SCAN_DPI}
+        # The spec is part of the filename, so changing CORPUS regenerates the document
+        tag = hashlib.sha256(json.dumps(spec, sort_keys=True).encode('utf-8')).hexdigest()[:8]
+        path = os.path.join(corpus_dir, f"{name}-{tag}.pdf")
+        if not os.path.exists(path):
+            tmp_path = path + ".tmp"
+            write_corpus_document(tmp_path, kind, pages, size, max_skew, color, seed=seed * 1000)
+            os.replace(tmp_path, path)
+        documents.append((name, path, spec))
+    return documents
+
+
+def _peak_rss_mb():
+    """Peak resident memory of this process in MiB."""
+    try:
+        # Reset by exec, unlike ru_maxrss, which a spawned process inherits from its parent
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # ru_maxrss is in KiB on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _run_case(pdf_path, options):
+    """
+    Convert `pdf_path` once with process_pdf and measure it.
+
+    Runs in a fresh process, so its peak RSS is that of this conversion only.
+    """
+    final = {}
+    output_dir = tempfile.mkdtemp(prefix="pdf2img-suite-")
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            saved = pdf_to_image.process_pdf(pdf_path, output_dir, progress_callback=final.update, **options)
+            elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return {
+        'seconds': elapsed,
+        'pages': final.get('pages_written', 0),
+        'pages_per_sec': final.get('pages_written', 0) / elapsed if elapsed else 0.0,
+        'files': len(saved),
+        'output_bytes': final.get('bytes_written', 0),
+        'timings': final.get('timings', {}),
+        'peak_rss_mb': _peak_rss_mb(),
+        # Largest renderer subprocess or pool worker
+        'child_peak_rss_mb': resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def bench_suite(args):
+    """Run process_pdf over the corpus and every case, and save the results as JSON."""
+    documents = build_corpus(args.corpus_dir)
+    if args.documents:
+        documents = [doc for doc in documents if doc[0] in args.documents.split(',')]
+    cases = args.cases.split(',') if args.cases else list(SUITE_CASES)
+    dpis = [int(dpi) for dpi in args.dpi.split(',')]
+    renderer = renderers.get_renderer(args.renderer).name
+
+    print(f"Suite: {len(documents)} documents x {len(cases)} cases x {len(dpis)} DPI, "
+          f"renderer {renderer}, {args.workers} worker(s)")
+    print(f"{'document':<20} {'case':<10} {'dpi':>4} {'pages/s':>8} {'RSS MB':>7} {'out MB':>7}  "
+          + " ".join(f"{stage:>7}" for stage in pdf_to_image.PIPELINE_STAGES))
+    results = []
+    context = multiprocessing.get_context('spawn')
+    for name, path, spec in documents:
+        for case in cases:
+            for dpi in dpis:
+                options = dict(SUITE_CASES[case], dpi=dpi, workers=args.workers, renderer=renderer)
+                runs = []
+                for _ in range(args.repeat):
+                    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                        runs.append(pool.submit(_run_case, path, options).result())
+                # Fastest run, with the highest peak RSS of all runs
+                result = min(runs, key=lambda run: run['seconds'])
+                result['peak_rss_mb'] = max(run['peak_rss_mb'] for run in runs)
+                result['child_peak_rss_mb'] = max(run['child_peak_rss_mb'] for run in runs)
+                result.update({'document': name, 'case': case, 'dpi': dpi, 'options': options, 'spec': spec})
+                results.append(result)
+                # Seconds per page of each stage
+                stages = [result['timings'].get(stage, 0.0) / max(1, result['pages'])
+                          for stage in pdf_to_image.PIPELINE_STAGES]
+                print(f"{name:<20} {case:<10} {dpi:>4} {result['pages_per_sec']:>8.2f} "
+                      f"{result['peak_rss_mb']:>7.0f} {result['output_bytes'] / 2**20:>7.1f}  "
+                      + " ".join(f"{seconds * 1000:>5.0f}ms" for seconds in stages))
+
+    report = {
+        'meta': {
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'revision': _git_revision(),
+            'renderer': renderer,
+            'workers': args.workers,
+            'repeat': args.repeat,
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results saved to {args.output}")
+
+
+def _change(new, old):
+    return (new - old) / old if old else 0.0
+
+
+def bench_compare(args):
+    """
+    Compare two suite result files case by case.
+
+    Exits with status 1 when a case got slower, used more memory or wrote
+    more bytes than the thresholds allow, so it can gate a change in CI.
+    """
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    def key(result):
+        return result['document'], result['case'], result['dpi']
+
+    old_results = {key(result): result for result in baseline['results']}
+    print(f"Baseline {baseline['meta'].get('revision')} vs candidate {candidate['meta'].get('revision')}")
+    print(f"{'document':<20} {'case':<10} {'dpi':>4} {'pages/s':>9} {'RSS':>9} {'bytes':>9}")
+    regressions = []
+    for result in candidate['results']:
+        old = old_results.get(key(result))
+        if old is None:
+            continue
+        speed = _change(result['pages_per_sec'], old['pages_per_sec'])
+        rss = _change(result['peak_rss_mb'], old['peak_rss_mb'])
+        size = _change(result['output_bytes'], old['output_bytes'])
+        failed = []
+        if -speed > args.max_slowdown:
+            failed.append('speed')
+        if rss > args.max_rss_growth:
+            failed.append('rss')
+        if size > args.max_bytes_growth:
+            failed.append('bytes')
+        if failed:
+            regressions.append((key(result), failed))
+        print(f"{result['document']:<20} {result['case']:<10} {result['dpi']:>4} {speed:>+8.1%} {rss:>+8.1%} "
+              f"{size:>+8.1%}" + (f"  REGRESSION ({', '.join(failed)})" if failed else ""))
+
+    if regressions:
+        print(f"{len(regressions)} regression(s) beyond the thresholds")
+        sys.exit(1)
+    print("No regressions")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the PDF to image pipeline")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    deskew = subparsers.add_parser("deskew", help="Skew estimation accuracy and speed")
+    deskew.add_argument("--pages", type=int, default=20, help="Number of synthetic pages")
+    deskew.add_argument("--dpi", type=int, default=300, help="Page resolution")
+    deskew.add_argument("--max-angle", type=float, default=5.0, help="Largest skew in degrees")
+    deskew.add_argument("--seed", type=int, default=0, help="Random seed for skew angles")
+    deskew.set_defaults(func=bench_deskew)
+
+    rotate = subparsers.add_parser("rotate", help="Forced 90/180/270 rotation speed")
+    rotate.add_argument("--dpi", type=int, default=300, help="Page resolution")
+    rotate.add_argument("--repeat", type=int, default=5, help="Best of this many runs")
+    rotate.set_defaults(func=bench_rotate)
+
+    alloc = subparsers.add_parser("alloc", help="Memory allocated per page, PIL vs memory-mapped pipeline")
+    alloc.add_argument("--pages", type=int, default=6, help="Number of synthetic pages")
+    alloc.add_argument("--dpi", type=int, default=300, help="Page resolution")
+    alloc.add_argument("--split", action="store_true", help="Split pages in half")
+    alloc.set_defaults(func=bench_alloc)
+
+    render = subparsers.add_parser("render", help="Rendering backends compared on real documents")
+    render.add_argument("documents", nargs="+", metavar="[TYPE=]FILE.pdf",
+                        help="Documents to render, optionally labelled with a type (default: scan or vector, "
+                             "as classified by renderers.document_type); results are summarized per type")
+    render.add_argument("--pages", type=int, default=5, help="Pages rendered from each document")
+    render.add_argument("--dpi", type=int, default=300, help="Page resolution")
+    render.add_argument("--gray", action="store_true", help="Render grayscale pages")
+    render.add_argument("--repeat", type=int, default=3, help="Best of this many runs")
+    render.add_argument("--renderers", help="Comma-separated backends (default: all available)")
+    render.set_defaults(func=bench_render)
+
+    suite = subparsers.add_parser("suite", help="process_pdf over a synthetic corpus, saved as JSON")
+    suite.add_argument("--corpus-dir", default=os.path.join(tempfile.gettempdir(), "pdf2img-bench-corpus"),
+                       help="Where the synthetic PDFs are written and reused")
+    suite.add_argument("--documents", help=f"Comma-separated corpus documents (default: all of "
+                                           f"{', '.join(doc[0] for doc in CORPUS)})")
+    suite.add_argument("--cases", help=f"Comma-separated cases (default: all of {', '.join(SUITE_CASES)})")
+    suite.add_argument("--dpi", default="150,300", help="Comma-separated resolutions")
+    suite.add_argument("--workers", type=int, default=1, help="process_pdf worker processes")
+    suite.add_argument("--repeat", type=int, default=1,
+                       help="Runs per case, keeping the fastest (use 3 or more for gating)")
+    suite.add_argument("--renderer", default="auto", help="Rendering backend (see renderers.py)")
+    suite.add_argument("--output", default="benchmark-results.json", help="JSON results file")
+    suite.set_defaults(func=bench_suite)
+
+    compare = subparsers.add_parser("compare", help="Compare two suite results and gate regressions")
+    compare.add_argument("baseline", help="JSON results of the reference run")
+    compare.add_argument("candidate", help="JSON results of the run to check")
+    compare.add_argument("--max-slowdown", type=float, default=0.10,
+                         help="Largest allowed drop in pages per second (fraction)")
+    compare.add_argument("--max-rss-growth", type=float, default=0.10,
+                         help="Largest allowed growth of peak RSS (fraction)")
+    compare.add_argument("--max-bytes-growth", type=float, default=0.05,
+                         help="Largest allowed growth of output bytes (fraction)")
+    compare.set_defaults(func=bench_compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+"""
+Resumable uploads sent in chunks.
+
+An upload is created with its filename and total size, then its bytes are
+appended in order, one request per chunk, each stating the offset it
+starts at. A chunk is streamed from the request to the end of a partial
+file without being held in memory, and a chunk sent at the wrong offset is
+refused with the current offset, so a client that lost its connection
+asks for the offset and carries on from there.
+
+The SHA-256 of the upload is computed while the chunks are written. A
+process keeps the hash state of the uploads it has appended to; when the
+next chunk of an upload arrives at another gunicorn worker, that worker
+first hashes the part already on disk to catch up. The file signature
+(a PDF header, or a ZIP header for archives of PDFs) is checked as soon
+as the first bytes arrive, so a file of the wrong type is rejected after
+its first chunk rather than after gigabytes.
+
+Each upload is a `<id>.part` file and a `<id>.json` record in
+`directory`. Both are removed when the upload is completed or aborted, or
+after `ttl` seconds without a chunk.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import hashlib
+import threading
+
+# Bytes copied from a request to the partial file at a time
+COPY_BLOCK_SIZE = 1024 * 1024
+
+# Accepted file types: extension -> (signature, bytes at the start of the
+# file it must appear in, description)
+FILE_SIGNATURES = {
+    '.pdf': (b'%PDF-', 1024, 'PDF file'),
+    '.zip': (b'PK\x03\x04', 4, 'ZIP archive'),
+}
+
+
+def file_type(filename):
+    """Extension of an accepted file type, or None"""
+    extension = os.path.splitext(filename)[1].lower()
+    return extension if extension in FILE_SIGNATURES else None
+
+
+class UploadError(Exception):
+    """
+    Raised when an upload or chunk is refused.
+
+    Args:
+        message: Reason, for the client
+        status: HTTP status code to answer with
+        offset: Current offset of the upload, for a chunk sent at the wrong one
+    """
+
+    def __init__(self, message, status=400, offset=None):
+        super().__init__(message)
+        self.status = status
+        self.offset = offset
+
+
+class UploadSessions:
+    """
+    Resumable uploads kept in `directory`, shared by all processes.
+
+    Args:
+        directory: Directory of the partial files and their records
+        max_size: Largest upload accepted, in bytes
+        ttl: Seconds after the last chunk before an unfinished upload is deleted
+    """
+
+    def __init__(self, directory, max_size, ttl=86400):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        # upload id -> (offset, hash of the bytes before it) for uploads appended to by this process
+        self._hashes = {}
+        self._lock = threading.Lock()
+
+    def _part_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.part")
+
+    def _record_path(self, upload_id):
+        return os.path.join(self.directory, f"{upload_id}.json")
+
+    def _write_record(self, record):
+        path = self._record_path(record['id'])
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(record, f)
+        os.replace(tmp_path, path)
+
+    def create(self, user_id, filename, size):
+        """
+        Start an upload.
+
+        Returns:
+            The upload's record, whose `id` is also used for the conversion
+        """
+        if file_type(filename) is None:
+            raise UploadError("Invalid file type")
+        if size <= 0:
+            raise UploadError("Upload size must be positive")
+        if size > self.max_size:
+            raise UploadError(f"File too large: the limit is {self.max_size} bytes", status=413)
+        os.makedirs(self.directory, exist_ok=True)
+        self.expire()
+        now = time.time()
+        record = {
+            'id': str(uuid.uuid4()),
+            'user_id': user_id,
+            'filename': filename,
+            'size': size,
+            'created': now,
+            'updated': now,
+        }
+        open(self._part_path(record['id']), 'wb').close()
+        self._write_record(record)
+        return record
+
+    def get(self, upload_id, user_id=None):
+        """
+        An upload's record with its current `offset`.
+
+        Raises:
+            UploadError: if there is no such upload, or it belongs to another user
+        """
+        try:
+            with open(self._record_path(upload_id)) as f:
+                record = json.load(f)
+            record['offset'] = os.path.getsize(self._part_path(upload_id))
+        except (OSError, ValueError):
+            raise UploadError("Upload not found", status=404)
+        if user_id is not None and record['user_id'] != user_id:
+            raise UploadError("Upload not found", status=404)
+        return record
+
+    def exists(self, upload_id):
+        return os.path.exists(self._record_path(upload_id))
+
+    def _hash_to(self, upload_id, f, offset):
+        """Hash state of the first `offset` bytes, catching up from disk if this process is behind"""
+        with self._lock:
+            offset_hashed, digest = self._hashes.get(upload_id, (0, None))
+        if digest is None or offset_hashed != offset:
+            # Earlier chunks were written by another process
+            digest = hashlib.sha256()
+            f.seek(0)
+            remaining = offset
+            while remaining:
+                block = f.read(min(COPY_BLOCK_SIZE, remaining))
+                if not block:
+                    break
+                digest.update(block)
+                remaining -= len(block)
+        return digest
+
+    def _lock_part(self, f, wait):
+        """Lock an upload's partial file, polling so gevent workers are never stuck in flock"""
+        while True:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except OSError:
+                if not wait:
+                    return False
+                time.sleep(0.05)
+
+    def append(self, upload_id, user_id, offset, stream, on_chunk=None):
+        """
+        Write a chunk read from `stream` at `offset`.
+
+        Args:
+            offset: Where the chunk starts; must be the current offset
+            stream: File-like object with the chunk's bytes
+            on_chunk: Optional callable on_chunk(record, path) run once
+                the chunk is written, with the upload's new record (e.g. to
+                start probing the PDF while the client sends the rest)
+
+        Returns:
+            The upload's record with its new `offset`
+        """
+        record = self.get(upload_id, user_id)
+        signature, window, description = FILE_SIGNATURES[file_type(record['filename'])]
+        valid = True
+        with open(self._part_path(upload_id), 'r+b') as f:
+            if not self._lock_part(f, wait=False):
+                raise UploadError("Another chunk of this upload is being written", status=409,
+                                  offset=record['offset'])
+            try:
+                current = os.fstat(f.fileno()).st_size
+                if offset != current:
+                    raise UploadError("Chunk does not start at the upload's offset", status=409, offset=current)
+                digest = self._hash_to(upload_id, f, current)
+                f.seek(0)
+                header = f.read(min(current, window))
+                f.seek(current)
+                written = current
+                try:
+                    while True:
+                        block = stream.read(COPY_BLOCK_SIZE)
+                        if not block:
+                            break
+                        if written + len(block) > record['size']:
+                            raise UploadError("Chunk goes past the end of the upload", offset=written)
+                        if len(header) < window:
+                            header += block[:window - len(header)]
+                            if signature not in header and len(header) >= min(window, record['size']):
+                                valid = False
+                                break
+                        f.write(block)
+                        digest.update(block)
+                        written += len(block)
+                finally:
+                    f.flush()
+                    # A dropped connection leaves a partial chunk: the hash still matches the file
+                    with self._lock:
+                        self._hashes[upload_id] = (written, digest)
+                if valid:
+                    # Reread under the lock, so fields added by update are kept
+                    record = self.get(upload_id)
+                    record['updated'] = time.time()
+                    if written == record['size']:
+                        record['sha256'] = digest.hexdigest()
+                        with self._lock:
+                            self._hashes.pop(upload_id, None)
+                    self._write_record({k: v for k, v in record.items() if k != 'offset'})
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+        if not valid:
+            self.delete(upload_id)
+            raise UploadError(f"Not a {description}", status=415)
+
+        record['offset'] = written
+        if on_chunk is not None:
+            on_chunk(record, self._part_path(upload_id))
+        return record
+
+    def update(self, upload_id, **fields):
+        """
+        Add fields to an upload's record (e.g. the result of a probe).
+
+        Does nothing once the upload is finished or deleted.
+        """
+        try:
+            f = open(self._part_path(upload_id), 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            # Serialized with append and finish, which read and replace the record
+            self._lock_part(f, wait=True)
+            try:
+                if not os.path.exists(self._part_path(upload_id)):
+                    # Moved by finish while we waited
+                    return
+                try:
+                    record = self.get(upload_id)
+                except UploadError:
+                    return
+                record.pop('offset')
+                record.update(fields)
+                self._write_record(record)
+                if not os.path.exists(self._part_path(upload_id)):
+                    # Deleted meanwhile; delete does not take the lock
+                    self.delete(upload_id)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def finish(self, upload_id, user_id, path):
+        """
+        Move a fully received upload to `path` and forget it.
+
+        Returns:
+            The upload's record, with its `sha256`
+        """
+        self.get(upload_id, user_id)
+        try:
+            f = open(self._part_path(upload_id), 'rb')
+        except FileNotFoundError:
+            raise UploadError("Upload not found", status=404)
+        with f:
+            self._lock_part(f, wait=True)
+            try:
+                # Read under the lock, so fields added by update are not lost
+                record = self.get(upload_id, user_id)
+                if record['offset'] != record['size'] or 'sha256' not in record:
+                    raise UploadError(f"Upload incomplete: {record['offset']} of {record['size']} bytes received",
+                                      status=409, offset=record['offset'])
+                os.replace(self._part_path(upload_id), path)
+                self.delete(upload_id)
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return record
+
+    def delete(self, upload_id):
+        """Abort an upload, removing its files"""
+        with self._lock:
+            self._hashes.pop(upload_id, None)
+        for path in (self._part_path(upload_id), self._record_path(upload_id)):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def expire(self):
+        """Delete uploads that received no chunk for `ttl` seconds"""
+        before = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            if not name.endswith('.json'):
+                continue
+            upload_id = name[:-len('.json')]
+            try:
+                if os.path.getmtime(os.path.join(self.directory, name)) < before:
+                    self.delete(upload_id)
+            except OSError:
+                continue
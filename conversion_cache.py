@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+"""
+Content-addressed cache of finished conversions.
+
+A conversion is identified by the SHA-256 of the uploaded PDF and the
+process_pdf options that affect its output. When a job completes, its
+pages are hard-linked into a cache directory named after that key. A
+later upload of the same PDF with the same options links the cached
+pages into its own output directory, so it completes without rendering
+anything.
+
+Hard links share the file data, so a cached conversion costs no extra
+disk space while a job still holds its pages; disk usage bills those
+pages to the cache rather than to every job linking them. Evicting an
+entry only removes the cache's links; jobs keep theirs. Entries are tracked in
+the conversion store and evicted least recently used first once they
+exceed a total size.
+"""
+import os
+import json
+import time
+import shutil
+import hashlib
+
+from usage_tracker import shared_inodes, tree_usage
+
+# Bump when a pipeline change alters the output for the same options,
+# so older cache entries are no longer matched
+CACHE_VERSION = 2
+
+# Bytes read from an upload at a time while saving and hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def save_and_hash(stream, path):
+    """
+    Copy `stream` to `path` and hash it on the way.
+
+    Returns:
+        Hex SHA-256 of the written bytes
+    """
+    digest = hashlib.sha256()
+    with open(path, 'wb') as f:
+        while True:
+            chunk = stream.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            f.write(chunk)
+    return digest.hexdigest()
+
+
+def normalize_options(options):
+    """
+    The process_pdf options that affect the output, in a canonical form.
+
+    Settings that have no effect on the chosen format are dropped, so for
+    example PNG jobs that differ only in JPEG quality share a cache entry.
+    """
+    normalized = dict(options)
+    if normalized.get('output_format') == 'png':
+        normalized.pop('quality', None)
+    else:
+        normalized.pop('png_compression', None)
+    if 'preview_widths' in normalized:
+        normalized['preview_widths'] = sorted(normalized['preview_widths'] or [])
+    return normalized
+
+
+def cache_key(pdf_sha256, options):
+    """Cache key for a PDF hash and its process_pdf options"""
+    payload = json.dumps({'version': CACHE_VERSION, 'pdf': pdf_sha256, 'options': normalize_options(options)},
+                         sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def _link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        # Different filesystem or no hard link support
+        shutil.copy2(src, dst)
+
+
+def link_outputs(src_dir, dst_dir, src_prefix, dst_prefix):
+    """
+    Hard-link the page images and previews of `src_dir` into `dst_dir`,
+    replacing the `src_prefix` of each filename with `dst_prefix`.
+
+    Hidden files and files not starting with `src_prefix` (like cached
+    ZIP archives) are skipped.
+
+    Returns:
+        (names of the linked page images in name order, total bytes)
+    """
+    pages = []
+    size = 0
+    for root, dirs, files in os.walk(src_dir):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        rel = os.path.relpath(root, src_dir)
+        target = dst_dir if rel == '.' else os.path.join(dst_dir, rel)
+        os.makedirs(target, exist_ok=True)
+        for name in files:
+            if name.startswith('.') or not name.startswith(src_prefix):
+                continue
+            new_name = dst_prefix + name[len(src_prefix):]
+            src = os.path.join(root, name)
+            _link_or_copy(src, os.path.join(target, new_name))
+            size += os.path.getsize(src)
+            if rel == '.':
+                pages.append(new_name)
+    return sorted(pages), size
+
+
+class ConversionCache:
+    """
+    Conversion outputs stored under `cache_dir`, indexed in a ConversionStore.
+
+    Args:
+        cache_dir: Directory of the cache entries; must be on the same
+            filesystem as the output folder for hard links to work
+        store: ConversionStore holding the cache index
+        max_bytes: Total size the cache is evicted down to
+        on_evict: Called with the key of each evicted entry, once its
+            links are removed
+    """
+
+    # Filename prefix of the cached pages, replaced by the job's ID when linked
+    ENTRY_PREFIX = 'cached_'
+
+    def __init__(self, cache_dir, store, max_bytes, on_evict=None):
+        self.cache_dir = cache_dir
+        self.store = store
+        self.max_bytes = max_bytes
+        self.on_evict = on_evict
+
+    def _entry_dir(self, key):
+        return os.path.join(self.cache_dir, key)
+
+    def linked_inodes(self, key):
+        """(st_dev, st_ino) of the entry's files that are linked into conversions"""
+        return shared_inodes(self._entry_dir(key))
+
+    def lookup(self, key, output_dir, file_base):
+        """
+        Link a cached conversion into `output_dir`, naming its pages after
+        `file_base` like process_pdf does.
+
+        Returns:
+            Names of the linked page images, or None on a cache miss
+        """
+        entry = self.store.get_cache_entry(key)
+        entry_dir = self._entry_dir(key)
+        if entry is None or not os.path.isdir(entry_dir):
+            return None
+        try:
+            pages, _ = link_outputs(entry_dir, output_dir, self.ENTRY_PREFIX, f"{file_base}_")
+        except OSError as e:
+            # Evicted by another process while linking; fall back to converting
+            print(f"Error linking cache entry {key}: {str(e)}")
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir, exist_ok=True)
+            return None
+        if len(pages) != entry['page_count']:
+            shutil.rmtree(output_dir, ignore_errors=True)
+            os.makedirs(output_dir, exist_ok=True)
+            return None
+        self.store.touch_cache_entry(key, time.time())
+        return pages
+
+    def add(self, key, pdf_sha256, output_dir, file_base):
+        """Store the finished conversion in `output_dir` under `key`, then evict"""
+        entry_dir = self._entry_dir(key)
+        if os.path.isdir(entry_dir):
+            return
+        tmp_dir = os.path.join(self.cache_dir, f".{key}.{os.getpid()}.tmp")
+        try:
+            pages, size = link_outputs(output_dir, tmp_dir, f"{file_base}_", self.ENTRY_PREFIX)
+            os.rename(tmp_dir, entry_dir)
+        except OSError as e:
+            # Most likely an identical job finished first
+            print(f"Error adding cache entry {key}: {str(e)}")
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            return
+        self.store.put_cache_entry(key, pdf_sha256, file_base, len(pages), size, time.time())
+        # The entry's pages are billed to the cache from now on, not to the jobs linking them
+        self.store.add_usage('', 'output', *tree_usage(entry_dir))
+        self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Drop least recently used entries until the cache fits in `max_bytes`
+        (default: the cache's max_bytes).
+
+        Returns:
+            Number of entries evicted
+        """
+        limit = self.max_bytes if max_bytes is None else max_bytes
+        _, total = self.store.cache_size()
+        evicted = 0
+        for entry in self.store.cache_entries_lru():
+            if total <= limit:
+                break
+            total -= entry['bytes']
+            if not self.store.delete_cache_entry(entry['key']):
+                # Evicted by another process
+                continue
+            entry_dir = self._entry_dir(entry['key'])
+            size, files = tree_usage(entry_dir)
+            shutil.rmtree(entry_dir, ignore_errors=True)
+            self.store.add_usage('', 'output', -size, -files)
+            evicted += 1
+            if self.on_evict is not None:
+                self.on_evict(entry['key'])
+        return evicted
+
+    def stats(self):
+        count, size = self.store.cache_size()
+        return {'entries': count, 'bytes': size, 'max_bytes': self.max_bytes}
@@ -0,0 +1,487 @@
+#!/usr/bin/env python3
+"""
+Indexed metadata store for conversions, backed by SQLite in WAL mode.
+
+The status/*.json files remain the live record of each job (they are what
+the status endpoint and the status stream read). Every status update is
+also written through to this store, so pages that list conversions, like
+the history page, query an index instead of opening every status file.
+
+Existing status files can be imported with:
+
+    python conversion_store.py import [--status-folder status] [--output-folder output]
+"""
+import os
+import json
+import sqlite3
+import argparse
+import threading
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversions (
+    id TEXT PRIMARY KEY,
+    user_id TEXT,
+    username TEXT,
+    status TEXT NOT NULL,
+    message TEXT,
+    timestamp REAL NOT NULL,
+    original_filename TEXT,
+    page_count INTEGER NOT NULL DEFAULT 0,
+    thumbnail TEXT,
+    params TEXT NOT NULL DEFAULT '{}',
+    last_accessed REAL
+);
+CREATE INDEX IF NOT EXISTS idx_conversions_user ON conversions (user_id, status, timestamp);
+CREATE INDEX IF NOT EXISTS idx_conversions_status ON conversions (status, timestamp);
+CREATE INDEX IF NOT EXISTS idx_conversions_timestamp ON conversions (timestamp);
+CREATE TABLE IF NOT EXISTS cache_entries (
+    key TEXT PRIMARY KEY,
+    pdf_sha256 TEXT NOT NULL,
+    source_id TEXT,
+    page_count INTEGER NOT NULL DEFAULT 0,
+    bytes INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_cache_entries_last_used ON cache_entries (last_used);
+CREATE TABLE IF NOT EXISTS usage (
+    file_id TEXT PRIMARY KEY,
+    upload_bytes INTEGER NOT NULL DEFAULT 0,
+    upload_files INTEGER NOT NULL DEFAULT 0,
+    output_bytes INTEGER NOT NULL DEFAULT 0,
+    output_files INTEGER NOT NULL DEFAULT 0,
+    status_bytes INTEGER NOT NULL DEFAULT 0,
+    status_files INTEGER NOT NULL DEFAULT 0,
+    linked_bytes INTEGER NOT NULL DEFAULT 0,
+    linked_files INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS purge_requests (
+    user_id TEXT PRIMARY KEY,
+    requested REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# Statuses after which a conversion never changes again
+FINAL_STATUSES = ('completed', 'error', 'cancelled')
+
+# Disk usage categories, one per app folder
+USAGE_CATEGORIES = ('upload', 'output', 'status')
+
+# Pages of a conversion hard-linked with the conversion cache. They are on
+# disk once, billed to the cache ('' in usage), but still count toward the
+# conversion's owner for quotas.
+LINKED_CATEGORY = 'linked'
+
+# What a conversion is charged for by the retention policies
+QUOTA_CATEGORIES = USAGE_CATEGORIES + (LINKED_CATEGORY,)
+
+# Status fields stored in their own columns; everything else goes into params
+COLUMNS = ('id', 'user_id', 'username', 'status', 'message', 'timestamp', 'original_filename')
+
+# Status fields that describe the job's progress rather than its parameters
+TRANSIENT_FIELDS = ('progress', 'queue_position', 'cancel_requested', 'image_count', 'thumbnail')
+
+
+class ConversionStore:
+    """
+    Conversion metadata indexed by owner, status and time.
+
+    Each thread gets its own connection; SQLite's WAL mode lets the
+    gunicorn workers read while one of them writes.
+    """
+
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._local = threading.local()
+        # The database is created on first use, not when the store is constructed
+        self._schema_ready = False
+
+    def _create_schema(self, conn):
+        with conn:
+            conn.executescript(SCHEMA)
+            # Columns added after the first release of the schema
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(conversions)")}
+            if 'last_accessed' not in columns:
+                conn.execute("ALTER TABLE conversions ADD COLUMN last_accessed REAL")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_conversions_lru "
+                         "ON conversions (COALESCE(last_accessed, timestamp))")
+            usage_columns = {row['name'] for row in conn.execute("PRAGMA table_info(usage)")}
+            if 'linked_bytes' not in usage_columns:
+                conn.execute("ALTER TABLE usage ADD COLUMN linked_bytes INTEGER NOT NULL DEFAULT 0")
+                conn.execute("ALTER TABLE usage ADD COLUMN linked_files INTEGER NOT NULL DEFAULT 0")
+        self._schema_ready = True
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        # A connection is never reused in a forked child
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                self._create_schema(conn)
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @staticmethod
+    def _row_to_dict(row):
+        record = dict(row)
+        record['params'] = json.loads(record['params'] or '{}')
+        return record
+
+    def upsert(self, status_data):
+        """
+        Insert or update a conversion from a status record.
+
+        page_count and thumbnail come from the status's image_count and
+        thumbnail fields and are left unchanged when the status lacks them.
+        """
+        params = {k: v for k, v in status_data.items()
+                  if k not in COLUMNS and k not in TRANSIENT_FIELDS}
+        values = [status_data.get(column) for column in COLUMNS]
+        values[COLUMNS.index('timestamp')] = status_data.get('timestamp', 0)
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT INTO conversions (id, user_id, username, status, message, timestamp,
+                                         original_filename, page_count, thumbnail, params)
+                VALUES (?, ?, ?, ?, ?, ?, ?, COALESCE(?, 0), ?, ?)
+                ON CONFLICT (id) DO UPDATE SET
+                    user_id = excluded.user_id,
+                    username = excluded.username,
+                    status = excluded.status,
+                    message = excluded.message,
+                    timestamp = excluded.timestamp,
+                    original_filename = excluded.original_filename,
+                    page_count = COALESCE(?, conversions.page_count),
+                    thumbnail = COALESCE(excluded.thumbnail, conversions.thumbnail),
+                    params = excluded.params
+                """,
+                (*values, status_data.get('image_count'), status_data.get('thumbnail'),
+                 json.dumps(params), status_data.get('image_count'))
+            )
+
+    def get(self, file_id):
+        """One conversion as a dict, or None"""
+        row = self._connect().execute("SELECT * FROM conversions WHERE id = ?", (file_id,)).fetchone()
+        return self._row_to_dict(row) if row is not None else None
+
+    def delete(self, file_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM conversions WHERE id = ?", (file_id,))
+
+    def touch(self, file_id, now):
+        """Record that a conversion's images were viewed or downloaded"""
+        with self._connect() as conn:
+            conn.execute("UPDATE conversions SET last_accessed = ? WHERE id = ?", (now, file_id))
+
+    def _filters(self, user_id=None, status=None, with_pages=False):
+        clauses, args = [], []
+        if user_id is not None:
+            clauses.append("user_id = ?")
+            args.append(user_id)
+        if status is not None:
+            clauses.append("status = ?")
+            args.append(status)
+        if with_pages:
+            clauses.append("page_count > 0")
+        where = f"WHERE {' AND '.join(clauses)}" if clauses else ""
+        return where, args
+
+    def list_conversions(self, user_id=None, status=None, with_pages=False, limit=50, offset=0):
+        """
+        Conversions, newest first.
+
+        Args:
+            user_id: Only this user's conversions (None for everyone's)
+            status: Only conversions with this status (None for any)
+            with_pages: Only conversions that produced at least one image
+            limit, offset: Page of results to return
+        """
+        where, args = self._filters(user_id, status, with_pages)
+        rows = self._connect().execute(
+            f"SELECT * FROM conversions {where} ORDER BY timestamp DESC LIMIT ? OFFSET ?",
+            (*args, limit, offset)
+        ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def count_conversions(self, user_id=None, status=None, with_pages=False):
+        where, args = self._filters(user_id, status, with_pages)
+        return self._connect().execute(f"SELECT COUNT(*) FROM conversions {where}", args).fetchone()[0]
+
+    def expired_conversions(self, before, limit):
+        """IDs of finished conversions created before `before`, oldest first"""
+        rows = self._connect().execute(
+            f"SELECT id FROM conversions WHERE status IN ({', '.join('?' * len(FINAL_STATUSES))}) "
+            f"AND timestamp < ? ORDER BY timestamp LIMIT ?",
+            (*FINAL_STATUSES, before, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def lru_conversions(self, user_id=None, limit=50):
+        """IDs of finished conversions, least recently viewed or created first"""
+        where = f"status IN ({', '.join('?' * len(FINAL_STATUSES))})"
+        args = list(FINAL_STATUSES)
+        if user_id is not None:
+            where += " AND user_id = ?"
+            args.append(user_id)
+        rows = self._connect().execute(
+            f"SELECT id FROM conversions WHERE {where} "
+            f"ORDER BY COALESCE(last_accessed, timestamp) LIMIT ?",
+            (*args, limit)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def kept_sources(self, limit):
+        """
+        IDs of completed conversions whose uploaded PDF is still on disk and
+        no longer needed (lazy conversions render from it on demand)
+        """
+        rows = self._connect().execute(
+            "SELECT conversions.id FROM conversions JOIN usage ON usage.file_id = conversions.id "
+            "WHERE conversions.status = 'completed' AND usage.upload_files > 0 "
+            "AND COALESCE(json_extract(conversions.params, '$.lazy'), 0) = 0 LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def profiled_conversions(self, limit=50):
+        """Conversions run with profiling enabled, newest first"""
+        rows = self._connect().execute(
+            "SELECT * FROM conversions WHERE COALESCE(json_extract(params, '$.profile'), 0) = 1 "
+            "ORDER BY timestamp DESC LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def batch_conversions(self, batch_id):
+        """Conversions of a batch, in the order they were uploaded"""
+        rows = self._connect().execute(
+            "SELECT * FROM conversions WHERE json_extract(params, '$.batch_id') = ? ORDER BY timestamp, id",
+            (batch_id,)
+        ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def cache_conversions(self, key):
+        """IDs of the conversions whose pages came from or went to a conversion cache entry"""
+        rows = self._connect().execute(
+            "SELECT id FROM conversions WHERE json_extract(params, '$.cache_key') = ?", (key,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def orphaned_usage(self, limit):
+        """IDs that use disk space but have no conversion record"""
+        rows = self._connect().execute(
+            "SELECT file_id FROM usage WHERE file_id != '' "
+            "AND file_id NOT IN (SELECT id FROM conversions) LIMIT ?",
+            (limit,)
+        ).fetchall()
+        return [row[0] for row in rows]
+
+    def add_purge_request(self, user_id, now):
+        """Ask for all of a user's finished conversions ('' for everyone's) to be deleted"""
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO purge_requests (user_id, requested) VALUES (?, ?)",
+                         (user_id, now))
+
+    def purge_requests(self):
+        rows = self._connect().execute("SELECT user_id, requested FROM purge_requests ORDER BY requested")
+        return [dict(row) for row in rows.fetchall()]
+
+    def delete_purge_request(self, user_id, requested):
+        """Remove a purge request, unless it was renewed after `requested`"""
+        with self._connect() as conn:
+            conn.execute("DELETE FROM purge_requests WHERE user_id = ? AND requested <= ?", (user_id, requested))
+
+    def get_cache_entry(self, key):
+        """Conversion cache entry (see conversion_cache.py) as a dict, or None"""
+        row = self._connect().execute("SELECT * FROM cache_entries WHERE key = ?", (key,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def put_cache_entry(self, key, pdf_sha256, source_id, page_count, size, now):
+        with self._connect() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO cache_entries
+                    (key, pdf_sha256, source_id, page_count, bytes, created, last_used, hits)
+                VALUES (?, ?, ?, ?, ?, ?, ?, 0)
+                """,
+                (key, pdf_sha256, source_id, page_count, size, now, now)
+            )
+
+    def touch_cache_entry(self, key, now):
+        """Record a cache hit"""
+        with self._connect() as conn:
+            conn.execute("UPDATE cache_entries SET last_used = ?, hits = hits + 1 WHERE key = ?", (now, key))
+
+    def delete_cache_entry(self, key):
+        """Delete a cache entry; returns whether this call deleted it"""
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM cache_entries WHERE key = ?", (key,)).rowcount > 0
+
+    def cache_entries_lru(self):
+        """Cache entries, least recently used first"""
+        rows = self._connect().execute("SELECT * FROM cache_entries ORDER BY last_used").fetchall()
+        return [dict(row) for row in rows]
+
+    def cache_size(self):
+        """Number of cache entries and their total size in bytes"""
+        count, size = self._connect().execute(
+            "SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM cache_entries").fetchone()
+        return count, size
+
+    def set_usage(self, file_id, category, size, files):
+        """
+        Record the bytes and files a conversion uses in one of QUOTA_CATEGORIES.
+
+        file_id '' holds files that belong to no conversion.
+        """
+        if category not in QUOTA_CATEGORIES:
+            raise ValueError(f"Unknown usage category: {category}")
+        with self._connect() as conn:
+            conn.execute(
+                f"""
+                INSERT INTO usage (file_id, {category}_bytes, {category}_files) VALUES (?, ?, ?)
+                ON CONFLICT (file_id) DO UPDATE SET
+                    {category}_bytes = excluded.{category}_bytes,
+                    {category}_files = excluded.{category}_files
+                """,
+                (file_id, size, files)
+            )
+
+    def add_usage(self, file_id, category, size, files):
+        """Add to (or, with negative numbers, subtract from) the usage recorded by set_usage"""
+        if category not in QUOTA_CATEGORIES:
+            raise ValueError(f"Unknown usage category: {category}")
+        with self._connect() as conn:
+            conn.execute(
+                f"""
+                INSERT INTO usage (file_id, {category}_bytes, {category}_files) VALUES (?, MAX(0, ?), MAX(0, ?))
+                ON CONFLICT (file_id) DO UPDATE SET
+                    {category}_bytes = MAX(0, {category}_bytes + ?),
+                    {category}_files = MAX(0, {category}_files + ?)
+                """,
+                (file_id, size, files, size, files)
+            )
+
+    def get_usage(self, file_id):
+        """Total bytes a conversion is charged for, over QUOTA_CATEGORIES"""
+        row = self._connect().execute(
+            f"SELECT {' + '.join(f'{category}_bytes' for category in QUOTA_CATEGORIES)} "
+            f"FROM usage WHERE file_id = ?", (file_id,)
+        ).fetchone()
+        return row[0] if row is not None else 0
+
+    def usage_by_user(self):
+        """Total bytes charged per user over QUOTA_CATEGORIES, largest first"""
+        rows = self._connect().execute(
+            f"SELECT conversions.user_id, SUM({' + '.join(f'usage.{c}_bytes' for c in QUOTA_CATEGORIES)}) AS used "
+            f"FROM usage JOIN conversions ON conversions.id = usage.file_id "
+            f"GROUP BY conversions.user_id ORDER BY used DESC"
+        ).fetchall()
+        return [(row[0], row[1]) for row in rows]
+
+    def delete_usage(self, file_id):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM usage WHERE file_id = ?", (file_id,))
+
+    def replace_usage(self, usage):
+        """
+        Replace all usage rows in one transaction.
+
+        Args:
+            usage: dict of file_id -> {category: (bytes, files)}
+        """
+        rows = [
+            (file_id, *[n for category in QUOTA_CATEGORIES for n in categories.get(category, (0, 0))])
+            for file_id, categories in usage.items()
+        ]
+        columns = ", ".join(f"{category}_bytes, {category}_files" for category in QUOTA_CATEGORIES)
+        with self._connect() as conn:
+            conn.execute("DELETE FROM usage")
+            conn.executemany(f"INSERT INTO usage (file_id, {columns}) "
+                             f"VALUES ({', '.join('?' * (1 + 2 * len(QUOTA_CATEGORIES)))})", rows)
+
+    def usage_totals(self, user_id=None):
+        """
+        Disk usage summed over all conversions, or over one user's. Linked
+        pages are not included: they are counted in the cache's usage.
+
+        Returns:
+            dict of category -> (bytes, files)
+        """
+        sums = ", ".join(f"COALESCE(SUM({category}_bytes), 0), COALESCE(SUM({category}_files), 0)"
+                         for category in USAGE_CATEGORIES)
+        if user_id is None:
+            row = self._connect().execute(f"SELECT {sums} FROM usage").fetchone()
+        else:
+            row = self._connect().execute(
+                f"SELECT {sums} FROM usage JOIN conversions ON conversions.id = usage.file_id "
+                f"WHERE conversions.user_id = ?", (user_id,)
+            ).fetchone()
+        return {category: (row[2 * i], row[2 * i + 1]) for i, category in enumerate(USAGE_CATEGORIES)}
+
+    def get_meta(self, key, default=None):
+        row = self._connect().execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def set_meta(self, key, value):
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def import_status_files(self, status_folder, output_folder, image_extensions=('.png', '.jpg', '.webp')):
+        """
+        Import existing status/*.json files, counting each conversion's
+        images once so the history page no longer has to.
+
+        Returns:
+            Number of conversions imported
+        """
+        imported = 0
+        for status_file in os.listdir(status_folder):
+            if not status_file.endswith('.json'):
+                continue
+            try:
+                with open(os.path.join(status_folder, status_file), 'r') as f:
+                    status_data = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Error reading status file {status_file}: {str(e)}")
+                continue
+
+            status_data.setdefault('id', status_file[:-len('.json')])
+            output_dir = os.path.join(output_folder, status_data['id'])
+            if 'image_count' not in status_data and os.path.isdir(output_dir):
+                images = sorted(f for f in os.listdir(output_dir) if f.endswith(image_extensions))
+                status_data['image_count'] = len(images)
+                status_data['thumbnail'] = images[0] if images else None
+
+            self.upsert(status_data)
+            imported += 1
+
+        self.set_meta('status_files_imported', imported)
+        return imported
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Manage the conversion metadata store")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    importer = subparsers.add_parser("import", help="Import status/*.json files")
+    importer.add_argument("--status-folder", default="status", help="Folder with status JSON files")
+    importer.add_argument("--output-folder", default="output", help="Folder with conversion outputs")
+    importer.add_argument("--database", help="SQLite file (default: <status-folder>/conversions.db)")
+    args = parser.parse_args()
+
+    store = ConversionStore(args.database or os.path.join(args.status_folder, 'conversions.db'))
+    count = store.import_status_files(args.status_folder, args.output_folder)
+    print(f"Imported {count} conversions")
+
+
+if __name__ == "__main__":
+    main()
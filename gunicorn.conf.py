@@ -0,0 +1,23 @@
+"""
+Gunicorn hooks; gunicorn reads this file from the working directory.
+
+The storage is set up once before the workers start, by `python app.py
+init` in a child process, so the master never opens the database its
+workers are forked from. Each worker then starts its background services
+(job workers, retention, usage rescans, metrics) as soon as it has loaded
+the app, rather than on its first request.
+"""
+import os
+import sys
+import subprocess
+
+
+def on_starting(server):
+    subprocess.run([sys.executable, 'app.py', 'init'], check=True)
+    # Inherited by the workers, which then skip the setup
+    os.environ['PDF2IMG_STORAGE_READY'] = '1'
+
+
+def post_worker_init(worker):
+    import app
+    app.start_services()
@@ -0,0 +1,402 @@
+#!/usr/bin/env python3
+"""
+Job queue and worker pool for background PDF conversions, shared by all
+gunicorn worker processes.
+
+The queue is a table in the SQLite metadata database, so every process
+sees the same jobs: a job submitted in one process may run in any other,
+and queued jobs survive the process that queued them. Jobs are dispatched
+round-robin between users across the whole server, so one user uploading
+a large batch cannot starve everybody else, and at most `slots` jobs run
+at once.
+
+A worker thread claims a job in a transaction that moves it from pending
+to running and records the claiming process. Each process holds an
+exclusive flock on a lock file of its own for as long as it lives, which
+the kernel releases however the process dies. Every `sweep_interval`
+seconds the workers requeue the running jobs of processes whose lock is
+free, so the jobs of a crashed or killed gunicorn worker run again
+without restarting the server.
+"""
+import os
+import json
+import time
+import uuid
+import fcntl
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    user_id TEXT NOT NULL DEFAULT '',
+    args TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'pending',
+    submitted REAL NOT NULL,
+    claimed_by TEXT,
+    claimed_at REAL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_state ON jobs (state, seq);
+CREATE TABLE IF NOT EXISTS job_users (
+    user_id TEXT PRIMARY KEY,
+    last_dispatched REAL NOT NULL
+);
+"""
+
+# Prefix of the lock files held by live processes, in lock_dir
+HOLDER_PREFIX = '.worker-'
+
+
+class QueueFull(Exception):
+    """Raised when a job is rejected by admission control."""
+
+
+class JobQueue:
+    """
+    Worker pool with server-wide fair queuing and cancellation.
+
+    Args:
+        runner: Callable invoked as runner(job_id, *args) for each job;
+            args must be JSON-serializable
+        db_path: SQLite database holding the queue
+        lock_dir: Directory of the lock files that tell live processes from dead ones
+        num_workers: Number of worker threads in this process
+        max_pending: Maximum number of queued jobs on the server
+        max_pending_per_user: Maximum number of queued jobs per user (None for no limit)
+        slots: Number of jobs allowed to run at once across all processes (None for no limit)
+        poll_interval: Seconds an idle worker waits before looking for jobs
+            queued by other processes
+        sweep_interval: Seconds between checks for jobs of dead processes
+        on_change: Optional callback invoked with the ordered list of queued
+            job IDs whenever this process changes the queue
+        on_requeue: Optional callback invoked as on_requeue(job_id, *args)
+            for each job of a dead process, before it is queued again
+    """
+
+    def __init__(self, runner, db_path, lock_dir, num_workers=1, max_pending=20, max_pending_per_user=None,
+                 slots=None, poll_interval=1.0, sweep_interval=10.0, on_change=None, on_requeue=None):
+        self.runner = runner
+        self.db_path = db_path
+        self.lock_dir = lock_dir
+        self.num_workers = max(1, int(num_workers))
+        self.max_pending = max_pending
+        self.max_pending_per_user = max_pending_per_user
+        self.slots = max(1, int(slots)) if slots else None
+        self.poll_interval = poll_interval
+        self.sweep_interval = sweep_interval
+        self.on_change = on_change
+        self.on_requeue = on_requeue
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._running = set()  # job IDs running in this process
+        self._workers = []
+        self._workers_pid = None
+        self._holder = None
+        self._holder_handle = None
+        self._holder_pid = None
+        self._holder_lock = threading.Lock()
+        self._last_sweep = 0.0
+        self._schema_ready = False
+
+    def _connect(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            # Autocommit: transactions are opened explicitly with BEGIN IMMEDIATE
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            if not self._schema_ready:
+                conn.executescript(SCHEMA)
+                self._schema_ready = True
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    @contextmanager
+    def _transaction(self):
+        """Write transaction; BEGIN IMMEDIATE takes the write lock up front, so reads in it are not stale"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def _holder_path(self, holder):
+        return os.path.join(self.lock_dir, f"{HOLDER_PREFIX}{holder}.lock")
+
+    def _register(self):
+        """Take this process's lock file, once per process, and return its holder name"""
+        # Worker threads start together: a second lock would replace the first, whose
+        # handle is then closed and its jobs look orphaned to the next sweep
+        with self._holder_lock:
+            if self._holder is not None and self._holder_pid == os.getpid():
+                return self._holder
+            holder = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            os.makedirs(self.lock_dir, exist_ok=True)
+            path = self._holder_path(holder)
+            # Locked before it is renamed into place, so a sweep never finds it unlocked
+            handle = open(f"{path}.tmp", 'a')
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.replace(f"{path}.tmp", path)
+            self._holder, self._holder_handle, self._holder_pid = holder, handle, os.getpid()
+            return holder
+
+    def _holder_alive(self, holder):
+        try:
+            handle = open(self._holder_path(holder), 'r')
+        except OSError:
+            return False
+        try:
+            # Non-blocking so gevent/greenlet workers are never stuck in flock
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            handle.close()
+        return False
+
+    def start(self):
+        """Start this process's worker threads, if they are not running yet."""
+        # Started lazily so importing the app never spawns threads (e.g. before gunicorn forks)
+        with self._cond:
+            if self._workers_pid != os.getpid():
+                self._workers, self._workers_pid = [], os.getpid()
+            while len(self._workers) < self.num_workers:
+                worker = threading.Thread(target=self._work, name=f"job-worker-{len(self._workers)}")
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+
+    def _pending_order(self, conn=None):
+        """Job IDs in the order they will be dispatched (round-robin over users)."""
+        conn = conn or self._connect()
+        rows = conn.execute(
+            "SELECT j.id, j.user_id, u.last_dispatched FROM jobs j LEFT JOIN job_users u ON u.user_id = j.user_id "
+            "WHERE j.state = 'pending' ORDER BY COALESCE(u.last_dispatched, 0), j.seq"
+        ).fetchall()
+        queues = OrderedDict()
+        for job_id, user_id, _ in rows:
+            queues.setdefault(user_id, []).append(job_id)
+        queues = list(queues.values())
+        order = []
+        depth = 0
+        while True:
+            row = [q[depth] for q in queues if depth < len(q)]
+            if not row:
+                return order
+            order.extend(row)
+            depth += 1
+
+    def _notify_change(self):
+        if self.on_change is None:
+            return
+        try:
+            self.on_change(self._pending_order())
+        except Exception as e:
+            print(f"Error publishing queue positions: {str(e)}")
+
+    def submit(self, job_id, user_id, *args, force=False):
+        """
+        Queue a job. A job whose ID is already queued or running is left as it is.
+
+        Args:
+            force: Skip admission control (used when recovering persisted jobs)
+
+        Returns:
+            1-based queue position of the job, or None if it is already running
+
+        Raises:
+            QueueFull: if the queue or the user's share of it is full
+        """
+        user_id = '' if user_id is None else str(user_id)
+        with self._transaction() as conn:
+            if not force:
+                pending = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending'").fetchone()[0]
+                if self.max_pending is not None and pending >= self.max_pending:
+                    raise QueueFull("Server is busy, please try again later")
+                if self.max_pending_per_user is not None:
+                    mine = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'pending' AND user_id = ?",
+                                        (user_id,)).fetchone()[0]
+                    if mine >= self.max_pending_per_user:
+                        raise QueueFull("Too many queued conversions for this user")
+            conn.execute("INSERT OR IGNORE INTO jobs (id, user_id, args, submitted) VALUES (?, ?, ?, ?)",
+                         (job_id, user_id, json.dumps(args), time.time()))
+            order = self._pending_order(conn)
+        with self._cond:
+            self._cond.notify()
+        self._notify_change()
+        return order.index(job_id) + 1 if job_id in order else None
+
+    def cancel(self, job_id):
+        """
+        Cancel a job, wherever it is queued or running.
+
+        Returns:
+            'queued' if the job was removed from the queue, 'running' if it was
+            flagged for cancellation, or None if there is no such job
+        """
+        with self._transaction() as conn:
+            row = conn.execute("SELECT state FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            if row[0] == 'pending':
+                conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+            else:
+                conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ?", (job_id,))
+        if row[0] != 'pending':
+            return 'running'
+        self._notify_change()
+        return 'queued'
+
+    def is_cancelled(self, job_id):
+        row = self._connect().execute("SELECT cancel_requested FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return bool(row and row[0])
+
+    def position(self, job_id):
+        """1-based queue position of a job, or None if it is not queued."""
+        order = self._pending_order()
+        return order.index(job_id) + 1 if job_id in order else None
+
+    def stats(self):
+        conn = self._connect()
+        counts = dict(conn.execute("SELECT state, COUNT(*) FROM jobs GROUP BY state").fetchall())
+        users = conn.execute("SELECT COUNT(DISTINCT user_id) FROM jobs WHERE state = 'pending'").fetchone()[0]
+        with self._cond:
+            running_here = len(self._running)
+        return {
+            'workers': self.num_workers,
+            'slots': self.slots,
+            'running': counts.get('running', 0),
+            'running_here': running_here,
+            'pending': counts.get('pending', 0),
+            'users_waiting': users,
+            'max_pending': self.max_pending,
+        }
+
+    def _claim(self):
+        """
+        Take the next job if a slot is free: the oldest job of the user
+        served least recently, who then goes to the back of the line.
+
+        Returns:
+            (job_id, args), or None if there is nothing to run
+        """
+        holder = self._register()
+        with self._transaction() as conn:
+            if self.slots is not None:
+                running = conn.execute("SELECT COUNT(*) FROM jobs WHERE state = 'running'").fetchone()[0]
+                if running >= self.slots:
+                    return None
+            row = conn.execute(
+                "SELECT j.seq, j.id, j.user_id, j.args FROM jobs j LEFT JOIN job_users u ON u.user_id = j.user_id "
+                "WHERE j.state = 'pending' ORDER BY COALESCE(u.last_dispatched, 0), j.seq LIMIT 1"
+            ).fetchone()
+            if row is None:
+                return None
+            seq, job_id, user_id, args = row
+            now = time.time()
+            claimed = conn.execute(
+                "UPDATE jobs SET state = 'running', claimed_by = ?, claimed_at = ? WHERE seq = ? AND state = 'pending'",
+                (holder, now, seq)
+            ).rowcount
+            if claimed != 1:
+                return None
+            conn.execute(
+                "INSERT INTO job_users (user_id, last_dispatched) VALUES (?, ?) "
+                "ON CONFLICT (user_id) DO UPDATE SET last_dispatched = excluded.last_dispatched",
+                (user_id, now)
+            )
+        return job_id, json.loads(args)
+
+    def _finish(self, job_id):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM jobs WHERE id = ? AND claimed_by = ?", (job_id, self._holder))
+
+    def sweep(self):
+        """
+        Queue the running jobs of dead processes again, and remove their lock files.
+
+        Returns:
+            Number of jobs queued again
+        """
+        holder = self._register()
+        self._last_sweep = time.time()
+        for name in os.listdir(self.lock_dir):
+            if not name.startswith(HOLDER_PREFIX) or not name.endswith('.lock'):
+                continue
+            other = name[len(HOLDER_PREFIX):-len('.lock')]
+            if other != holder and not self._holder_alive(other):
+                for path in (self._holder_path(other), f"{self._holder_path(other)}.tmp"):
+                    try:
+                        os.remove(path)
+                    except FileNotFoundError:
+                        pass
+
+        conn = self._connect()
+        holders = [row[0] for row in conn.execute(
+            "SELECT DISTINCT claimed_by FROM jobs WHERE state = 'running' AND claimed_by != ?", (holder,))]
+        requeued = 0
+        for dead in holders:
+            if self._holder_alive(dead):
+                continue
+            jobs = conn.execute("SELECT id, args FROM jobs WHERE state = 'running' AND claimed_by = ?",
+                                (dead,)).fetchall()
+            # Reset the jobs' own records while they are still marked running, so
+            # no worker picks one up before it is ready to run again
+            for job_id, args in jobs:
+                print(f"Requeueing job {job_id} of stopped worker {dead}")
+                if self.on_requeue is not None:
+                    try:
+                        self.on_requeue(job_id, *json.loads(args))
+                    except Exception as e:
+                        print(f"Error requeueing job {job_id}: {str(e)}")
+            with self._transaction() as conn:
+                requeued += conn.execute(
+                    "UPDATE jobs SET state = 'pending', claimed_by = NULL, claimed_at = NULL "
+                    "WHERE state = 'running' AND claimed_by = ?", (dead,)
+                ).rowcount
+        if requeued:
+            with self._cond:
+                self._cond.notify_all()
+            self._notify_change()
+        return requeued
+
+    def _work(self):
+        while True:
+            try:
+                if time.time() - self._last_sweep >= self.sweep_interval:
+                    self.sweep()
+                job = self._claim()
+            except (sqlite3.Error, OSError) as e:
+                print(f"Error reading the job queue: {str(e)}")
+                job = None
+            if job is None:
+                with self._cond:
+                    self._cond.wait(self.poll_interval)
+                continue
+
+            job_id, args = job
+            with self._cond:
+                self._running.add(job_id)
+            self._notify_change()
+            try:
+                self.runner(job_id, *args)
+            except Exception as e:
+                print(f"Error running job {job_id}: {str(e)}")
+            finally:
+                try:
+                    self._finish(job_id)
+                except sqlite3.Error as e:
+                    print(f"Error finishing job {job_id}: {str(e)}")
+                with self._cond:
+                    self._running.discard(job_id)
+                    # A slot is free
+                    self._cond.notify_all()
@@ -0,0 +1,304 @@
+#!/usr/bin/env python3
+"""
+Counters, gauges and histograms exported in the Prometheus text format.
+
+Each process (gunicorn worker) updates its metrics in memory, which costs
+a lock and a dict update, and a background thread writes them to a file
+of its own in `directory` every `flush_interval` seconds. A scrape of
+/metrics, served by any one of the workers, merges the files of all of
+them: counters and histograms are summed, gauges are summed over the
+processes that are still alive. The files of processes that have exited
+are folded into an archive file, so counters never go backwards when a
+worker is restarted.
+
+A process's file is named after its PID and a random suffix, and the
+process holds a lock file of the same name for as long as it runs. A
+file whose lock is free belongs to an exited process, even one from an
+earlier container boot whose PID has since been reused.
+"""
+import os
+import json
+import time
+import fcntl
+import uuid
+import bisect
+import threading
+
+# Upper bounds of the default histogram buckets, in seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+ARCHIVE_NAME = 'archive.json'
+
+
+def _format_labels(labelnames, values, extra=()):
+    pairs = list(zip(labelnames, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class Metrics:
+    """
+    Registry of the metrics of one process, shared with the others through `directory`.
+
+    Args:
+        directory: Directory of the per-process metric files
+        flush_interval: Seconds between writes of this process's file
+    """
+
+    def __init__(self, directory, flush_interval=5.0):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._definitions = {}  # name -> (type, help, labelnames, buckets)
+        self._values = {}  # name -> {label values: number, or [bucket counts..., sum, count]}
+        self._lock = threading.Lock()
+        self._dirty = False
+        self._thread = None
+        self._start_lock = threading.Lock()
+        self._name = None
+        self._name_pid = None
+        self._name_handle = None
+        self._name_lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _define(self, kind, name, help_text, labelnames=(), buckets=None):
+        self._definitions[name] = (kind, help_text, tuple(labelnames), tuple(buckets) if buckets else None)
+        self._values.setdefault(name, {})
+
+    def counter(self, name, help_text, labelnames=()):
+        self._define('counter', name, help_text, labelnames)
+
+    def gauge(self, name, help_text, labelnames=()):
+        self._define('gauge', name, help_text, labelnames)
+
+    def histogram(self, name, help_text, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self._define('histogram', name, help_text, labelnames, buckets)
+
+    def _key(self, name, labels):
+        return tuple(str(labels.get(label, '')) for label in self._definitions[name][2])
+
+    def inc(self, name, amount=1, **labels):
+        """Add `amount` to a counter or gauge"""
+        key = self._key(name, labels)
+        with self._lock:
+            values = self._values[name]
+            values[key] = values.get(key, 0) + amount
+            self._dirty = True
+
+    def dec(self, name, amount=1, **labels):
+        self.inc(name, -amount, **labels)
+
+    def set(self, name, value, **labels):
+        """Set a gauge"""
+        key = self._key(name, labels)
+        with self._lock:
+            self._values[name][key] = value
+            self._dirty = True
+
+    def observe(self, name, value, **labels):
+        """Record one observation in a histogram"""
+        buckets = self._definitions[name][3]
+        key = self._key(name, labels)
+        with self._lock:
+            values = self._values[name]
+            state = values.get(key)
+            if state is None:
+                state = values[key] = [0] * (len(buckets) + 1) + [0.0, 0]
+            # Per-bucket counts; made cumulative when rendered
+            state[bisect.bisect_left(buckets, value)] += 1
+            state[-2] += value
+            state[-1] += 1
+            self._dirty = True
+
+    def start(self):
+        """Start the background flush thread, once per process"""
+        # Started lazily so importing the app never spawns threads (e.g. before gunicorn forks)
+        with self._start_lock:
+            if self._thread is None:
+                os.makedirs(self.directory, exist_ok=True)
+                # Fold in the files left by earlier boots before they are read
+                self._archive_dead()
+                self._thread = threading.Thread(target=self._run, name="metrics-flush", daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error writing metrics: {str(e)}")
+
+    def _register(self):
+        """Take this process's lock file, once per process, and return the name of its files"""
+        # A scrape flushes too: a second name racing the flush thread would leave
+        # the first one's file unlocked, to be archived while its counts live on
+        with self._name_lock:
+            if self._name is not None and self._name_pid == os.getpid():
+                return self._name
+            name = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+            lock_path = os.path.join(self.directory, f"{name}.lock")
+            # Locked before it is renamed into place, so _archive_dead never finds it unlocked
+            handle = open(f"{lock_path}.tmp", 'a')
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.replace(f"{lock_path}.tmp", lock_path)
+            self._name, self._name_handle, self._name_pid = name, handle, os.getpid()
+            return name
+
+    def _alive(self, name):
+        """Whether the process that writes the file `name`.json still runs"""
+        try:
+            handle = open(os.path.join(self.directory, f"{name}.lock"), 'r')
+        except OSError:
+            # Written before the lock files, or its lock was removed with it
+            return False
+        try:
+            # Non-blocking so gevent/greenlet workers are never stuck in flock
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            return True
+        finally:
+            handle.close()
+        return False
+
+    def _snapshot(self):
+        with self._lock:
+            self._dirty = False
+            return {name: [[list(key), value if not isinstance(value, list) else list(value)]
+                           for key, value in values.items()]
+                    for name, values in self._values.items()}
+
+    def flush(self, force=False):
+        """Write this process's metrics to its file, if they changed"""
+        if not (self._dirty or force):
+            return
+        path = os.path.join(self.directory, f"{self._register()}.json")
+        tmp_path = f"{path}.tmp"
+        # The flush thread and scrapes write the same temporary file
+        with self._flush_lock:
+            with open(tmp_path, 'w') as f:
+                json.dump({'pid': os.getpid(), 'metrics': self._snapshot()}, f)
+            os.replace(tmp_path, path)
+
+    def _merge(self, merged, metrics, gauges=True):
+        for name, entries in metrics.items():
+            definition = self._definitions.get(name)
+            if definition is None or (definition[0] == 'gauge' and not gauges):
+                continue
+            values = merged.setdefault(name, {})
+            for key, value in entries:
+                key = tuple(key)
+                if isinstance(value, list):
+                    current = values.get(key)
+                    if current is None or len(current) != len(value):
+                        values[key] = list(value)
+                    else:
+                        values[key] = [a + b for a, b in zip(current, value)]
+                else:
+                    values[key] = values.get(key, 0) + value
+
+    def _archive_dead(self):
+        """Fold the files of exited processes into the archive"""
+        with open(os.path.join(self.directory, '.archive.lock'), 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                # Another worker is archiving or reading; try again on the next scrape
+                return
+            try:
+                dead = []
+                for name in os.listdir(self.directory):
+                    if not name.endswith('.json') or name == ARCHIVE_NAME:
+                        continue
+                    if not self._alive(name[:-len('.json')]):
+                        dead.append(name)
+                if not dead:
+                    return
+                archive_path = os.path.join(self.directory, ARCHIVE_NAME)
+                archived = {}
+                if os.path.exists(archive_path):
+                    with open(archive_path) as f:
+                        self._merge(archived, json.load(f)['metrics'])
+                for name in dead:
+                    try:
+                        with open(os.path.join(self.directory, name)) as f:
+                            # Gauges of an exited process no longer hold
+                            self._merge(archived, json.load(f)['metrics'], gauges=False)
+                    except (OSError, ValueError):
+                        continue
+                tmp_path = f"{archive_path}.tmp"
+                with open(tmp_path, 'w') as f:
+                    json.dump({'metrics': {name: [[list(key), value] for key, value in values.items()]
+                                           for name, values in archived.items()}}, f)
+                os.replace(tmp_path, archive_path)
+                for name in dead:
+                    os.remove(os.path.join(self.directory, name))
+                    try:
+                        os.remove(os.path.join(self.directory, f"{name[:-len('.json')]}.lock"))
+                    except FileNotFoundError:
+                        pass
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def collect(self):
+        """Metrics of all processes, merged: name -> {label values: value}"""
+        self.flush(force=True)
+        self._archive_dead()
+        merged = {}
+        with open(os.path.join(self.directory, '.archive.lock'), 'a') as lock:
+            # Shared, so a file is never counted both on its own and in the archive
+            while True:
+                try:
+                    fcntl.flock(lock, fcntl.LOCK_SH | fcntl.LOCK_NB)
+                    break
+                except OSError:
+                    # Non-blocking so gevent workers are never stuck in flock
+                    time.sleep(0.01)
+            try:
+                for name in os.listdir(self.directory):
+                    if not name.endswith('.json'):
+                        continue
+                    try:
+                        with open(os.path.join(self.directory, name)) as f:
+                            self._merge(merged, json.load(f)['metrics'])
+                    except (OSError, ValueError):
+                        continue
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+        return merged
+
+    def render(self, overrides=None):
+        """
+        All metrics in the Prometheus text exposition format.
+
+        Args:
+            overrides: Optional dict of unlabelled gauge name -> value, for
+                gauges read from state shared by all processes, which must
+                not be summed over them
+        """
+        merged = self.collect()
+        for name, value in (overrides or {}).items():
+            merged[name] = {(): value}
+        lines = []
+        for name, (kind, help_text, labelnames, buckets) in self._definitions.items():
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, value in sorted(merged.get(name, {}).items()):
+                if kind != 'histogram':
+                    lines.append(f"{name}{_format_labels(labelnames, key)} {_format_value(value)}")
+                    continue
+                cumulative = 0
+                for bound, count in zip(buckets + (float('inf'),), value[:-2]):
+                    cumulative += count
+                    le = _format_value(bound) if bound != float('inf') else '+Inf'
+                    lines.append(f"{name}_bucket{_format_labels(labelnames, key, [('le', le)])} {cumulative}")
+                lines.append(f"{name}_sum{_format_labels(labelnames, key)} {value[-2]!r}")
+                lines.append(f"{name}_count{_format_labels(labelnames, key)} {value[-1]}")
+        return '\n'.join(lines) + '\n'
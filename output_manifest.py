@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Content ETags of a finished conversion's files.
+
+The outputs of a conversion never change once it has completed, so each
+file gets a strong ETag derived from its SHA-256 when the job finishes.
+The ETags are stored in a manifest in the output directory (hidden, so it
+is not archived or cached), which lets a download be answered with 304
+Not Modified, or served with long-lived cache headers, without hashing or
+even opening the file.
+"""
+import os
+import json
+import hashlib
+
+MANIFEST_NAME = '.manifest.json'
+
+# Bytes read from a file at a time while hashing it
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# Hex digits of the SHA-256 kept in an ETag
+ETAG_LENGTH = 32
+
+
+def file_etag(path):
+    """Strong ETag (without quotes) of a file's content"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(HASH_CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()[:ETAG_LENGTH]
+
+
+def build_manifest(output_dir, subdirs=()):
+    """
+    Hash the files of `output_dir` (and of its `subdirs`) into its manifest.
+
+    Hidden files are skipped. Files in a subdirectory are keyed by their
+    path relative to `output_dir`, with forward slashes.
+
+    Returns:
+        dict of relative path -> ETag
+    """
+    etags = {}
+    for subdir in ('',) + tuple(subdirs):
+        directory = os.path.join(output_dir, subdir)
+        if not os.path.isdir(directory):
+            continue
+        for entry in os.scandir(directory):
+            if entry.name.startswith('.') or not entry.is_file():
+                continue
+            key = f"{subdir}/{entry.name}" if subdir else entry.name
+            etags[key] = file_etag(entry.path)
+
+    path = os.path.join(output_dir, MANIFEST_NAME)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump({'etags': etags}, f)
+    os.replace(tmp_path, path)
+    return etags
+
+
+def load_manifest(output_dir):
+    """ETags of a conversion's files, or None if it has no manifest"""
+    try:
+        with open(os.path.join(output_dir, MANIFEST_NAME)) as f:
+            return json.load(f)['etags']
+    except (OSError, ValueError, KeyError):
+        return None
@@ -1,76 +1,198 @@
 #!/usr/bin/env python3
 import os
+import re
+import time
+import queue
+import shutil
+import tempfile
 import argparse
+import tracemalloc
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
 import numpy as np
 import cv2
-from pdf2image import convert_from_path
-from PIL import Image
+from renderers import RENDERERS, RENDERER_PREFERENCE, get_renderer
+from profiling import PROFILE_DIR, profile_conversion, load_summary, format_summary
+from batch import MANIFEST_NAME, EXTRACT_DIR, BatchManifest, collect_inputs
 
+# Number of pages rendered per pdftoppm call; bounds peak memory per job
+DEFAULT_CHUNK_SIZE = 4
 
-def deskew_image(image, force_rotate=None):
+
+# Longest side of the downscaled copy used to estimate skew
+DESKEW_MAX_DIM = 2048
+
+# Pages skewed by less than this many degrees are left untouched
+DESKEW_MIN_ANGLE = 0.1
+
+# Forced rotations (counterclockwise degrees, as for cv2.getRotationMatrix2D)
+# mapped to lossless cv2.rotate transposes
+FORCED_ROTATIONS = {
+    90: cv2.ROTATE_90_COUNTERCLOCKWISE,
+    180: cv2.ROTATE_180,
+    270: cv2.ROTATE_90_CLOCKWISE,
+}
+
+
+# Output formats and the file extension each one is written with
+OUTPUT_FORMATS = {
+    'png': '.png',
+    'jpeg': '.jpg',
+    'webp': '.webp',
+}
+COLOR_MODES = ('auto', 'rgb', 'gray', 'bitonal')
+
+DEFAULT_OUTPUT_FORMAT = 'png'
+# zlib level 3 is about as fast as level 1 and noticeably smaller on page scans
+DEFAULT_PNG_COMPRESSION = 3
+DEFAULT_QUALITY = 90
+DEFAULT_COLOR_MODE = 'rgb'
+
+# 'auto' color mode: pages are probed at this DPI, and a page is colorless
+# when at most AUTO_COLOR_RATIO of its pixels have a chroma (largest minus
+# smallest channel) above AUTO_CHROMA_THRESHOLD
+AUTO_PROBE_DPI = 36
+AUTO_CHROMA_THRESHOLD = 32
+AUTO_COLOR_RATIO = 0.001
+
+# Seconds process_pdf waits for a page from its workers before polling cancel_check again
+PAGE_POLL_INTERVAL = 0.5
+
+# Per-page pipeline stages timed in progress reports
+PIPELINE_STAGES = ('render', 'deskew', 'crop', 'split', 'encode', 'write', 'preview')
+
+# Widths of the WebP renditions written to PREVIEW_DIR next to each page,
+# smallest (the thumbnail) first
+PREVIEW_WIDTHS = (320, 640, 1280)
+PREVIEW_DIR = 'previews'
+PREVIEW_QUALITY = 80
+
+
+class ConversionCancelled(Exception):
+    """Raised by process_pdf when its cancel_check asks it to stop."""
+
+
+class FrameBuffers:
+    """
+    Full-size scratch arrays reused from page to page.
+    
+    Pages of one document almost always share a size, so the deskew and
+    color conversion outputs are allocated once per window of pages
+    instead of once per page. A buffer is only valid until the next
+    page asks for the same role.
+    """
+    
+    def __init__(self):
+        self._arrays = {}
+    
+    def get(self, role, shape, dtype=np.uint8):
+        """Scratch array for `role` with the given shape, reallocated only when the shape changes"""
+        array = self._arrays.get(role)
+        if array is None or array.shape != tuple(shape) or array.dtype != dtype:
+            array = np.empty(shape, dtype=dtype)
+            self._arrays[role] = array
+        return array
+
+
+def _buffer(buffers, role, shape):
+    return buffers.get(role, shape) if buffers is not None else None
+
+
+def deskew_image(image, force_rotate=None, buffers=None):
     """
     Correct the skew in an image.
     
     Args:
         image: numpy array of the image
         force_rotate: Force rotation angle (0, 90, 180, 270) or None for auto-detect
+        buffers: Optional FrameBuffers to write the result into instead of
+            allocating a new array
         
     Returns:
-        Deskewed image as numpy array
+        Deskewed image as numpy array (`image` itself when it needs no change)
     """
-    # If force rotation is specified, apply it directly
+    # If force rotation is specified, apply it as an exact pixel transpose
     if force_rotate is not None:
-        (h, w) = image.shape[:2]
-        center = (w // 2, h // 2)
-        
-        if force_rotate == 90:
-            M = cv2.getRotationMatrix2D(center, 90, 1.0)
-            rotated = cv2.warpAffine(image, M, (h, w), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-            return rotated
-        elif force_rotate == 180:
-            M = cv2.getRotationMatrix2D(center, 180, 1.0)
-            rotated = cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-            return rotated
-        elif force_rotate == 270:
-            M = cv2.getRotationMatrix2D(center, 270, 1.0)
-            rotated = cv2.warpAffine(image, M, (h, w), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
-            return rotated
-        else:
+        rotate_code = FORCED_ROTATIONS.get(force_rotate)
+        if rotate_code is None:
             # 0 degrees or invalid value, return original
             return image
+        shape = image.shape if force_rotate == 180 else (image.shape[1], image.shape[0]) + image.shape[2:]
+        return cv2.rotate(image, rotate_code, dst=_buffer(buffers, 'deskew', shape))
+    
+    # Auto-detect skew on a downscaled copy, then warp the full image once
+    angle = estimate_skew_angle(image)
     
-    # Auto-detect rotation and skew
+    # Already straight: skip the full-resolution warp entirely
+    if abs(angle) < DESKEW_MIN_ANGLE:
+        return image
+    
+    # Rotate the image
+    (h, w) = image.shape[:2]
+    center = (w // 2, h // 2)
+    M = cv2.getRotationMatrix2D(center, angle, 1.0)
+    rotated = cv2.warpAffine(image, M, (w, h), dst=_buffer(buffers, 'deskew', image.shape),
+                             flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    
+    return rotated
+
+
+def estimate_skew_angle(image, max_dim=DESKEW_MAX_DIM):
+    """
+    Estimate the skew angle of a page.
+    
+    The page is downscaled by an integer factor so its longest side is at
+    most `max_dim` pixels, and only the leftmost and rightmost foreground
+    pixel of each row is passed to cv2.minAreaRect. Those points have the
+    same convex hull as the full foreground, so the result matches a fit
+    over every pixel while the cost no longer grows with the DPI.
+    
+    Args:
+        image: numpy array of the image (grayscale or 3-channel)
+        max_dim: Longest side of the downscaled copy, in pixels
+        
+    Returns:
+        Rotation in degrees (counterclockwise, as for cv2.getRotationMatrix2D)
+        that straightens the page, in the range [-45, 45)
+    """
     # Convert to grayscale
     if len(image.shape) == 3:
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
     else:
-        gray = image.copy()
+        gray = image
     
-    # Threshold the image
-    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1]
+    # Downscale by an integer factor (much faster than an arbitrary ratio)
+    (h, w) = gray.shape[:2]
+    factor = max(1, -(-max(h, w) // max_dim))
+    if factor > 1:
+        gray = cv2.resize(gray, (max(1, w // factor), max(1, h // factor)),
+                          interpolation=cv2.INTER_LINEAR)
     
-    # Find contours
-    coords = np.column_stack(np.where(thresh > 0))
+    # Threshold the image
+    thresh = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)[1] > 0
     
-    # Get rotated rectangle
-    if len(coords) == 0:
-        return image  # No text found, return original
+    rows = np.flatnonzero(thresh.any(axis=1))
+    if len(rows) == 0:
+        return 0.0  # No text found
     
-    angle = cv2.minAreaRect(coords)[-1]
+    # Leftmost and rightmost foreground pixel of each row, as (x, y) points
+    foreground = thresh[rows]
+    points = np.empty((2 * len(rows), 2), dtype=np.int32)
+    points[0::2, 0] = foreground.argmax(axis=1)
+    points[1::2, 0] = foreground.shape[1] - 1 - foreground[:, ::-1].argmax(axis=1)
+    points[0::2, 1] = rows
+    points[1::2, 1] = rows
     
-    # Adjust angle
-    if angle < -45:
-        angle = -(90 + angle)
-    else:
-        angle = -angle
+    angle = cv2.minAreaRect(points)[-1]
     
-    # Rotate the image
-    (h, w) = image.shape[:2]
-    center = (w // 2, h // 2)
-    M = cv2.getRotationMatrix2D(center, angle, 1.0)
-    rotated = cv2.warpAffine(image, M, (w, h), flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE)
+    # minAreaRect reports angles in [-90, 0) or (0, 90] depending on the
+    # OpenCV version; fold into [-45, 45)
+    while angle >= 45:
+        angle -= 90
+    while angle < -45:
+        angle += 90
     
-    return rotated
+    return angle
 
 
 def check_orientation(image):
@@ -87,10 +209,571 @@ def check_orientation(image):
     return 0
 
 
-def process_pdf(pdf_path, output_dir, dpi=300, split_pages=False, rotation=None, crop_margin=0):
+def get_page_count(pdf_path, renderer=None):
+    """
+    Get the number of pages in a PDF without rendering it.
+    
+    Args:
+        pdf_path: Path to the PDF file
+        renderer: Rendering backend whose parser reads the document (see
+            iter_rendered_pages)
+        
+    Returns:
+        Page count as an int
+    """
+    return get_renderer(renderer, pdf_path).page_count(pdf_path)
+
+
+# Bytes at the start of a linearized PDF that hold its linearization dictionary
+LINEARIZED_HEADER_SIZE = 1024
+
+_LINEARIZED_DICT = re.compile(rb'<<\s*/Linearized\b(.*?)>>', re.S)
+
+
+def linearized_page_count(head, file_size):
+    """
+    Get the number of pages of a linearized ("fast web view") PDF from its
+    first bytes, before the rest of the file is available.
+    
+    Args:
+        head: The first LINEARIZED_HEADER_SIZE bytes of the file
+        file_size: Size of the whole file, to check the linearization
+            dictionary still describes it
+        
+    Returns:
+        Page count as an int, or None if the file is not linearized or was
+        changed after it was linearized
+    """
+    match = _LINEARIZED_DICT.search(head[:LINEARIZED_HEADER_SIZE])
+    if match is None:
+        return None
+    params = dict(re.findall(rb'/([A-Za-z]+)\s+(\d+)', match.group(1)))
+    # An incremental update appends to the file, so /L no longer matches its size
+    if b'N' not in params or int(params.get(b'L', -1)) != file_size:
+        return None
+    return int(params[b'N'])
+
+
+def parse_page_ranges(spec):
+    """
+    Parse a page range string such as "1-3,7,10-".
+    
+    Args:
+        spec: Comma-separated page numbers and ranges; "10-" runs to the
+            last page
+        
+    Returns:
+        List of (first_page, last_page) tuples, last_page None for open ranges
+        
+    Raises:
+        ValueError: if the string is not a valid page range
+    """
+    ranges = []
+    for part in spec.replace(' ', '').split(','):
+        if not part:
+            continue
+        first, sep, last = part.partition('-')
+        if not first.isdigit() or (last and not last.isdigit()):
+            raise ValueError(f"Invalid page range: {part}")
+        first = int(first)
+        last = int(last) if last else (None if sep else first)
+        if first < 1 or (last is not None and last < first):
+            raise ValueError(f"Invalid page range: {part}")
+        ranges.append((first, last))
+    if not ranges:
+        raise ValueError("No pages selected")
+    return ranges
+
+
+def select_pages(pages, total_pages):
+    """
+    Resolve a page selection against a document's page count.
+    
+    Args:
+        pages: None for all pages, a page range string (see
+            parse_page_ranges) or an iterable of page numbers
+        total_pages: Number of pages in the document
+        
+    Returns:
+        Sorted list of distinct 1-based page numbers; pages past the end
+        of the document are dropped
+    """
+    if pages is None:
+        return list(range(1, total_pages + 1))
+    if isinstance(pages, str):
+        selected = set()
+        for first, last in parse_page_ranges(pages):
+            selected.update(range(first, min(last or total_pages, total_pages) + 1))
+        return sorted(selected)
+    return sorted({int(page) for page in pages if 1 <= int(page) <= total_pages})
+
+
+def iter_rendered_pages(pdf_path, first_page, last_page, dpi=300, gray=False, renderer=None):
+    """
+    Render a window of pages and yield them as numpy arrays.
+    
+    Args:
+        gray: Render single-channel grayscale pages
+        renderer: Name of the backend in renderers.RENDERERS (default: the
+            one renderers.get_renderer picks for this document)
+        
+    Yields:
+        (page_num, image) for each page, image being an RGB array, or a
+        2-D grayscale array with `gray`. Each array is only valid until
+        the next page is requested.
+    """
+    yield from get_renderer(renderer, pdf_path).iter_pages(pdf_path, first_page, last_page, dpi=dpi, gray=gray)
+
+
+def is_colorless(image):
+    """Whether a rendered page has (next to) no color; see AUTO_CHROMA_THRESHOLD"""
+    if image.ndim == 2:
+        return True
+    chroma = image.max(axis=2) - image.min(axis=2)
+    return np.count_nonzero(chroma > AUTO_CHROMA_THRESHOLD) <= AUTO_COLOR_RATIO * chroma.size
+
+
+def probe_colorless_pages(pdf_path, first_page, last_page, renderer=None):
+    """
+    Find the pages of a window without color, for the 'auto' color mode.
+    
+    The pages are rendered at AUTO_PROBE_DPI, which costs a small fraction
+    of the full-resolution render.
+    
+    Returns:
+        dict of page number -> whether the page is colorless
+    """
+    return {page_num: is_colorless(image)
+            for page_num, image in iter_rendered_pages(pdf_path, first_page, last_page, dpi=AUTO_PROBE_DPI,
+                                                       renderer=renderer)}
+
+
+def iter_render_runs(pdf_path, first_page, last_page, color_mode=DEFAULT_COLOR_MODE, renderer=None):
+    """
+    Split a window into runs of consecutive pages rendered the same way.
+    
+    'gray' and 'bitonal' pages are rendered single-channel, so the whole
+    pipeline runs on a third of the data; bitonal pages are thresholded
+    when they are encoded, after deskewing. With 'auto', colorless pages
+    are rendered single-channel and written as grayscale, and pages with
+    color are rendered and written as RGB.
+    
+    Yields:
+        (first_page, last_page, gray, page_color_mode) for each run
+    """
+    if color_mode != 'auto':
+        yield first_page, last_page, color_mode in ('gray', 'bitonal'), color_mode
+        return
+    
+    colorless = probe_colorless_pages(pdf_path, first_page, last_page, renderer)
+    run_start = first_page
+    for page_num in range(first_page, last_page + 1):
+        gray = colorless.get(page_num, False)
+        if page_num == last_page or colorless.get(page_num + 1, False) != gray:
+            yield run_start, page_num, gray, 'gray' if gray else 'rgb'
+            run_start = page_num + 1
+
+
+def iter_page_windows(total_pages, chunk_size, pages=None):
+    """
+    Split a page count into consecutive (first_page, last_page) windows.
+    
+    Page numbers are 1-based and inclusive, matching pdftoppm's -f/-l options.
+    
+    Args:
+        pages: Optional sorted page numbers to cover instead of every page;
+            windows never span a gap in the selection
+    """
+    chunk_size = max(1, int(chunk_size))
+    if pages is None:
+        for first_page in range(1, total_pages + 1, chunk_size):
+            yield first_page, min(first_page + chunk_size - 1, total_pages)
+        return
+    
+    first_page = last_page = None
+    for page in pages:
+        if first_page is not None and page == last_page + 1 and page - first_page < chunk_size:
+            last_page = page
+            continue
+        if first_page is not None:
+            yield first_page, last_page
+        first_page = last_page = page
+    if first_page is not None:
+        yield first_page, last_page
+
+
+def encode_image(image, output_format=DEFAULT_OUTPUT_FORMAT, png_compression=DEFAULT_PNG_COMPRESSION,
+                 quality=DEFAULT_QUALITY, color_mode=DEFAULT_COLOR_MODE, buffers=None, role='encode'):
+    """
+    Encode a page with OpenCV's imencode.
+    
+    Args:
+        image: RGB or grayscale numpy array
+        output_format: One of OUTPUT_FORMATS ('png', 'jpeg', 'webp')
+        png_compression: zlib level for PNG, 0 (fastest) to 9 (smallest)
+        quality: Quality for JPEG and WebP, 1 to 100
+        color_mode: One of COLOR_MODES: 'rgb' keeps color, 'gray' writes
+            8-bit grayscale, 'bitonal' writes 1-bit black and white (Otsu).
+            'auto' writes the image as it is, like 'rgb' (the choice is made
+            when rendering, see iter_render_runs)
+        buffers: Optional FrameBuffers for the color-converted copy of the page
+        role: Buffer role, distinct for images that are encoded together
+        
+    Returns:
+        Encoded image as a 1-D uint8 numpy array
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"Unsupported output format: {output_format}")
+    if color_mode not in COLOR_MODES:
+        raise ValueError(f"Unsupported color mode: {color_mode}")
+    
+    if color_mode in ('gray', 'bitonal') and image.ndim == 3:
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2GRAY, dst=_buffer(buffers, role, image.shape[:2]))
+        if color_mode == 'bitonal':
+            # Threshold the converted copy in place
+            cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU, dst=image)
+    elif color_mode == 'bitonal':
+        image = cv2.threshold(image, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU,
+                              dst=_buffer(buffers, role, image.shape))[1]
+    elif image.ndim == 3:
+        # OpenCV encoders expect BGR
+        image = cv2.cvtColor(image, cv2.COLOR_RGB2BGR, dst=_buffer(buffers, role, image.shape))
+    
+    if output_format == 'png':
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+        if color_mode == 'bitonal':
+            params += [cv2.IMWRITE_PNG_BILEVEL, 1]
+    elif output_format == 'jpeg':
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(quality)]
+    else:
+        params = [cv2.IMWRITE_WEBP_QUALITY, int(quality)]
+    
+    ok, encoded = cv2.imencode(OUTPUT_FORMATS[output_format], image, params)
+    if not ok:
+        raise ValueError(f"Failed to encode image as {output_format}")
+    return encoded
+
+
+def _record_peak_memory(stats, stage):
+    """
+    While tracemalloc is tracing (see profiling.py), record the peak traced
+    memory since the previous stage as the peak of `stage` in `stats`.
+    """
+    if stats is not None and tracemalloc.is_tracing():
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+        memory = stats.setdefault('peak_memory', {})
+        memory[stage] = max(memory.get(stage, 0), peak)
+
+
+def _add_timing(stats, stage, start):
+    """Add the time since `start` (a perf_counter value) to a stage in `stats`."""
+    if stats is not None:
+        timings = stats.setdefault('timings', {})
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - start
+        _record_peak_memory(stats, stage)
+    return time.perf_counter()
+
+
+def save_image(image, path_base, stats=None, **encode_options):
+    """
+    Encode a page and write it to `path_base` plus the format's extension.
+    
+    Args:
+        stats: Optional dict that collects encode/write timings and bytes_written
+        encode_options: Keyword arguments for encode_image
+        
+    Returns:
+        Path of the written file
+    """
+    output_format = encode_options.get('output_format', DEFAULT_OUTPUT_FORMAT)
+    path = path_base + OUTPUT_FORMATS[output_format]
+    start = time.perf_counter()
+    encoded = encode_image(image, **encode_options)
+    start = _add_timing(stats, 'encode', start)
+    encoded.tofile(path)
+    _add_timing(stats, 'write', start)
+    if stats is not None:
+        stats['bytes_written'] = stats.get('bytes_written', 0) + encoded.nbytes
+    return path
+
+
+def preview_name(image_name, width):
+    """Filename of the `width` pixel preview of the page image `image_name`"""
+    return f"{os.path.splitext(image_name)[0]}_w{width}.webp"
+
+
+def save_previews(image, path, widths=PREVIEW_WIDTHS, color_mode=DEFAULT_COLOR_MODE, stats=None):
+    """
+    Write downscaled WebP renditions of a saved page into PREVIEW_DIR.
+    
+    The renditions are built as a pyramid from the in-memory page, largest
+    first, each one resized from the previous one. Pages narrower than a
+    width are written at their own size, so every width always exists.
+    
+    Args:
+        image: numpy array of the page as it was saved to `path`
+        path: Path of the saved full-resolution page
+        widths: Preview widths in pixels
+        color_mode: Color mode of the page; bitonal pages get grayscale previews
+        stats: Optional dict that collects the time spent in the 'preview' stage
+        
+    Returns:
+        List of paths of the written previews
+    """
+    start = time.perf_counter()
+    preview_dir = os.path.join(os.path.dirname(path), PREVIEW_DIR)
+    os.makedirs(preview_dir, exist_ok=True)
+    # Downscaled 1-bit pages are unreadable; antialiased gray is what a thumbnail needs
+    preview_mode = 'rgb' if color_mode in ('rgb', 'auto') else 'gray'
+    
+    written = []
+    level = image
+    for width in sorted(widths, reverse=True):
+        height, current_width = level.shape[:2]
+        if width < current_width:
+            size = (width, max(1, round(height * width / current_width)))
+            level = cv2.resize(level, size, interpolation=cv2.INTER_AREA)
+        preview_path = os.path.join(preview_dir, preview_name(os.path.basename(path), width))
+        encode_image(level, output_format='webp', quality=PREVIEW_QUALITY,
+                     color_mode=preview_mode).tofile(preview_path)
+        written.append(preview_path)
+    
+    _add_timing(stats, 'preview', start)
+    return written
+
+
+def process_page(img, page_num, output_dir, file_base, split_pages=False, rotation=None, crop_margin=0,
+                 encode_options=None, stats=None, preview_widths=(), buffers=None):
+    """
+    Deskew, crop, optionally split and save a single rendered page.
+    
+    Crop and split are views of the deskewed page, so with `buffers` a
+    page is processed without allocating any full-size arrays once the
+    buffers exist.
+    
+    Args:
+        img: numpy array (or PIL image) of the rendered page
+        page_num: 1-based page number, used in the output filename
+        output_dir: Directory to save output images
+        file_base: Filename prefix for the output images
+        split_pages: Whether to split double pages in half
+        rotation: Force specific rotation angle (0, 90, 180, 270)
+        crop_margin: Pixels to crop from edges to remove artifacts
+        encode_options: Keyword arguments for encode_image
+        stats: Optional dict that collects per-stage timings (seconds, keyed
+            by PIPELINE_STAGES) and bytes_written
+        preview_widths: Widths of the WebP previews to write next to each
+            saved image (see save_previews); empty for none
+        buffers: Optional FrameBuffers reused across pages
+        
+    Returns:
+        List of paths of the saved images
+    """
+    encode_options = encode_options or {}
+    start = time.perf_counter()
+    
+    # No copy when the page is already a numpy array
+    img_array = np.asarray(img)
+    
+    # Apply rotation if specified or detect orientation
+    if rotation is not None:
+        # Force specific rotation
+        deskewed = deskew_image(img_array, force_rotate=rotation, buffers=buffers)
+    else:
+        # Try to auto-detect and fix skew
+        deskewed = deskew_image(img_array, buffers=buffers)
+    start = _add_timing(stats, 'deskew', start)
+    
+    # Crop margins if specified to remove artifacts (a view, not a copy)
+    if crop_margin > 0:
+        height, width = deskewed.shape[:2]
+        deskewed = deskewed[crop_margin:height - crop_margin, crop_margin:width - crop_margin]
+    start = _add_timing(stats, 'crop', start)
+    
+    page_base = os.path.join(output_dir, f"{file_base}_page{page_num:04d}")
+    if split_pages:
+        # Split image in half (left and right pages)
+        width = deskewed.shape[1]
+        parts = [(deskewed[:, :width // 2], page_base + "_left"),
+                 (deskewed[:, width // 2:], page_base + "_right")]
+        _add_timing(stats, 'split', start)
+    else:
+        parts = [(deskewed, page_base)]
+    
+    saved = []
+    for index, (part, part_base) in enumerate(parts):
+        # Save with zero-padded page numbers
+        path = save_image(part, part_base, stats, buffers=buffers, role=f"encode{index}", **encode_options)
+        if preview_widths:
+            save_previews(part, path, preview_widths,
+                          encode_options.get('color_mode', DEFAULT_COLOR_MODE), stats)
+        saved.append(path)
+    
+    return saved
+
+
+def default_workers():
+    """
+    Number of worker processes used for a single job: half of the CPU cores
+    available to this process, and at least one.
+    """
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    return max(1, cores // 2)
+
+
+def iter_window_pages(pdf_path, first_page, last_page, output_dir, file_base, dpi=300,
+                      split_pages=False, rotation=None, crop_margin=0, encode_options=None,
+                      preview_widths=(), renderer=None):
+    """
+    Render one window of pages and process them one at a time.
+    
+    Args:
+        renderer: Name of the rendering backend (see iter_rendered_pages)
+        
+    Yields:
+        (page_num, saved_paths, stats) for each page, as soon as it has been
+        saved. stats holds the page's stage timings and bytes_written; the
+        first page of the window also carries pages_rendered for the window,
+        and each run's render time is shared evenly between its pages (see
+        iter_render_runs).
+    """
+    encode_options = encode_options or {}
+    buffers = FrameBuffers()
+    rendered = last_page - first_page + 1
+    
+    start = time.perf_counter()
+    runs = iter_render_runs(pdf_path, first_page, last_page,
+                            encode_options.get('color_mode', DEFAULT_COLOR_MODE), renderer)
+    for run_first, run_last, gray, color_mode in runs:
+        page_options = dict(encode_options, color_mode=color_mode)
+        
+        # Render only the current run of pages
+        pages = iter_rendered_pages(pdf_path, run_first, run_last, dpi=dpi, gray=gray, renderer=renderer)
+        render_time = None
+        for page_num, img in pages:
+            if render_time is None:
+                # The whole run is rendered (and probed) before its first page is yielded
+                render_time = (time.perf_counter() - start) / (run_last - run_first + 1)
+            stats = {'timings': {'render': render_time}, 'pages_rendered': rendered}
+            _record_peak_memory(stats, 'render')
+            rendered = 0
+            saved = process_page(img, page_num, output_dir, file_base,
+                                 split_pages=split_pages, rotation=rotation,
+                                 crop_margin=crop_margin, encode_options=page_options,
+                                 stats=stats, preview_widths=preview_widths, buffers=buffers)
+            del img
+            yield page_num, saved, stats
+        start = time.perf_counter()
+
+
+def render_page(pdf_path, page_num, output_dir, file_base, dpi=300, split_pages=False, rotation=None,
+                crop_margin=0, encode_options=None, preview_widths=(), renderer=None):
+    """
+    Render and save a single page, for on-demand rendering.
+    
+    The page is processed in a hidden temporary directory and its files
+    are renamed into `output_dir`, previews first. Once a page image
+    exists in `output_dir` it is therefore complete, and so are its
+    previews.
+    
+    Returns:
+        List of paths of the saved images
+    """
+    tmp_dir = tempfile.mkdtemp(prefix=f".page{page_num}-", dir=output_dir)
+    try:
+        saved = []
+        for _, paths, _ in iter_window_pages(pdf_path, page_num, page_num, tmp_dir, file_base, dpi=dpi,
+                                             split_pages=split_pages, rotation=rotation,
+                                             crop_margin=crop_margin, encode_options=encode_options,
+                                             preview_widths=preview_widths, renderer=renderer):
+            saved.extend(paths)
+        
+        tmp_previews = os.path.join(tmp_dir, PREVIEW_DIR)
+        if os.path.isdir(tmp_previews):
+            os.makedirs(os.path.join(output_dir, PREVIEW_DIR), exist_ok=True)
+            for name in os.listdir(tmp_previews):
+                os.replace(os.path.join(tmp_previews, name), os.path.join(output_dir, PREVIEW_DIR, name))
+        
+        final = []
+        for path in saved:
+            target = os.path.join(output_dir, os.path.basename(path))
+            os.replace(path, target)
+            final.append(target)
+        return final
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def _process_window_task(*args, **kwargs):
+    """Process pool entry point for a page window; returns a list instead of a generator."""
+    return list(iter_window_pages(*args, **kwargs))
+
+
+# Queue through which pool workers send each page as soon as it is saved (see _stream_window_task)
+_page_queue = None
+
+
+def _init_page_queue(page_queue):
+    """Process pool initializer: set the queue _stream_window_task sends pages to"""
+    global _page_queue
+    _page_queue = page_queue
+
+
+def _stream_window_task(*args, **kwargs):
+    """Process pool entry point for a page window that sends each page to the parent as it is saved; returns the page count."""
+    count = 0
+    for page in iter_window_pages(*args, **kwargs):
+        _page_queue.put(page)
+        count += 1
+    return count
+
+
+def _new_progress(pages_total):
+    """Progress report of a conversion that has not written any page yet"""
+    return {
+        'pages_total': pages_total,
+        'pages_rendered': 0,
+        'pages_written': 0,
+        'files_written': 0,
+        'bytes_written': 0,
+        'elapsed': 0.0,
+        'timings': {stage: 0.0 for stage in PIPELINE_STAGES},
+    }
+
+
+def _add_page_stats(progress, saved, stats, started):
+    """Count a page written by iter_window_pages in a progress report"""
+    progress['pages_rendered'] += stats.get('pages_rendered', 0)
+    progress['pages_written'] += 1
+    progress['files_written'] += len(saved)
+    progress['bytes_written'] += stats.get('bytes_written', 0)
+    progress['elapsed'] = time.perf_counter() - started
+    for stage, seconds in stats.get('timings', {}).items():
+        progress['timings'][stage] = progress['timings'].get(stage, 0.0) + seconds
+    for stage, peak in stats.get('peak_memory', {}).items():
+        memory = progress.setdefault('peak_memory', {})
+        memory[stage] = max(memory.get(stage, 0), peak)
+
+
+def process_pdf(pdf_path, output_dir, dpi=300, split_pages=False, rotation=None, crop_margin=0,
+                chunk_size=DEFAULT_CHUNK_SIZE, workers=1, cancel_check=None,
+                output_format=DEFAULT_OUTPUT_FORMAT, png_compression=DEFAULT_PNG_COMPRESSION,
+                quality=DEFAULT_QUALITY, color_mode=DEFAULT_COLOR_MODE, progress_callback=None,
+                preview_widths=(), pages=None, renderer=None):
     """
     Convert PDF to images and deskew them.
     
+    Pages are rendered in windows of `chunk_size` pages, and each page is
+    released as soon as it has been saved, so peak memory depends on the
+    window size rather than on the length of the document. With more than
+    one worker, windows are sharded across a process pool, at most
+    2 * `workers` of them queued at a time, and peak memory is roughly
+    `workers * chunk_size` pages.
+    
     Args:
         pdf_path: Path to the PDF file
         output_dir: Directory to save output images
@@ -98,6 +781,32 @@ def process_pdf(pdf_path, output_dir, dpi=300, split_pages=False, rotation=None,
         split_pages: Whether to split double pages in half (default: False)
         rotation: Force specific rotation angle (0, 90, 180, 270)
         crop_margin: Pixels to crop from edges to remove artifacts (default: 0)
+        chunk_size: Number of pages rendered at once (default: DEFAULT_CHUNK_SIZE)
+        workers: Number of worker processes (default: 1, no pool)
+        cancel_check: Optional callable polled between page windows (with
+            workers, after each page and at least every PAGE_POLL_INTERVAL
+            seconds); when it returns True the conversion stops with
+            ConversionCancelled
+        output_format: 'png', 'jpeg' or 'webp' (default: 'png')
+        png_compression: PNG zlib level, 0-9 (default: DEFAULT_PNG_COMPRESSION)
+        quality: JPEG/WebP quality, 1-100 (default: DEFAULT_QUALITY)
+        color_mode: 'auto', 'rgb', 'gray' or 'bitonal' (default: 'rgb'); see
+            iter_render_runs
+        progress_callback: Optional callable invoked with a progress dict after
+            each page is saved: pages_total, pages_rendered, pages_written,
+            files_written, bytes_written, elapsed (seconds) and timings
+            (seconds spent per stage in PIPELINE_STAGES, summed over pages
+            and workers); while tracemalloc is tracing, also peak_memory
+            (highest traced bytes per stage)
+        preview_widths: Widths of the WebP previews written to
+            `output_dir`/PREVIEW_DIR for each image (default: none)
+        pages: Pages to convert, as a range string like "1-3,7,10-" or a
+            list of page numbers (default: all pages)
+        renderer: Rendering backend, one of renderers.RENDERERS (default:
+            the first available one)
+        
+    Returns:
+        List of paths of the saved images, in page order
     """
     # Create output directory if it doesn't exist
     os.makedirs(output_dir, exist_ok=True)
@@ -105,58 +814,298 @@ def process_pdf(pdf_path, output_dir, dpi=300, split_pages=False, rotation=None,
     # Get filename without extension
     file_base = os.path.splitext(os.path.basename(pdf_path))[0]
     
-    # Convert PDF to images
-    print(f"Converting PDF to images (DPI: {dpi})...")
-    images = convert_from_path(pdf_path, dpi=dpi)
-    
-    total_pages = len(images)
-    print(f"Total pages: {total_pages}")
-    
-    for i, img in enumerate(images):
-        print(f"Processing page {i+1}/{total_pages}")
-        
-        # Convert PIL image to numpy array for OpenCV
-        img_array = np.array(img)
-        
-        # Apply rotation if specified or detect orientation
-        if rotation is not None:
-            # Force specific rotation
-            deskewed = deskew_image(img_array, force_rotate=rotation)
-        else:
-            # Try to auto-detect and fix skew
-            deskewed = deskew_image(img_array)
-        
-        deskewed_pil = Image.fromarray(deskewed)
-        
-        # Crop margins if specified to remove artifacts
-        if crop_margin > 0:
-            width, height = deskewed_pil.size
-            deskewed_pil = deskewed_pil.crop((
-                crop_margin, 
-                crop_margin, 
-                width - crop_margin, 
-                height - crop_margin
-            ))
-        
-        if split_pages:
-            # Split image in half (left and right pages)
-            width, height = deskewed_pil.size
-            left_img = deskewed_pil.crop((0, 0, width // 2, height))
-            right_img = deskewed_pil.crop((width // 2, 0, width, height))
-            
-            # Save left and right images with zero-padded page numbers
-            left_img.save(os.path.join(output_dir, f"{file_base}_page{i+1:04d}_left.png"))
-            right_img.save(os.path.join(output_dir, f"{file_base}_page{i+1:04d}_right.png"))
-        else:
-            # Save the deskewed image with zero-padded page numbers
-            deskewed_pil.save(os.path.join(output_dir, f"{file_base}_page{i+1:04d}.png"))
+    renderer = get_renderer(renderer, pdf_path).name
+    total_pages = get_page_count(pdf_path, renderer)
+    selected = select_pages(pages, total_pages)
+    if not selected:
+        raise ValueError(f"No pages selected: the document has {total_pages} pages")
+    windows = list(iter_page_windows(total_pages, chunk_size, None if pages is None else selected))
+    workers = max(1, min(int(workers or 1), len(windows)))
+    print(f"Converting PDF to images (DPI: {dpi}, chunk size: {chunk_size}, workers: {workers}, "
+          f"renderer: {renderer})...")
+    print(f"Total pages: {total_pages}" + (f", converting {len(selected)}" if pages is not None else ""))
+    
+    encode_options = dict(output_format=output_format, png_compression=png_compression,
+                          quality=quality, color_mode=color_mode)
+    window_args = dict(dpi=dpi, split_pages=split_pages, rotation=rotation, crop_margin=crop_margin,
+                       encode_options=encode_options, preview_widths=tuple(preview_widths or ()),
+                       renderer=renderer)
+    pages = {}
+    progress = _new_progress(len(selected))
+    started = time.perf_counter()
+    
+    def record_page(page_num, saved, stats):
+        pages[page_num] = saved
+        _add_page_stats(progress, saved, stats, started)
+        print(f"Processed page {page_num}/{total_pages} ({progress['pages_written']}/{len(selected)} done)")
+        if progress_callback is not None:
+            progress_callback(dict(progress, timings=dict(progress['timings'])))
+    
+    def check_cancelled():
+        if cancel_check is not None and cancel_check():
+            raise ConversionCancelled(f"Conversion of {pdf_path} was cancelled")
+    
+    if workers == 1:
+        for first_page, last_page in windows:
+            check_cancelled()
+            for page_num, saved, stats in iter_window_pages(pdf_path, first_page, last_page,
+                                                            output_dir, file_base, **window_args):
+                record_page(page_num, saved, stats)
+    else:
+        # Spawn rather than fork: the web app calls this from a thread. Workers
+        # send each page through page_queue as it is saved, so progress and
+        # cancellation do not wait for whole windows.
+        ctx = multiprocessing.get_context("spawn")
+        page_queue = ctx.Queue()
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=ctx,
+                                       initializer=_init_page_queue, initargs=(page_queue,))
+        remaining = iter(windows)
+        in_flight = set()
+        # Pages sent by the finished windows, and pages received so far
+        expected = received = 0
+        try:
+            while True:
+                while len(in_flight) < 2 * workers:
+                    window = next(remaining, None)
+                    if window is None:
+                        break
+                    in_flight.add(executor.submit(_stream_window_task, pdf_path, window[0], window[1],
+                                                  output_dir, file_base, **window_args))
+                if not in_flight and received >= expected:
+                    break
+                try:
+                    record_page(*page_queue.get(timeout=PAGE_POLL_INTERVAL))
+                    received += 1
+                except queue.Empty:
+                    pass
+                check_cancelled()
+                for future in [future for future in in_flight if future.done()]:
+                    in_flight.discard(future)
+                    expected += future.result()
+        finally:
+            # After an error or a cancel, windows that have not started are dropped
+            executor.shutdown(wait=True, cancel_futures=True)
     
     print(f"All images saved to {output_dir}")
+    return [path for page_num in sorted(pages) for path in pages[page_num]]
+
+
+def process_batch(documents, dpi=300, split_pages=False, rotation=None, crop_margin=0,
+                  chunk_size=DEFAULT_CHUNK_SIZE, workers=1, output_format=DEFAULT_OUTPUT_FORMAT,
+                  png_compression=DEFAULT_PNG_COMPRESSION, quality=DEFAULT_QUALITY,
+                  color_mode=DEFAULT_COLOR_MODE, preview_widths=(), pages=None, renderer=None,
+                  manifest=None, cancel_check=None, progress_callback=None,
+                  on_document_start=None, on_document_done=None):
+    """
+    Convert many PDFs with the page windows of all of them on one worker pool.
+    
+    Documents are opened in order, each as soon as the pool has room for its
+    first window, so workers go on to the next document while the last
+    windows of the previous one finish instead of waiting for them, and the
+    pool is started once for the whole batch. At most 2 * `workers` windows
+    are queued at a time. A document that fails is recorded as such and the
+    batch carries on with the next one.
+    
+    Args:
+        documents: Iterable of (key, pdf_path, output_dir), key naming the
+            document in callbacks, results and the manifest
+        manifest: Optional batch.BatchManifest; documents it has as
+            completed are skipped, and each result is recorded in it
+        cancel_check: Optional callable cancel_check(key) polled before each
+            window of a document; when it returns True the document is cancelled
+        progress_callback: Optional callable progress_callback(key, progress)
+            invoked after each page, with progress as for process_pdf; raising
+            ConversionCancelled from it cancels the document
+        on_document_start: Optional callable on_document_start(key) invoked
+            before a document is opened; the document is skipped if it returns False
+        on_document_done: Optional callable on_document_done(key, result)
+            invoked once a document is finished
+        Other arguments are as for process_pdf.
+        
+    Returns:
+        dict of key -> result, with status ('completed', 'error', 'cancelled'
+        or 'skipped'), pages, images, files_written, bytes_written, elapsed,
+        timings (seconds per stage) and error
+    """
+    # Fail the whole batch up front on an unknown backend; 'auto' is resolved per document
+    get_renderer(renderer)
+    workers = max(1, int(workers or 1))
+    encode_options = dict(output_format=output_format, png_compression=png_compression,
+                          quality=quality, color_mode=color_mode)
+    window_args = dict(dpi=dpi, split_pages=split_pages, rotation=rotation, crop_margin=crop_margin,
+                       encode_options=encode_options, preview_widths=tuple(preview_widths or ()))
+    print(f"Converting a batch of PDFs (DPI: {dpi}, chunk size: {chunk_size}, workers: {workers}, "
+          f"renderer: {renderer or 'auto'})...")
+    results = {}
+    
+    def fail(state, e):
+        state['status'] = 'error'
+        state['error'] = f"{type(e).__name__}: {str(e)}"
+        print(f"Error converting {state['key']}: {str(e)}")
+    
+    def maybe_finish(state):
+        if not state['all_submitted'] or state['pending'] or state['finished']:
+            return
+        state['finished'] = True
+        progress = state['progress']
+        result = {
+            'status': state['status'],
+            'pages': progress['pages_written'],
+            'images': [path for page_num in sorted(state['pages']) for path in state['pages'][page_num]],
+            'files_written': progress['files_written'],
+            'bytes_written': progress['bytes_written'],
+            'elapsed': round(time.perf_counter() - state['started'], 3),
+            'timings': {stage: round(seconds, 6) for stage, seconds in progress['timings'].items()},
+            'error': state.get('error'),
+        }
+        results[state['key']] = result
+        print(f"{state['key']}: {state['status']}, {result['pages']} pages in {result['elapsed']:.1f}s")
+        if manifest is not None:
+            manifest.record(state['key'], state['pdf_path'], result)
+        if on_document_done is not None:
+            on_document_done(state['key'], result)
+    
+    def iter_windows():
+        """(state, first_page, last_page) of every window to render, document by document"""
+        for key, pdf_path, output_dir in documents:
+            if manifest is not None and manifest.is_done(key, pdf_path):
+                results[key] = dict(manifest.get(key), status='skipped')
+                print(f"{key}: already converted, skipped")
+                continue
+            if on_document_start is not None and on_document_start(key) is False:
+                continue
+            state = {'key': key, 'pdf_path': pdf_path, 'output_dir': output_dir,
+                     'file_base': os.path.splitext(os.path.basename(pdf_path))[0],
+                     'status': 'completed', 'pages': {}, 'progress': _new_progress(0),
+                     'pending': 0, 'all_submitted': False, 'finished': False,
+                     'started': time.perf_counter()}
+            try:
+                os.makedirs(output_dir, exist_ok=True)
+                state['window_args'] = dict(window_args, renderer=get_renderer(renderer, pdf_path).name)
+                total_pages = get_page_count(pdf_path, state['window_args']['renderer'])
+                selected = select_pages(pages, total_pages)
+                if not selected:
+                    raise ValueError(f"No pages selected: the document has {total_pages} pages")
+                windows = list(iter_page_windows(total_pages, chunk_size, None if pages is None else selected))
+                state['progress']['pages_total'] = len(selected)
+            except Exception as e:
+                fail(state, e)
+                windows = []
+            
+            for first_page, last_page in windows:
+                if state['status'] != 'completed':
+                    break
+                if cancel_check is not None and cancel_check(key):
+                    state['status'] = 'cancelled'
+                    break
+                state['pending'] += 1
+                yield state, first_page, last_page
+            state['all_submitted'] = True
+            maybe_finish(state)
+    
+    def record_window(state, window_pages):
+        # Pages of a document that already failed or was cancelled are not counted
+        if state['status'] != 'completed':
+            return
+        for page_num, saved, stats in window_pages:
+            state['pages'][page_num] = saved
+            _add_page_stats(state['progress'], saved, stats, state['started'])
+            if progress_callback is not None:
+                progress = state['progress']
+                progress_callback(state['key'], dict(progress, timings=dict(progress['timings'])))
+    
+    started = time.perf_counter()
+    if workers == 1:
+        for state, first_page, last_page in iter_windows():
+            try:
+                for page in iter_window_pages(state['pdf_path'], first_page, last_page,
+                                              state['output_dir'], state['file_base'], **state['window_args']):
+                    record_window(state, [page])
+            except ConversionCancelled:
+                # Raised by progress_callback to stop this document
+                state['status'] = 'cancelled'
+            except Exception as e:
+                fail(state, e)
+            state['pending'] -= 1
+    else:
+        # Spawn rather than fork: the web app calls this from a thread
+        ctx = multiprocessing.get_context("spawn")
+        tasks = iter_windows()
+        with ProcessPoolExecutor(max_workers=workers, mp_context=ctx) as executor:
+            in_flight = {}
+            exhausted = False
+            
+            def drop_windows(state):
+                # Windows of a stopped document that have not started are not run at all
+                for future, other in list(in_flight.items()):
+                    if other is state and future.cancel():
+                        del in_flight[future]
+                        state['pending'] -= 1
+            
+            while True:
+                while not exhausted and len(in_flight) < 2 * workers:
+                    task = next(tasks, None)
+                    if task is None:
+                        exhausted = True
+                        break
+                    state, first_page, last_page = task
+                    future = executor.submit(_process_window_task, state['pdf_path'], first_page, last_page,
+                                             state['output_dir'], state['file_base'], **state['window_args'])
+                    in_flight[future] = state
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    state = in_flight.pop(future)
+                    state['pending'] -= 1
+                    try:
+                        record_window(state, future.result())
+                    except ConversionCancelled:
+                        state['status'] = 'cancelled'
+                    except Exception as e:
+                        if state['status'] == 'completed':
+                            fail(state, e)
+                    if state['status'] != 'completed':
+                        drop_windows(state)
+                    maybe_finish(state)
+    
+    counts = {}
+    for result in results.values():
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+    print(f"Batch finished in {time.perf_counter() - started:.1f}s: "
+          + ", ".join(f"{count} {status}" for status, count in sorted(counts.items())))
+    return results
+
+
+def run_batch(args, options):
+    """Convert the PDFs named on the command line as a batch, resuming an interrupted one"""
+    try:
+        inputs = collect_inputs(args.pdf_path, os.path.join(args.output_dir, EXTRACT_DIR))
+    except (OSError, ValueError) as e:
+        raise SystemExit(f"Error: {str(e)}")
+    if not inputs:
+        raise SystemExit("Error: no PDF files found")
+    
+    manifest_path = os.path.join(args.output_dir, MANIFEST_NAME)
+    # The options that change the output; a manifest written with others is not resumed
+    manifest = BatchManifest(manifest_path, dict(
+        dpi=args.dpi, split_pages=args.split, rotation=args.rotate, crop_margin=args.crop,
+        output_format=args.output_format, png_compression=args.png_compression, quality=args.quality,
+        color_mode=args.color_mode, preview_widths=list(options['preview_widths']), pages=args.pages,
+        renderer=get_renderer(args.renderer).name), resume=not args.restart)
+    
+    results = process_batch([(key, path, os.path.join(args.output_dir, *key.split('/'))) for key, path in inputs],
+                            args.dpi, args.split, args.rotate, args.crop, manifest=manifest, **options)
+    print(f"Manifest saved to {manifest_path}")
+    if any(result['status'] == 'error' for result in results.values()):
+        raise SystemExit(1)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Convert PDF to deskewed images")
-    parser.add_argument("pdf_path", help="Path to the PDF file")
+    parser.add_argument("pdf_path", nargs="+",
+                        help="Path to the PDF file; several files, directories, glob patterns or "
+                             "ZIP archives convert a batch, each PDF to OUTPUT_DIR/<name>")
     parser.add_argument("--output-dir", default="output", help="Output directory for images")
     parser.add_argument("--dpi", type=int, default=300, help="DPI for output images")
     parser.add_argument("--split", action="store_true", help="Split double pages in half")
@@ -164,10 +1113,62 @@ def main():
                         help="Force rotation angle (0, 90, 180, or 270 degrees)")
     parser.add_argument("--crop", type=int, default=0,
                         help="Crop margin in pixels to remove artifacts from edges")
+    parser.add_argument("--chunk-size", type=int, default=DEFAULT_CHUNK_SIZE,
+                        help="Number of pages rendered at once (bounds peak memory)")
+    parser.add_argument("--format", dest="output_format", choices=sorted(OUTPUT_FORMATS),
+                        default=DEFAULT_OUTPUT_FORMAT, help="Output image format")
+    parser.add_argument("--png-compression", type=int, choices=range(10), default=DEFAULT_PNG_COMPRESSION,
+                        metavar="0-9", help="PNG compression level (0 fastest, 9 smallest)")
+    parser.add_argument("--quality", type=int, default=DEFAULT_QUALITY,
+                        help="JPEG/WebP quality (1-100)")
+    parser.add_argument("--color-mode", choices=COLOR_MODES, default=DEFAULT_COLOR_MODE,
+                        help="Write color, grayscale or 1-bit black and white images, "
+                             "or pick color or grayscale per page (auto)")
+    parser.add_argument("--workers", type=int, default=default_workers(),
+                        help="Number of worker processes (default: half of the CPU cores)")
+    parser.add_argument("--pages", help='Pages to convert, e.g. "1-3,7,10-" (default: all)')
+    parser.add_argument("--previews", action="store_true",
+                        help=f"Also write WebP previews ({', '.join(map(str, PREVIEW_WIDTHS))} pixels wide) "
+                             f"to {PREVIEW_DIR}/")
+    parser.add_argument("--profile", nargs="?", const="", metavar="DIR",
+                        help="Profile the conversion with cProfile and tracemalloc (forces one worker); "
+                             f"artifacts go to DIR (default: OUTPUT_DIR/{PROFILE_DIR})")
+    parser.add_argument("--renderer", choices=['auto'] + sorted(RENDERERS), default='auto',
+                        help="Rendering backend (default: the first available of "
+                             f"{', '.join(RENDERER_PREFERENCE)})")
+    parser.add_argument("--restart", action="store_true",
+                        help=f"Batches: convert every PDF again instead of resuming from OUTPUT_DIR/{MANIFEST_NAME}")
     
     args = parser.parse_args()
     
-    process_pdf(args.pdf_path, args.output_dir, args.dpi, args.split, args.rotate, args.crop)
+    options = dict(chunk_size=args.chunk_size, workers=args.workers,
+                   output_format=args.output_format, png_compression=args.png_compression,
+                   quality=args.quality, color_mode=args.color_mode,
+                   preview_widths=PREVIEW_WIDTHS if args.previews else (), pages=args.pages,
+                   renderer=args.renderer)
+    
+    pdf_path = args.pdf_path[0]
+    if len(args.pdf_path) > 1 or not (os.path.isfile(pdf_path) and pdf_path.lower().endswith('.pdf')):
+        if args.profile is not None:
+            parser.error("--profile takes a single PDF")
+        run_batch(args, options)
+        return
+    
+    if args.profile is None:
+        process_pdf(pdf_path, args.output_dir, args.dpi, args.split, args.rotate, args.crop, **options)
+        return
+    
+    # Only the calling thread is profiled
+    options['workers'] = 1
+    artifact_dir = args.profile or os.path.join(args.output_dir, PROFILE_DIR)
+    try:
+        profile_conversion(artifact_dir, process_pdf, pdf_path, args.output_dir, args.dpi,
+                           args.split, args.rotate, args.crop, **options)
+    finally:
+        summary = load_summary(artifact_dir)
+        if summary is not None:
+            print(format_summary(summary))
+            print(f"Profile saved to {artifact_dir}")
 
 
 if __name__ == "__main__":
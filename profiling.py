@@ -0,0 +1,172 @@
+#!/usr/bin/env python3
+"""
+Opt-in profiling of a single conversion.
+
+profile_conversion runs process_pdf (or any function taking a
+progress_callback) under cProfile and tracemalloc and stores the
+artifacts in a directory, normally the `.profile` directory of the job's
+output:
+
+- profile.pstats: the cProfile data, for pstats or snakeviz
+- profile.txt: the 40 functions with the highest cumulative time
+- start.snapshot, end.snapshot: tracemalloc snapshots before and after
+  the conversion, for tracemalloc.Snapshot.load
+- summary.json: top functions, time and peak memory per pipeline stage,
+  and the allocations still held at the end
+
+Only the calling thread is profiled, so the conversion must run with a
+single worker. tracemalloc is process-wide: allocations of other threads
+are traced too, and only one conversion per process is profiled at a
+time.
+"""
+import io
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+# Directory of the artifacts inside a job's output directory (hidden, so
+# it is left out of ZIP archives and the conversion cache)
+PROFILE_DIR = '.profile'
+
+SUMMARY_NAME = 'summary.json'
+
+# Frames stored per traced allocation
+TRACEMALLOC_FRAMES = 10
+
+_profile_lock = threading.Lock()
+
+
+def _function_label(key):
+    filename, line, name = key
+    if filename == '~':
+        # Built-in function
+        return name
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def top_functions(profiler, limit=30):
+    """The `limit` functions with the highest cumulative time, as dicts"""
+    stats = pstats.Stats(profiler)
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit]
+    return [{
+        'function': _function_label(key),
+        'calls': nc,
+        'primitive_calls': cc,
+        'tottime': round(tt, 6),
+        'cumtime': round(ct, 6),
+    } for key, (cc, nc, tt, ct, _) in rows]
+
+
+def retained_allocations(start, end, limit=15):
+    """Source lines holding the most memory at `end` that was allocated after `start`"""
+    return [{
+        'location': f"{os.path.basename(stat.traceback[0].filename)}:{stat.traceback[0].lineno}",
+        'size': stat.size_diff,
+        'count': stat.count_diff,
+    } for stat in end.compare_to(start, 'lineno')[:limit] if stat.size_diff > 0]
+
+
+def profile_conversion(artifact_dir, func, *args, progress_callback=None, **kwargs):
+    """
+    Call func(*args, progress_callback=..., **kwargs) under the profilers.
+
+    The artifacts are written even if func raises, and the exception is
+    then re-raised.
+
+    Args:
+        artifact_dir: Directory for the artifacts (created if needed)
+        progress_callback: Passed on to func; the last progress it reports
+            provides the per-stage times and peak memory of the summary
+
+    Returns:
+        What func returns
+    """
+    os.makedirs(artifact_dir, exist_ok=True)
+    last_progress = {}
+
+    def on_progress(progress):
+        last_progress.update(progress)
+        if progress_callback is not None:
+            progress_callback(progress)
+
+    with _profile_lock:
+        tracemalloc.start(TRACEMALLOC_FRAMES)
+        profiler = cProfile.Profile()
+        error = None
+        start_snapshot = tracemalloc.take_snapshot()
+        started = time.perf_counter()
+        try:
+            profiler.enable()
+            try:
+                return func(*args, progress_callback=on_progress, **kwargs)
+            finally:
+                profiler.disable()
+        except BaseException as e:
+            error = f"{type(e).__name__}: {str(e)}"
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            stage_peaks = last_progress.get('peak_memory', {})
+            # The stages reset the traced peak as they go (see pdf_to_image._record_peak_memory)
+            peak = max([tracemalloc.get_traced_memory()[1], *stage_peaks.values()])
+            end_snapshot = tracemalloc.take_snapshot()
+            tracemalloc.stop()
+            try:
+                _write_artifacts(artifact_dir, profiler, start_snapshot, end_snapshot, {
+                    'created': time.time(),
+                    'elapsed': round(elapsed, 3),
+                    'error': error,
+                    'pages': last_progress.get('pages_written', 0),
+                    'peak_memory': peak,
+                    'stages': {stage: {'seconds': round(seconds, 6),
+                                       'peak_memory': stage_peaks.get(stage)}
+                               for stage, seconds in last_progress.get('timings', {}).items()},
+                })
+            except Exception as e:
+                print(f"Error writing profile to {artifact_dir}: {str(e)}")
+
+
+def _write_artifacts(artifact_dir, profiler, start_snapshot, end_snapshot, summary):
+    profiler.dump_stats(os.path.join(artifact_dir, 'profile.pstats'))
+    start_snapshot.dump(os.path.join(artifact_dir, 'start.snapshot'))
+    end_snapshot.dump(os.path.join(artifact_dir, 'end.snapshot'))
+
+    text = io.StringIO()
+    pstats.Stats(profiler, stream=text).sort_stats('cumulative').print_stats(40)
+    with open(os.path.join(artifact_dir, 'profile.txt'), 'w') as f:
+        f.write(text.getvalue())
+
+    summary['top_functions'] = top_functions(profiler)
+    summary['retained_allocations'] = retained_allocations(start_snapshot, end_snapshot)
+    with open(os.path.join(artifact_dir, SUMMARY_NAME), 'w') as f:
+        json.dump(summary, f, indent=2)
+
+
+def load_summary(artifact_dir):
+    """The summary.json of a profiled conversion, or None if there is none"""
+    try:
+        with open(os.path.join(artifact_dir, SUMMARY_NAME)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def format_summary(summary, limit=15):
+    """Plain-text report of a summary, as printed by the CLI"""
+    lines = [f"Profiled {summary['pages']} pages in {summary['elapsed']:.2f}s, "
+             f"peak traced memory {summary['peak_memory'] / 2**20:.1f} MB"]
+    if summary.get('error'):
+        lines.append(f"Failed with {summary['error']}")
+    lines.append(f"{'stage':<10} {'seconds':>9} {'peak MB':>9}")
+    for stage, values in summary['stages'].items():
+        peak = values.get('peak_memory')
+        peak_mb = f"{peak / 2**20:.1f}" if peak is not None else '-'
+        lines.append(f"{stage:<10} {values['seconds']:>9.3f} {peak_mb:>9}")
+    lines.append(f"{'cumtime':>9} {'tottime':>9} {'calls':>7}  function")
+    for row in summary['top_functions'][:limit]:
+        lines.append(f"{row['cumtime']:>9.3f} {row['tottime']:>9.3f} {row['calls']:>7}  {row['function']}")
+    return '\n'.join(lines)
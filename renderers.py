@@ -0,0 +1,311 @@
+#!/usr/bin/env python3
+"""
+PDF rendering backends that produce pages as numpy arrays.
+
+- pdftoppm: poppler's rasterizer writing PPM/PGM files, which are
+  memory-mapped instead of decoded (the default)
+- pdftocairo: poppler's cairo backend writing uncompressed TIFF files,
+  which antialiases vector art differently from pdftoppm
+- pymupdf: MuPDF in-process, if the PyMuPDF package is installed; pages
+  are rendered into memory with no subprocess or temporary files
+- pdf2image: pdftoppm through pdf2image and PIL, the fallback when none
+  of the above is available
+
+`python benchmark.py render` compares the available backends on sample
+documents of each kind. Its fastest backend per document type goes in
+PDF_RENDERER_BY_TYPE (e.g. "scan=pdftoppm,vector=pymupdf"), which 'auto'
+follows for the documents it can classify, see document_type().
+"""
+import os
+import re
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+import cv2
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+try:
+    import pymupdf
+except ImportError:
+    pymupdf = None
+
+# Backends tried in this order when none is named
+RENDERER_PREFERENCE = ('pdftoppm', 'pymupdf', 'pdftocairo', 'pdf2image')
+
+# Kinds of documents told apart by document_type()
+DOCUMENT_TYPES = ('scan', 'vector')
+
+# Bytes read from the start of a PDF to classify it
+DOC_TYPE_SAMPLE_SIZE = 8 * 1024 * 1024
+
+# Share of those bytes in image streams above which a document is a scan
+SCAN_IMAGE_SHARE = 0.5
+
+_IMAGE_XOBJECT = re.compile(rb'/Subtype\s*/Image\b')
+
+
+def read_pnm(path):
+    """
+    Memory-map a binary PPM (RGB) or PGM (grayscale) file as a numpy array.
+
+    The pixels are not copied: the array reads straight from the file
+    (through the page cache), and is read-only.
+
+    Returns:
+        (height, width, 3) or (height, width) uint8 array
+    """
+    with open(path, 'rb') as f:
+        header = f.read(512)
+
+    # Magic number, width, height and maxval, separated by whitespace and comments
+    fields = []
+    pos = 0
+    while len(fields) < 4:
+        while header[pos:pos + 1].isspace():
+            pos += 1
+        if header[pos:pos + 1] == b'#':
+            pos = header.index(b'\n', pos) + 1
+            continue
+        end = pos
+        while end < len(header) and not header[end:end + 1].isspace():
+            end += 1
+        fields.append(header[pos:end])
+        pos = end
+    # A single whitespace byte separates the header from the pixels
+    offset = pos + 1
+
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if magic not in (b'P5', b'P6') or maxval > 255:
+        raise ValueError(f"Unsupported PNM file: {path}")
+    shape = (height, width, 3) if magic == b'P6' else (height, width)
+    return np.memmap(path, dtype=np.uint8, mode='r', offset=offset, shape=shape)
+
+
+def read_tiff(path):
+    """Decode an 8-bit TIFF into an RGB or grayscale numpy array."""
+    image = cv2.imread(path, cv2.IMREAD_UNCHANGED)
+    if image is None:
+        raise ValueError(f"Unsupported TIFF file: {path}")
+    if image.ndim == 3 and image.shape[2] == 4:
+        return cv2.cvtColor(image, cv2.COLOR_BGRA2RGB)
+    if image.ndim == 3:
+        # In place: OpenCV decodes to BGR
+        cv2.cvtColor(image, cv2.COLOR_BGR2RGB, dst=image)
+    return image
+
+
+class Renderer:
+    """
+    A rendering backend.
+
+    iter_pages(pdf_path, first_page, last_page, dpi, gray) yields
+    (page_num, image) for each page of the range, image being an RGB
+    array, or a 2-D grayscale array with `gray`. Each array is only valid
+    until the next page is requested.
+    """
+
+    name = None
+
+    def available(self):
+        return True
+
+    def page_count(self, pdf_path):
+        return int(pdfinfo_from_path(pdf_path)["Pages"])
+
+    def iter_pages(self, pdf_path, first_page, last_page, dpi=300, gray=False):
+        raise NotImplementedError
+
+
+class _PopplerRenderer(Renderer):
+    """Runs a poppler tool over the page range, then loads its output files one at a time."""
+
+    def available(self):
+        return shutil.which(self.name) is not None
+
+    def command(self, dpi, gray):
+        raise NotImplementedError
+
+    def load(self, path):
+        raise NotImplementedError
+
+    def iter_pages(self, pdf_path, first_page, last_page, dpi=300, gray=False):
+        tmp_dir = tempfile.mkdtemp(prefix="pdf2img-")
+        try:
+            result = subprocess.run(
+                [self.name, '-r', str(dpi), '-f', str(first_page), '-l', str(last_page)]
+                + self.command(dpi, gray) + [pdf_path, os.path.join(tmp_dir, 'page')],
+                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+            )
+            if result.returncode != 0:
+                raise RuntimeError(f"{self.name} failed: {result.stderr.decode(errors='replace').strip()}")
+
+            # page-<n>.<ext>, with n zero-padded to the same width within one run
+            for page_num, name in zip(range(first_page, last_page + 1), sorted(os.listdir(tmp_dir))):
+                path = os.path.join(tmp_dir, name)
+                yield page_num, self.load(path)
+                os.remove(path)
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+class PdftoppmRenderer(_PopplerRenderer):
+    name = 'pdftoppm'
+
+    def command(self, dpi, gray):
+        return ['-gray'] if gray else []
+
+    def load(self, path):
+        return read_pnm(path)
+
+
+class PdftocairoRenderer(_PopplerRenderer):
+    name = 'pdftocairo'
+
+    def command(self, dpi, gray):
+        return ['-tiff', '-tiffcompression', 'none'] + (['-gray'] if gray else [])
+
+    def load(self, path):
+        return read_tiff(path)
+
+
+class PyMuPDFRenderer(Renderer):
+    name = 'pymupdf'
+
+    def available(self):
+        return pymupdf is not None
+
+    def page_count(self, pdf_path):
+        with pymupdf.open(pdf_path) as doc:
+            return doc.page_count
+
+    def iter_pages(self, pdf_path, first_page, last_page, dpi=300, gray=False):
+        matrix = pymupdf.Matrix(dpi / 72, dpi / 72)
+        colorspace = pymupdf.csGRAY if gray else pymupdf.csRGB
+        with pymupdf.open(pdf_path) as doc:
+            for page_num in range(first_page, min(last_page, doc.page_count) + 1):
+                pix = doc[page_num - 1].get_pixmap(matrix=matrix, colorspace=colorspace, alpha=False)
+                # A view of the pixmap's samples; rows may be padded to pix.stride
+                shape = (pix.height, pix.width) if gray else (pix.height, pix.width, 3)
+                strides = (pix.stride, 1) if gray else (pix.stride, 3, 1)
+                yield page_num, np.ndarray(shape, dtype=np.uint8, buffer=pix.samples_mv, strides=strides)
+                del pix
+
+
+class Pdf2imageRenderer(Renderer):
+    name = 'pdf2image'
+
+    def available(self):
+        # pdf2image runs the poppler tools
+        return shutil.which('pdfinfo') is not None
+
+    def iter_pages(self, pdf_path, first_page, last_page, dpi=300, gray=False):
+        images = convert_from_path(pdf_path, dpi=dpi, first_page=first_page, last_page=last_page,
+                                   grayscale=gray)
+        for page_num in range(first_page, first_page + len(images)):
+            img = images.pop(0)
+            yield page_num, np.asarray(img)
+            img.close()
+
+
+RENDERERS = {renderer.name: renderer for renderer in
+             (PdftoppmRenderer(), PdftocairoRenderer(), PyMuPDFRenderer(), Pdf2imageRenderer())}
+
+
+def available_renderers():
+    """Names of the backends usable here, in RENDERER_PREFERENCE order"""
+    return [name for name in RENDERER_PREFERENCE if RENDERERS[name].available()]
+
+
+def parse_renderer_by_type(spec):
+    """
+    Parse a PDF_RENDERER_BY_TYPE setting.
+
+    Args:
+        spec: Comma-separated TYPE=BACKEND pairs, e.g. "scan=pdftoppm,vector=pymupdf"
+
+    Returns:
+        dict of document type -> backend name; entries naming an unknown
+        type or backend are left out with a warning
+    """
+    mapping = {}
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        doc_type, _, name = (part.strip() for part in item.partition('='))
+        if doc_type not in DOCUMENT_TYPES or name not in RENDERERS:
+            print(f"Warning: ignoring PDF_RENDERER_BY_TYPE entry {item!r}")
+            continue
+        mapping[doc_type] = name
+    return mapping
+
+
+# Backend 'auto' uses per document type, from `python benchmark.py render`
+RENDERER_BY_TYPE = parse_renderer_by_type(os.environ.get('PDF_RENDERER_BY_TYPE', ''))
+
+_document_types = {}
+
+
+def document_type(pdf_path):
+    """
+    Classify a PDF as 'scan' (mostly embedded page images) or 'vector'.
+
+    Only the first DOC_TYPE_SAMPLE_SIZE bytes are read: the document is a
+    scan if image streams take up SCAN_IMAGE_SHARE of them. Results are
+    kept per path, size and modification time.
+
+    Returns:
+        One of DOCUMENT_TYPES
+    """
+    st = os.stat(pdf_path)
+    cache_key = (pdf_path, st.st_size, st.st_mtime_ns)
+    if cache_key not in _document_types:
+        with open(pdf_path, 'rb') as f:
+            data = f.read(DOC_TYPE_SAMPLE_SIZE)
+        image_bytes = 0
+        pos = 0
+        while True:
+            match = _IMAGE_XOBJECT.search(data, pos)
+            if match is None:
+                break
+            start = data.find(b'stream', match.end())
+            if start < 0:
+                break
+            end = data.find(b'endstream', start)
+            if end < 0:
+                # The image runs past the sample
+                end = len(data)
+            image_bytes += end - start
+            pos = end
+        doc_type = 'scan' if data and image_bytes >= SCAN_IMAGE_SHARE * len(data) else 'vector'
+        _document_types[cache_key] = doc_type
+    return _document_types[cache_key]
+
+
+def get_renderer(name=None, pdf_path=None):
+    """
+    Look up a backend by name.
+
+    Args:
+        name: One of RENDERERS, or None/'auto' for the backend
+            RENDERER_BY_TYPE gives for the type of `pdf_path`, if it is
+            available, else the first available backend in
+            RENDERER_PREFERENCE
+        pdf_path: Document to be rendered, if known
+
+    Returns:
+        Renderer instance
+    """
+    if name in (None, 'auto'):
+        if pdf_path is not None and RENDERER_BY_TYPE:
+            preferred = RENDERER_BY_TYPE.get(document_type(pdf_path))
+            if preferred is not None and RENDERERS[preferred].available():
+                return RENDERERS[preferred]
+        available = available_renderers()
+        if not available:
+            raise RuntimeError("No PDF renderer available: install poppler-utils or PyMuPDF")
+        return RENDERERS[available[0]]
+    renderer = RENDERERS.get(name)
+    if renderer is None:
+        raise ValueError(f"Unknown renderer: {name}")
+    if not renderer.available():
+        raise ValueError(f"Renderer not available: {name}")
+    return renderer
@@ -0,0 +1,247 @@
+#!/usr/bin/env python3
+"""
+Background retention service that deletes old conversions by policy.
+
+Policies, each disabled when set to 0 or False:
+
+- max_age: delete finished conversions older than this many seconds
+- user_quota: delete a user's least recently used conversions while the
+  user's conversions take up more than this many bytes, counting the
+  pages they share with the conversion cache
+- disk_budget: delete the least recently used conversions of any user
+  while all conversions together take up more than this many bytes
+- delete_sources: delete the uploaded PDF once its conversion has completed
+
+Cleanup requests from users (see request_purge) are handled by the same
+service. The work is done in batches of `batch_size` conversions with a
+pause between batches, on a background thread, so request workers never
+wait for it. A lock file lets one gunicorn worker run the service at a
+time. The others skip a run while it is held.
+"""
+import os
+import json
+import time
+import fcntl
+import threading
+
+
+class RetentionService:
+    """
+    Applies the retention policies every `interval` seconds.
+
+    Args:
+        store: ConversionStore with the conversion index and usage counters
+        purge: Callable purge(file_id) that deletes all files and records of a conversion
+        delete_source: Callable delete_source(file_id) that deletes a conversion's uploaded PDF
+        lock_path: Lock file shared by all processes running the service
+        interval: Seconds between runs
+        batch_size: Conversions handled per batch
+        batch_pause: Seconds to sleep between batches
+        max_age, user_quota, disk_budget, delete_sources: Policies (see module docstring)
+        on_purge_all: Optional callable invoked after an admin has purged
+            every conversion (e.g. to empty the conversion cache)
+    """
+
+    def __init__(self, store, purge, delete_source, lock_path, interval=300, batch_size=20,
+                 batch_pause=0.5, max_age=0, user_quota=0, disk_budget=0, delete_sources=False,
+                 on_purge_all=None):
+        self.store = store
+        self.purge = purge
+        self.delete_source = delete_source
+        self.lock_path = lock_path
+        self.interval = interval
+        self.batch_size = max(1, int(batch_size))
+        self.batch_pause = batch_pause
+        self.max_age = max_age
+        self.user_quota = user_quota
+        self.disk_budget = disk_budget
+        self.delete_sources = delete_sources
+        self.on_purge_all = on_purge_all
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def policies(self):
+        return {
+            'max_age': self.max_age,
+            'user_quota': self.user_quota,
+            'disk_budget': self.disk_budget,
+            'delete_sources': self.delete_sources,
+            'interval': self.interval,
+            'batch_size': self.batch_size,
+        }
+
+    def start(self):
+        """Start the background thread, once per process"""
+        # Started lazily so importing the app never spawns threads (e.g. before gunicorn forks)
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="retention", daemon=True)
+                self._thread.start()
+
+    def request_purge(self, user_id=None):
+        """
+        Queue the deletion of all of a user's finished conversions, or of
+        everyone's (and of files that belong to no conversion) when user_id
+        is None. Returns immediately; the service does the work.
+        """
+        self.store.add_purge_request(user_id or '', time.time())
+        self.wake()
+
+    def wake(self):
+        """Run the policies now rather than at the next interval"""
+        self.start()
+        self._wake.set()
+
+    def pending_purges(self):
+        return self.store.purge_requests()
+
+    def stats(self):
+        """Counters of the service, shared by all processes"""
+        stats = json.loads(self.store.get_meta('retention_stats', '{}'))
+        stats['policies'] = self.policies()
+        stats['pending_purges'] = self.pending_purges()
+        return stats
+
+    def _run(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Error applying retention policies: {str(e)}")
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def run_once(self):
+        """
+        Apply every policy once.
+
+        Returns:
+            dict of conversions deleted per policy, or None if another
+            process is already running the service
+        """
+        with open(self.lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return None
+            try:
+                return self._apply_policies()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _apply_policies(self):
+        started = time.time()
+        self._freed = 0
+        deleted = {
+            'purge_requests': self._handle_purge_requests(),
+            'max_age': self._apply_max_age() if self.max_age else 0,
+            'user_quota': self._apply_user_quota() if self.user_quota else 0,
+            'disk_budget': self._apply_disk_budget() if self.disk_budget else 0,
+            'sources': self._apply_delete_sources() if self.delete_sources else 0,
+        }
+
+        stats = json.loads(self.store.get_meta('retention_stats', '{}'))
+        totals = stats.get('deleted', {})
+        for policy, count in deleted.items():
+            totals[policy] = totals.get(policy, 0) + count
+        stats.update({
+            'runs': stats.get('runs', 0) + 1,
+            'last_run': started,
+            'last_duration': round(time.time() - started, 3),
+            'last_deleted': deleted,
+            'deleted': totals,
+            'bytes_freed': stats.get('bytes_freed', 0) + self._freed,
+            'last_bytes_freed': self._freed,
+            'pid': os.getpid(),
+        })
+        self.store.set_meta('retention_stats', json.dumps(stats))
+        return deleted
+
+    def _purge_batch(self, file_ids):
+        """Delete a batch of conversions, then pause. Returns the number deleted."""
+        deleted = 0
+        for file_id in file_ids:
+            freed = self.store.get_usage(file_id)
+            try:
+                self.purge(file_id)
+            except OSError as e:
+                print(f"Error deleting conversion {file_id}: {str(e)}")
+                continue
+            self._freed += freed
+            deleted += 1
+        if file_ids:
+            time.sleep(self.batch_pause)
+        return deleted
+
+    def _purge_all(self, next_batch):
+        """Purge the batches returned by next_batch() until it runs dry or nothing can be deleted."""
+        deleted = 0
+        while True:
+            batch = next_batch()
+            if not batch:
+                return deleted
+            count = self._purge_batch(batch)
+            if not count:
+                return deleted
+            deleted += count
+
+    def _evict_lru(self, user_id, excess):
+        """Purge least recently used conversions (of one user, or of anyone) until `excess` bytes are freed"""
+        remaining = [excess]
+
+        def next_batch():
+            batch = []
+            for file_id in self.store.lru_conversions(user_id, self.batch_size):
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= self.store.get_usage(file_id)
+                batch.append(file_id)
+            return batch
+
+        return self._purge_all(next_batch)
+
+    def _handle_purge_requests(self):
+        deleted = 0
+        for request in self.store.purge_requests():
+            user_id = request['user_id'] or None
+            deleted += self._purge_all(lambda: self.store.lru_conversions(user_id, self.batch_size))
+            if user_id is None:
+                # Files left behind without a conversion record
+                deleted += self._purge_all(lambda: self.store.orphaned_usage(self.batch_size))
+                if self.on_purge_all is not None:
+                    self.on_purge_all()
+            self.store.delete_purge_request(request['user_id'], request['requested'])
+        return deleted
+
+    def _apply_max_age(self):
+        before = time.time() - self.max_age
+        return self._purge_all(lambda: self.store.expired_conversions(before, self.batch_size))
+
+    def _apply_user_quota(self):
+        deleted = 0
+        for user_id, used in self.store.usage_by_user():
+            if used <= self.user_quota:
+                # Sorted largest first: nobody else is over quota
+                break
+            deleted += self._evict_lru(user_id, used - self.user_quota)
+        return deleted
+
+    def _apply_disk_budget(self):
+        # Only space held by conversions counts, pages they share with the cache included;
+        # the database and cache themselves are not evictable here
+        used = sum(size for _, size in self.store.usage_by_user())
+        return self._evict_lru(None, used - self.disk_budget) if used > self.disk_budget else 0
+
+    def _apply_delete_sources(self):
+        deleted = 0
+        while True:
+            batch = self.store.kept_sources(self.batch_size)
+            if not batch:
+                return deleted
+            for file_id in batch:
+                self._freed += self.store.get_usage(file_id)
+                self.delete_source(file_id)
+                self._freed -= self.store.get_usage(file_id)
+            deleted += len(batch)
+            time.sleep(self.batch_pause)
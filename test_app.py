@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+"""Tests of the web app through Flask's test client; run with `python -m pytest` or `python -m unittest`."""
+import io
+import os
+import sys
+import time
+import fcntl
+import shutil
+import zipfile
+import tempfile
+import unittest
+
+from test_pdf_to_image import write_blank_pdf
+
+# The app keeps its folders relative to the working directory
+_tmp = None
+app = None
+
+
+def setUpModule():
+    global _tmp, app
+    _tmp = tempfile.mkdtemp()
+    os.environ.setdefault('PDF_WORKERS', '1')
+    # No background metric writes into the temporary directory once it is removed
+    os.environ.setdefault('METRICS_FLUSH_INTERVAL', '3600')
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    os.chdir(_tmp)
+    import app as app_module
+    app = app_module
+    app.app.config['TESTING'] = True
+    app.app.config['OUTPUT_FOLDER'] = os.path.abspath('output')
+
+
+def tearDownModule():
+    os.chdir('/')
+    shutil.rmtree(_tmp, ignore_errors=True)
+
+
+def disk_usage(path):
+    """Bytes and files under `path`, each hard-linked file counted once, like du"""
+    seen = set()
+    size = files = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            st = os.lstat(os.path.join(root, name))
+            if (st.st_dev, st.st_ino) not in seen:
+                seen.add((st.st_dev, st.st_ino))
+                size += st.st_size
+                files += 1
+    return size, files
+
+
+class AppTestCase(unittest.TestCase):
+    def setUp(self):
+        self.client = app.app.test_client()
+        self.client.post('/login', data={'username': 'admin', 'password': 'admin'})
+
+    def upload(self, pdf_bytes, **form):
+        response = self.client.post('/upload', data={'pdf_file': (io.BytesIO(pdf_bytes), 'test.pdf'), **form},
+                                    content_type='multipart/form-data')
+        self.assertEqual(response.status_code, 200, response.get_json())
+        return response.get_json()['id']
+
+    def wait_for_jobs(self, timeout=60):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            stats = app.job_queue.stats()
+            if not stats['pending'] and not stats['running']:
+                return
+            time.sleep(0.1)
+        self.fail("Jobs did not finish")
+
+    def chunked_upload(self, filename, data):
+        response = self.client.post('/uploads', data={'filename': filename, 'size': len(data)})
+        upload_id = response.get_json()['id']
+        response = self.client.patch(f'/uploads/{upload_id}', data=data, headers={'Upload-Offset': '0'})
+        self.assertEqual(response.status_code, 200, response.get_json())
+        return upload_id
+
+    def blank_pdf(self, pages):
+        path = os.path.join(_tmp, f"blank-{pages}.pdf")
+        write_blank_pdf(path, pages)
+        with open(path, 'rb') as f:
+            return f.read()
+
+
+class ChunkedUploadRouteTest(AppTestCase):
+    def test_resume_from_the_offset_in_the_409(self):
+        pdf = self.blank_pdf(1)
+        upload_id = self.client.post('/uploads', data={'filename': 'doc.pdf', 'size': len(pdf)}).get_json()['id']
+        self.client.patch(f'/uploads/{upload_id}', data=pdf[:100], headers={'Upload-Offset': '0'})
+        response = self.client.patch(f'/uploads/{upload_id}', data=pdf[50:], headers={'Upload-Offset': '50'})
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['offset'], 100)
+
+        response = self.client.post(f'/uploads/{upload_id}/complete')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.get_json()['offset'], 100)
+
+        offset = response.get_json()['offset']
+        response = self.client.patch(f'/uploads/{upload_id}', data=pdf[offset:],
+                                     headers={'Upload-Offset': str(offset)})
+        self.assertTrue(response.get_json()['complete'])
+
+    def test_wrong_signature_is_a_415(self):
+        upload_id = self.client.post('/uploads', data={'filename': 'doc.pdf', 'size': 100000}).get_json()['id']
+        response = self.client.patch(f'/uploads/{upload_id}', data=b"GIF89a" + b"\0" * 2000,
+                                     headers={'Upload-Offset': '0'})
+        self.assertEqual(response.status_code, 415)
+        self.assertEqual(self.client.get(f'/uploads/{upload_id}').status_code, 404)
+
+
+class CachedUsageTest(AppTestCase):
+    def test_totals_match_disk_after_cached_conversion(self):
+        pdf = self.blank_pdf(3)
+        first = self.upload(pdf, dpi='50')
+        self.wait_for_jobs()
+        self.assertEqual(app.get_status(first)['status'], 'completed')
+        second = self.upload(pdf, dpi='50')
+        self.assertTrue(app.get_status(second).get('cache_hit'))
+
+        # No reconcile in between: the counters must already hold the cache entry, once
+        self.assertEqual(app.usage_tracker.totals()['output'], disk_usage(app.app.config['OUTPUT_FOLDER']))
+
+    def test_disk_usage_route_counts_cache_entries(self):
+        pdf = self.blank_pdf(2)
+        self.upload(pdf, dpi='40')
+        self.wait_for_jobs()
+        self.upload(pdf, dpi='40')
+
+        output = self.client.get('/disk-usage').get_json()['output']
+        self.assertEqual((output['raw_size'], output['count']), disk_usage(app.app.config['OUTPUT_FOLDER']))
+
+
+class CachedQuotaTest(AppTestCase):
+    def footprint(self, user_id):
+        """Bytes of a user's conversions with every page counted, shared or not"""
+        total = 0
+        for record in app.conversion_store.list_conversions(user_id, limit=1000):
+            file_id = record['id']
+            for path in (os.path.join(app.app.config['UPLOAD_FOLDER'], f"{file_id}.pdf"),
+                         os.path.join(app.app.config['STATUS_FOLDER'], f"{file_id}.json")):
+                if os.path.exists(path):
+                    total += os.path.getsize(path)
+            for root, _, names in os.walk(os.path.join(app.app.config['OUTPUT_FOLDER'], file_id)):
+                total += sum(os.lstat(os.path.join(root, name)).st_size for name in names)
+        return total
+
+    def test_quota_counts_cached_pages(self):
+        pdf = self.blank_pdf(4)
+        self.upload(pdf, dpi='60')
+        self.wait_for_jobs()
+        self.upload(pdf, dpi='60')
+
+        used = dict(app.conversion_store.usage_by_user())['admin']
+        self.assertEqual(used, self.footprint('admin'))
+
+        service = app.retention_service
+        quota = service.user_quota
+        service.user_quota = used - 1
+        try:
+            deleted = service.run_once()
+        finally:
+            service.user_quota = quota
+        self.assertGreaterEqual(deleted['user_quota'], 1)
+        self.assertLessEqual(dict(app.conversion_store.usage_by_user()).get('admin', 0), used - 1)
+
+
+class BatchArchiveLimitsTest(AppTestCase):
+    def archive(self, count):
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, 'w', zipfile.ZIP_DEFLATED) as zf:
+            for i in range(count):
+                zf.writestr(f"doc{i}.pdf", self.blank_pdf(1) + b" " * 100000)
+        return buffer.getvalue()
+
+    def uploads_left(self):
+        return sorted(name for name in os.listdir(app.app.config['UPLOAD_FOLDER']) if not name.startswith('.'))
+
+    def post_batch(self, data):
+        before = self.uploads_left()
+        response = self.client.post('/batch', data={'upload_id': self.chunked_upload('set.zip', data)})
+        self.assertEqual(self.uploads_left(), before)
+        return response
+
+    def test_too_many_pdfs(self):
+        app.app.config['BATCH_MAX_PDFS'] = 2
+        try:
+            response = self.post_batch(self.archive(3))
+        finally:
+            app.app.config['BATCH_MAX_PDFS'] = 500
+        self.assertEqual(response.status_code, 413)
+
+    def test_too_many_extracted_bytes(self):
+        max_bytes = app.app.config['BATCH_MAX_EXTRACTED_SIZE']
+        # Each PDF is 100 kB once extracted, but the archive is a few kB
+        app.app.config['BATCH_MAX_EXTRACTED_SIZE'] = 250000
+        try:
+            response = self.post_batch(self.archive(3))
+        finally:
+            app.app.config['BATCH_MAX_EXTRACTED_SIZE'] = max_bytes
+        self.assertEqual(response.status_code, 413)
+
+
+class LazyArchiveTest(AppTestCase):
+    def test_archive_skips_a_page_that_stays_locked(self):
+        file_id = self.upload(self.blank_pdf(3), lazy='1', dpi='40')
+        output_dir = os.path.join(app.app.config['OUTPUT_FOLDER'], file_id)
+        # Render page 1 with the default timeout, so the render pool has started
+        # before page 3 has to render within the short one below
+        app.ensure_lazy_page(file_id, app.get_status(file_id), 1)
+        timeout = app.app.config['LAZY_RENDER_TIMEOUT']
+        app.app.config['LAZY_RENDER_TIMEOUT'] = 0.5
+        # As if another worker were rendering page 2 and never finished
+        with open(os.path.join(output_dir, '.page2.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                response = self.client.get(f'/download-all/{file_id}')
+                data = response.get_data()
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+                app.app.config['LAZY_RENDER_TIMEOUT'] = timeout
+
+        self.assertEqual(response.status_code, 200)
+        with zipfile.ZipFile(io.BytesIO(data)) as zf:
+            self.assertIsNone(zf.testzip())
+            names = zf.namelist()
+        self.assertEqual(len(names), 2)
+        self.assertFalse(any('page0002' in name for name in names))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""Tests of UploadSessions; run with `python -m pytest` or `python -m unittest`."""
+import io
+import os
+import shutil
+import hashlib
+import tempfile
+import unittest
+
+import chunked_upload
+from chunked_upload import UploadError, UploadSessions
+
+PDF = b"%PDF-1.4\n" + bytes(range(256)) * 40 + b"\n%%EOF\n"
+
+
+class UploadSessionsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.directory = os.path.join(self.tmp, 'partial')
+        self.sessions = UploadSessions(self.directory, max_size=1024 * 1024)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def append(self, sessions, upload_id, offset, data):
+        return sessions.append(upload_id, 'alice', offset, io.BytesIO(data))
+
+    def test_chunk_at_wrong_offset_is_refused_with_current_offset(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(PDF))['id']
+        self.append(self.sessions, upload_id, 0, PDF[:1000])
+        for offset in (0, 500, 1500):
+            with self.assertRaises(UploadError) as caught:
+                self.append(self.sessions, upload_id, offset, PDF[offset:offset + 1000])
+            self.assertEqual(caught.exception.status, 409)
+            self.assertEqual(caught.exception.offset, 1000)
+        # Nothing was written by the refused chunks
+        self.assertEqual(self.append(self.sessions, upload_id, 1000, PDF[1000:])['offset'], len(PDF))
+
+    def test_wrong_signature_is_rejected_on_first_chunk(self):
+        data = b"GIF89a" + b"\0" * 100000
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(data))['id']
+        with self.assertRaises(UploadError) as caught:
+            self.append(self.sessions, upload_id, 0, data[:4096])
+        self.assertEqual(caught.exception.status, 415)
+        # The upload is gone: no later chunk or finish can go through
+        self.assertFalse(self.sessions.exists(upload_id))
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_zip_signature(self):
+        upload_id = self.sessions.create('alice', 'set.zip', 10)['id']
+        with self.assertRaises(UploadError) as caught:
+            self.append(self.sessions, upload_id, 0, b"%PDF-1.4\n\n")
+        self.assertEqual(caught.exception.status, 415)
+
+    def test_hash_catches_up_in_another_process(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(PDF))['id']
+        self.append(self.sessions, upload_id, 0, PDF[:3000])
+        # The next chunks reach other gunicorn workers, which never saw the first
+        other = UploadSessions(self.directory, max_size=1024 * 1024)
+        self.append(other, upload_id, 3000, PDF[3000:6000])
+        self.append(UploadSessions(self.directory, max_size=1024 * 1024), upload_id, 6000, PDF[6000:])
+
+        path = os.path.join(self.tmp, 'doc.pdf')
+        record = other.finish(upload_id, 'alice', path)
+        self.assertEqual(record['sha256'], hashlib.sha256(PDF).hexdigest())
+        with open(path, 'rb') as f:
+            self.assertEqual(f.read(), PDF)
+
+    def test_hash_catches_up_when_this_process_is_behind(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(PDF))['id']
+        self.append(self.sessions, upload_id, 0, PDF[:2000])
+        self.append(UploadSessions(self.directory, max_size=1024 * 1024), upload_id, 2000, PDF[2000:5000])
+        # This process's hash state stops at 2000 bytes
+        record = self.append(self.sessions, upload_id, 5000, PDF[5000:])
+        self.assertEqual(self.sessions.get(upload_id)['sha256'], hashlib.sha256(PDF).hexdigest())
+        self.assertEqual(record['offset'], len(PDF))
+
+    def test_hash_over_several_copy_blocks(self):
+        data = b"%PDF-1.4\n" + os.urandom(3 * chunked_upload.COPY_BLOCK_SIZE // 2)
+        sessions = UploadSessions(self.directory, max_size=len(data))
+        upload_id = sessions.create('alice', 'doc.pdf', len(data))['id']
+        half = len(data) // 2
+        self.append(sessions, upload_id, 0, data[:half])
+        self.append(UploadSessions(self.directory, max_size=len(data)), upload_id, half, data[half:])
+        self.assertEqual(sessions.get(upload_id)['sha256'], hashlib.sha256(data).hexdigest())
+
+    def test_finish_incomplete_upload(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(PDF))['id']
+        self.append(self.sessions, upload_id, 0, PDF[:1000])
+        path = os.path.join(self.tmp, 'doc.pdf')
+        with self.assertRaises(UploadError) as caught:
+            self.sessions.finish(upload_id, 'alice', path)
+        self.assertEqual(caught.exception.status, 409)
+        self.assertEqual(caught.exception.offset, 1000)
+        self.assertFalse(os.path.exists(path))
+        # The upload can still be completed
+        self.append(self.sessions, upload_id, 1000, PDF[1000:])
+        self.assertEqual(self.sessions.finish(upload_id, 'alice', path)['sha256'], hashlib.sha256(PDF).hexdigest())
+        self.assertFalse(self.sessions.exists(upload_id))
+
+    def test_chunk_past_the_end(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', 100)['id']
+        with self.assertRaises(UploadError) as caught:
+            self.append(self.sessions, upload_id, 0, PDF[:200])
+        self.assertEqual(caught.exception.status, 400)
+
+    def test_other_users_upload_is_not_found(self):
+        upload_id = self.sessions.create('alice', 'doc.pdf', len(PDF))['id']
+        with self.assertRaises(UploadError) as caught:
+            self.sessions.append(upload_id, 'bob', 0, io.BytesIO(PDF))
+        self.assertEqual(caught.exception.status, 404)
+
+
+if __name__ == '__main__':
+    unittest.main()
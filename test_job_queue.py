@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+"""Tests of JobQueue; run with `python -m pytest` or `python -m unittest`."""
+import os
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+from job_queue import HOLDER_PREFIX, JobQueue, QueueFull
+
+
+class JobQueueTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.db_path = os.path.join(self.tmp, 'jobs.db')
+        self.lock_dir = os.path.join(self.tmp, 'locks')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_queue(self, runner=None, **kwargs):
+        """A queue on the shared database, like one gunicorn worker's"""
+        kwargs.setdefault('poll_interval', 0.05)
+        return JobQueue(runner or (lambda job_id, *args: None), self.db_path, self.lock_dir, **kwargs)
+
+    def wait_until(self, condition, timeout=10):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out")
+            time.sleep(0.02)
+
+
+class FairnessTest(JobQueueTestCase):
+    def submit_jobs(self, queue):
+        for job_id, user_id in (('a1', 'a'), ('a2', 'a'), ('a3', 'a'), ('b1', 'b'), ('c1', 'c'), ('c2', 'c')):
+            queue.submit(job_id, user_id, job_id)
+
+    def test_pending_order_is_round_robin(self):
+        queue = self.make_queue()
+        self.submit_jobs(queue)
+        expected = ['a1', 'b1', 'c1', 'a2', 'c2', 'a3']
+        self.assertEqual(queue._pending_order(), expected)
+        self.assertEqual([queue.position(job_id) for job_id in expected], list(range(1, 7)))
+
+    def test_jobs_run_round_robin(self):
+        order = []
+        queue = self.make_queue(lambda job_id, *args: order.append(job_id), num_workers=1)
+        self.submit_jobs(queue)
+        queue.start()
+        self.wait_until(lambda: len(order) == 6)
+        self.assertEqual(order, ['a1', 'b1', 'c1', 'a2', 'c2', 'a3'])
+
+    def test_user_served_last_goes_to_the_back(self):
+        queue = self.make_queue()
+        queue.submit('a1', 'a')
+        queue._finish(queue._claim()[0])
+        # 'a' was just served, so 'b', who queued later, comes first
+        queue.submit('a2', 'a')
+        queue.submit('b1', 'b')
+        self.assertEqual(queue._pending_order(), ['b1', 'a2'])
+        self.assertEqual(queue._claim()[0], 'b1')
+
+
+class AdmissionTest(JobQueueTestCase):
+    def test_per_user_and_server_caps(self):
+        queue = self.make_queue(max_pending=50, max_pending_per_user=10)
+        for i in range(10):
+            queue.submit(f"a{i}", 'a')
+        with self.assertRaises(QueueFull):
+            queue.submit('a10', 'a')
+        for user in 'bcd':
+            for i in range(10):
+                queue.submit(f"{user}{i}", user)
+        for i in range(9):
+            queue.submit(f"e{i}", 'e')
+        queue.submit('f0', 'f')
+        self.assertEqual(queue.stats()['pending'], 50)
+        with self.assertRaises(QueueFull):
+            queue.submit('g0', 'g')
+        # Recovered jobs are queued regardless
+        queue.submit('g0', 'g', force=True)
+        self.assertEqual(queue.stats()['pending'], 51)
+
+    def test_running_jobs_do_not_count(self):
+        queue = self.make_queue(max_pending=1)
+        queue.submit('a1', 'a')
+        queue._claim()
+        queue.submit('a2', 'a')
+        self.assertEqual(queue.stats()['running'], 1)
+        self.assertEqual(queue.stats()['pending'], 1)
+
+
+class SlotsTest(JobQueueTestCase):
+    def test_slots_are_shared_by_processes(self):
+        first, second = self.make_queue(slots=1), self.make_queue(slots=1)
+        first.submit('a1', 'a')
+        first.submit('b1', 'b')
+        job_id, _ = first._claim()
+        self.assertIsNone(second._claim())
+        first._finish(job_id)
+        self.assertEqual(second._claim()[0], 'b1')
+
+    def test_workers_never_exceed_slots(self):
+        release = threading.Event()
+        lock = threading.Lock()
+        running = []
+        peak = []
+
+        def runner(job_id, *args):
+            with lock:
+                running.append(job_id)
+                peak.append(len(running))
+            release.wait(10)
+            with lock:
+                running.remove(job_id)
+
+        queues = [self.make_queue(runner, num_workers=2, slots=3) for _ in range(2)]
+        for i in range(6):
+            queues[0].submit(f"j{i}", f"user{i}")
+        for queue in queues:
+            queue.start()
+        self.wait_until(lambda: queues[0].stats()['running'] == 3)
+        # Give the idle workers a few polls to overstep the limit
+        time.sleep(0.3)
+        self.assertEqual(queues[0].stats()['running'], 3)
+        release.set()
+        self.wait_until(lambda: queues[0].stats()['pending'] == 0 and queues[0].stats()['running'] == 0)
+        self.assertEqual(max(peak), 3)
+
+
+class RecoveryTest(JobQueueTestCase):
+    def test_jobs_of_a_dead_holder_are_requeued(self):
+        requeued = []
+        dead = self.make_queue()
+        alive = self.make_queue()
+        sweeper = self.make_queue(on_requeue=lambda job_id, *args: requeued.append((job_id, args)))
+        dead.submit('a1', 'a', 'doc.pdf')
+        dead.submit('b1', 'b')
+        self.assertEqual(dead._claim()[0], 'a1')
+        self.assertEqual(alive._claim()[0], 'b1')
+        dead_lock = dead._holder_path(dead._holder)
+        # As if the process had been killed: the kernel releases its flock
+        dead._holder_handle.close()
+
+        self.assertEqual(sweeper.sweep(), 1)
+        self.assertEqual(requeued, [('a1', ('doc.pdf',))])
+        self.assertFalse(os.path.exists(dead_lock))
+        self.assertEqual(sweeper._pending_order(), ['a1'])
+        self.assertEqual(sweeper.stats()['running'], 1)
+        # The requeued job runs again, in whichever process claims it
+        self.assertEqual(sweeper._claim(), ('a1', ['doc.pdf']))
+
+    def test_live_holders_keep_their_jobs(self):
+        first, second = self.make_queue(), self.make_queue()
+        first.submit('a1', 'a')
+        first._claim()
+        self.assertEqual(second.sweep(), 0)
+        self.assertEqual(second.stats()['running'], 1)
+        self.assertEqual(len([name for name in os.listdir(self.lock_dir) if name.startswith(HOLDER_PREFIX)]), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
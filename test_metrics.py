@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Tests of Metrics shared between processes; run with `python -m pytest` or `python -m unittest`."""
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from metrics import ARCHIVE_NAME, Metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def make_metrics(self):
+        """The registry of one gunicorn worker, sharing the directory with the others"""
+        metrics = Metrics(self.tmp)
+        metrics.counter('jobs_total', 'Finished jobs', ('outcome',))
+        metrics.gauge('active_jobs', 'Running jobs')
+        metrics.histogram('job_seconds', 'Job durations', buckets=(1, 10))
+        return metrics
+
+    def record(self, metrics, jobs, active, seconds):
+        metrics.inc('jobs_total', jobs, outcome='ok')
+        metrics.set('active_jobs', active)
+        metrics.observe('job_seconds', seconds)
+        metrics.flush()
+
+    def test_counters_and_gauges_are_summed(self):
+        first, second = self.make_metrics(), self.make_metrics()
+        self.record(first, 2, 1, 0.5)
+        self.record(second, 3, 2, 5)
+
+        merged = first.collect()
+        self.assertEqual(merged['jobs_total'], {('ok',): 5})
+        self.assertEqual(merged['active_jobs'], {(): 3})
+        # Per-bucket counts, then sum and count
+        self.assertEqual(merged['job_seconds'], {(): [1, 1, 0, 5.5, 2]})
+        self.assertIn('jobs_total{outcome="ok"} 5', second.render().splitlines())
+
+    def test_exited_process_keeps_counters_and_drops_gauges(self):
+        first, second = self.make_metrics(), self.make_metrics()
+        self.record(first, 2, 1, 0.5)
+        self.record(second, 3, 2, 5)
+        second_name = second._name
+        # As if the worker had exited: the kernel releases its lock
+        second._name_handle.close()
+
+        for _ in range(2):
+            # Archived once, however often it is collected
+            merged = first.collect()
+            self.assertEqual(merged['jobs_total'], {('ok',): 5})
+            self.assertEqual(merged['job_seconds'][()][-1], 2)
+            self.assertEqual(merged['active_jobs'], {(): 1})
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, ARCHIVE_NAME)))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, f"{second_name}.json")))
+        self.assertFalse(os.path.exists(os.path.join(self.tmp, f"{second_name}.lock")))
+
+        # Its replacement starts from zero; the totals do not go backwards
+        replacement = self.make_metrics()
+        self.record(replacement, 1, 4, 20)
+        merged = first.collect()
+        self.assertEqual(merged['jobs_total'], {('ok',): 6})
+        self.assertEqual(merged['active_jobs'], {(): 5})
+
+    def test_concurrent_flushes_take_one_lock(self):
+        metrics = self.make_metrics()
+        metrics.inc('jobs_total', outcome='ok')
+        barrier = threading.Barrier(8)
+
+        def flush():
+            barrier.wait()
+            metrics.flush(force=True)
+
+        threads = [threading.Thread(target=flush) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        locks = [name for name in os.listdir(self.tmp) if name.endswith('.lock') and name != '.archive.lock']
+        self.assertEqual(locks, [f"{metrics._name}.lock"])
+        self.assertEqual(self.make_metrics().collect()['jobs_total'], {('ok',): 1})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+"""Tests of process_batch; run with `python -m pytest` or `python -m unittest`."""
+import os
+import shutil
+import tempfile
+import unittest
+
+import pdf_to_image
+
+
+def write_blank_pdf(path, page_count):
+    """Write a PDF of `page_count` blank A7 pages"""
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>"]
+    kids = " ".join(f"{3 + i} 0 R" for i in range(page_count))
+    objects.append(f"<< /Type /Pages /Kids [{kids}] /Count {page_count} >>".encode())
+    for _ in range(page_count):
+        objects.append(b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 210 298] >>")
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += f"{number} 0 obj\n".encode() + body + b"\nendobj\n"
+    xref = len(data)
+    data += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n".encode()
+    data += b"".join(f"{offset:010d} 00000 n \n".encode() for offset in offsets)
+    data += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n".encode()
+    with open(path, 'wb') as f:
+        f.write(data)
+
+
+class ProcessBatchCancelTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.documents = []
+        for key in ('a', 'b'):
+            pdf_path = os.path.join(self.tmp, f"{key}.pdf")
+            write_blank_pdf(pdf_path, 4)
+            self.documents.append((key, pdf_path, os.path.join(self.tmp, f"out-{key}")))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def run_batch(self, workers):
+        def progress_callback(key, progress):
+            if key == 'a':
+                raise pdf_to_image.ConversionCancelled()
+
+        return pdf_to_image.process_batch(self.documents, dpi=30, chunk_size=1, workers=workers,
+                                          progress_callback=progress_callback)
+
+    def assert_cancelled(self, results):
+        self.assertEqual(results['a']['status'], 'cancelled')
+        self.assertIsNone(results['a']['error'])
+        self.assertLess(results['a']['pages'], 4)
+        self.assertEqual(results['b']['status'], 'completed')
+        self.assertEqual(results['b']['pages'], 4)
+
+    def test_cancel_from_progress_callback(self):
+        self.assert_cancelled(self.run_batch(workers=1))
+
+    def test_cancel_from_progress_callback_with_pool(self):
+        self.assert_cancelled(self.run_batch(workers=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Tests of the backend choice in renderers; run with `python -m pytest` or `python -m unittest`."""
+import os
+import shutil
+import tempfile
+import unittest
+from unittest import mock
+
+import benchmark
+import renderers
+from test_pdf_to_image import write_blank_pdf
+
+
+class DocumentTypeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def corpus_document(self, name):
+        _, kind, _, size, max_skew, color = next(doc for doc in benchmark.CORPUS if doc[0] == name)
+        path = os.path.join(self.tmp, f"{name}.pdf")
+        benchmark.write_corpus_document(path, kind, 2, size, max_skew, color)
+        return path
+
+    def test_classifies_corpus_documents(self):
+        self.assertEqual(renderers.document_type(self.corpus_document('scan-gray-a4')), 'scan')
+        self.assertEqual(renderers.document_type(self.corpus_document('vector-text-a4')), 'vector')
+
+    def test_auto_follows_renderer_by_type(self):
+        available = renderers.available_renderers()
+        scan = self.corpus_document('scan-color-a4')
+        vector = os.path.join(self.tmp, "blank.pdf")
+        write_blank_pdf(vector, 1)
+        unavailable = next((name for name in renderers.RENDERER_PREFERENCE if name not in available), None)
+        mapping = {'scan': available[-1]}
+        if unavailable is not None:
+            mapping['vector'] = unavailable
+        with mock.patch.object(renderers, 'RENDERER_BY_TYPE', mapping):
+            self.assertEqual(renderers.get_renderer('auto', scan).name, available[-1])
+            # An unavailable or missing choice falls back to the preference order
+            self.assertEqual(renderers.get_renderer('auto', vector).name, available[0])
+            # A named backend is used as is
+            self.assertEqual(renderers.get_renderer(available[0], scan).name, available[0])
+
+    def test_parse_renderer_by_type(self):
+        self.assertEqual(renderers.parse_renderer_by_type("scan=pdftoppm, vector = pymupdf"),
+                         {'scan': 'pdftoppm', 'vector': 'pymupdf'})
+        self.assertEqual(renderers.parse_renderer_by_type("text=pdftoppm,scan=nope,"), {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+"""
+Disk usage of the app folders, kept as counters in the conversion store.
+
+The app updates the counters as it writes and removes files: uploads,
+status files, the pages of a conversion, and the entries of the
+conversion cache. Reading the totals is
+then a single query instead of a walk over every file. A background
+thread rescans the folders now and then to correct any drift, such as
+files removed by hand or writes lost when a process crashed.
+"""
+import os
+import time
+import fcntl
+import threading
+
+
+def tree_usage(path, shared='count', skip_inodes=()):
+    """
+    Bytes and files under `path`.
+
+    Args:
+        shared: What to count of files that have other hard links: 'count'
+            their whole size, 'skip' them, or 'split' their size between
+            their links, so that the holders add up to one copy
+        skip_inodes: (st_dev, st_ino) of shared files that are counted
+            elsewhere, as returned by shared_inodes
+    """
+    size = files = 0
+    stack = [path]
+    while stack:
+        try:
+            entries = list(os.scandir(stack.pop()))
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    st = entry.stat(follow_symlinks=False)
+                    if st.st_nlink == 1 or shared == 'count':
+                        size += st.st_size
+                    elif shared == 'skip' or (st.st_dev, st.st_ino) in skip_inodes:
+                        continue
+                    else:
+                        size += st.st_size // st.st_nlink
+                    files += 1
+            except OSError:
+                # Removed while scanning
+                continue
+    return size, files
+
+
+def shared_inodes(path):
+    """Set of (st_dev, st_ino) of the files under `path` that have other hard links"""
+    inodes = set()
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if st.st_nlink > 1:
+                inodes.add((st.st_dev, st.st_ino))
+    return inodes
+
+
+def linked_usage(path, inodes):
+    """Bytes and files under `path` that are hard links to the files `inodes` (see shared_inodes)"""
+    size = files = 0
+    if not inodes:
+        return size, files
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except OSError:
+                continue
+            if (st.st_dev, st.st_ino) in inodes:
+                size += st.st_size
+                files += 1
+    return size, files
+
+
+def _add(usage, file_id, category, size, files):
+    categories = usage.setdefault(file_id, {})
+    old_size, old_files = categories.get(category, (0, 0))
+    categories[category] = (old_size + size, old_files + files)
+
+
+def scan_usage(upload_folder, output_folder, status_folder):
+    """
+    Walk the app folders and attribute every file to its conversion.
+
+    Files that belong to no conversion (the metadata database, lock files,
+    temp files) are attributed to file_id ''. Pages hard-linked between
+    the conversion cache and conversions are counted once, as part of the
+    cache, and recorded as 'linked' for the conversions so they still count
+    toward their owner's quota; pages still shared between conversions
+    after their cache entry was evicted are split between them.
+
+    Returns:
+        dict of file_id -> {category: (bytes, files)}, as taken by
+        ConversionStore.replace_usage
+    """
+    usage = {}
+
+    for entry in os.scandir(upload_folder):
+        if entry.is_file():
+            file_id = '' if entry.name.startswith('.') else entry.name.split('.')[0]
+            _add(usage, file_id, 'upload', entry.stat().st_size, 1)
+
+    cached = set()
+    for entry in os.scandir(output_folder):
+        if entry.name.startswith('.') and entry.is_dir():
+            _add(usage, '', 'output', *tree_usage(entry.path))
+            cached |= shared_inodes(entry.path)
+
+    for entry in os.scandir(output_folder):
+        if entry.name.startswith('.'):
+            if not entry.is_dir():
+                _add(usage, '', 'output', entry.stat().st_size, 1)
+        elif entry.is_dir():
+            _add(usage, entry.name, 'output', *tree_usage(entry.path, shared='split', skip_inodes=cached))
+            _add(usage, entry.name, 'linked', *linked_usage(entry.path, cached))
+        elif entry.name.endswith('_images.zip'):
+            _add(usage, entry.name[:-len('_images.zip')], 'output', entry.stat().st_size, 1)
+        else:
+            _add(usage, '', 'output', entry.stat().st_size, 1)
+
+    for entry in os.scandir(status_folder):
+        if entry.is_file():
+            is_status = entry.name.endswith('.json') and not entry.name.startswith('.')
+            file_id = entry.name[:-len('.json')] if is_status else ''
+            _add(usage, file_id, 'status', entry.stat().st_size, 1)
+
+    return usage
+
+
+class UsageTracker:
+    """
+    Reads disk usage totals and reconciles them with the folders.
+
+    Args:
+        store: ConversionStore holding the counters
+        upload_folder, output_folder, status_folder: App folders to scan
+        interval: Seconds between reconciliation scans
+    """
+
+    def __init__(self, store, upload_folder, output_folder, status_folder, interval=3600):
+        self.store = store
+        self.folders = (upload_folder, output_folder, status_folder)
+        self.interval = interval
+        self._lock_path = os.path.join(status_folder, '.usage.lock')
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def last_reconciled(self):
+        value = self.store.get_meta('usage_reconciled_at')
+        return float(value) if value is not None else None
+
+    def reconcile(self):
+        """
+        Rescan the folders and replace the counters.
+
+        Only one process scans at a time; the others skip the scan.
+
+        Returns:
+            Whether this call did the scan
+        """
+        with open(self._lock_path, 'a') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                return False
+            try:
+                started = time.time()
+                self.store.replace_usage(scan_usage(*self.folders))
+                self.store.set_meta('usage_reconciled_at', started)
+                print(f"Reconciled disk usage in {time.time() - started:.1f}s")
+                return True
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _run(self):
+        while True:
+            last = self.last_reconciled()
+            due = 0 if last is None else last + self.interval - time.time()
+            if due > 0:
+                time.sleep(due)
+                continue
+            try:
+                self.reconcile()
+            except Exception as e:
+                print(f"Error reconciling disk usage: {str(e)}")
+            # Another process may hold the lock; give it time to record its scan
+            time.sleep(min(60, self.interval))
+
+    def start(self):
+        """Start the background reconciliation thread, once per process"""
+        # Started lazily so importing the app never spawns threads (e.g. before gunicorn forks)
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="usage-reconcile", daemon=True)
+                self._thread.start()
+
+    def totals(self, user_id=None):
+        """dict of category -> (bytes, files); see ConversionStore.usage_totals"""
+        self.start()
+        return self.store.usage_totals(user_id)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""
+ZIP archives of conversion outputs, streamed or cached on disk.
+
+Page images are PNG/JPEG/WebP, which are already compressed, so they are
+stored without deflate. That makes an archive little more than a copy of
+the images, cheap enough to stream on the fly. The first bytes go out
+as soon as the first image is read.
+"""
+import os
+import zipfile
+
+# Formats that gain nothing from deflate
+STORED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.webp')
+
+# Bytes read from each image at a time while streaming
+STREAM_CHUNK_SIZE = 1024 * 1024
+
+
+class _StreamSink:
+    """
+    Write-only file object that collects what ZipFile writes until drained.
+
+    It has no tell() or seek(), so ZipFile writes in streaming mode with
+    data descriptors.
+    """
+
+    def __init__(self):
+        self._chunks = []
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def archive_files(output_dir):
+    """
+    Files of a conversion that go into its archive, in name order.
+
+    Subdirectories and hidden files (like in-progress temp files) are skipped.
+    """
+    return sorted(
+        name for name in os.listdir(output_dir)
+        if not name.startswith('.') and os.path.isfile(os.path.join(output_dir, name))
+    )
+
+
+def _zip_info(path, arcname):
+    zinfo = zipfile.ZipInfo.from_file(path, arcname)
+    if arcname.lower().endswith(STORED_EXTENSIONS):
+        zinfo.compress_type = zipfile.ZIP_STORED
+    else:
+        zinfo.compress_type = zipfile.ZIP_DEFLATED
+    return zinfo
+
+
+def iter_zip(output_dir, files=None, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Generate a ZIP archive of `output_dir` as a stream of byte chunks.
+
+    Args:
+        output_dir: Directory with the files to archive
+        files: Names of the files to include (default: archive_files(output_dir))
+        chunk_size: Bytes read from each file at a time
+
+    Yields:
+        Consecutive chunks of the archive
+    """
+    if files is None:
+        files = archive_files(output_dir)
+
+    sink = _StreamSink()
+    with zipfile.ZipFile(sink, 'w') as zf:
+        for name in files:
+            path = os.path.join(output_dir, name)
+            with open(path, 'rb') as src, zf.open(_zip_info(path, name), 'w') as dest:
+                while True:
+                    data = src.read(chunk_size)
+                    if not data:
+                        break
+                    dest.write(data)
+                    yield sink.drain()
+            yield sink.drain()
+    # Central directory
+    yield sink.drain()
+
+
+def build_zip(output_dir, zip_path):
+    """
+    Write the archive of `output_dir` to `zip_path` atomically.
+
+    The archive is written to a temporary file next to `zip_path` and
+    renamed into place, so readers never see a partial archive and
+    concurrent builds of the same archive do not interfere.
+
+    Returns:
+        Path to the archive
+    """
+    tmp_path = os.path.join(os.path.dirname(zip_path),
+                            f".{os.path.basename(zip_path)}.{os.getpid()}.tmp")
+    try:
+        with zipfile.ZipFile(tmp_path, 'w') as zf:
+            for name in archive_files(output_dir):
+                path = os.path.join(output_dir, name)
+                zf.write(path, name, compress_type=_zip_info(path, name).compress_type)
+        os.replace(tmp_path, zip_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return zip_path